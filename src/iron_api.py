@@ -0,0 +1,53 @@
+"""
+Library API for assembling without the filesystem: source text and input files go in as buffers, and the ROM and its
+symbol table come back. Nothing is read from or written to disk, and no state is shared between calls, so level
+editors and test generators can assemble thousands of programs in a loop, or from several threads at once.
+
+	from iron_api import assemble_source
+	result = assemble_source("!CHR_FILE tiles.chr\\nreset:\\nJMP reset\\n", {"TILES.CHR": chr_bytes})
+	result.rom, result.labels["RESET"]
+
+Files are named by path relative to the source, as `.INCLUDE` and `.INCBIN` name them. File names given on `!` lines
+are uppercased along with the rest of the line, so the files they name need uppercase keys.
+"""
+from typing import Iterable, Mapping, Union
+
+import iron_token
+from iron_assembler import Assembler
+from iron_parser import Parser
+
+
+class Assembly:
+	"""
+	The result of assembling: the ROM, and the CPU address of each label and value of each symbol, by name.
+	"""
+
+	def __init__(self, rom: bytes, parser: Parser) -> None:
+		self.rom = rom
+		self.labels: dict[str, int] = {name: label.absolute_addr for name, label in parser.sym_lib.labels.items()}
+		self.symbols: dict[str, int] = {name: symbol.value for name, symbol in parser.sym_lib.symbols.items()}
+		self.parser = parser  # For anything else about the layout, such as where in PRG-ROM each label is
+
+	@property
+	def view(self) -> memoryview:
+		return memoryview(self.rom)
+
+
+def assemble_source(source: Union[str, bytes, Iterable[str]], files: Union[Mapping[str, bytes], None] = None,
+					optimize: bool = False, name: str = "main.asm",
+					defines: Union[Mapping[str, int], None] = None) -> Assembly:
+	"""
+	Assembles source, given as text, the raw bytes of a source file, or an iterable of lines, into a ROM. files holds
+	every file the source includes or puts in the ROM, by path; a file that isn't there raises FileNotFoundError, the
+	same as one missing from disk. defines sets symbols before the source's first line, for conditional assembly.
+	name only sets the source's path, which includes are relative to.
+	"""
+	if isinstance(source, bytes):
+		tokens = iron_token.lex_source(source)
+	elif isinstance(source, str):
+		tokens = iron_token.lex_lines(source.splitlines())
+	else:
+		tokens = iron_token.lex_lines(source)
+	assembler = Assembler(name, ".", ".", optimize=optimize, files=files or {}, defines=defines)
+	assembler.build(tokens)
+	return Assembly(assembler.virtual_cart.rom_bytes(), assembler.parser)
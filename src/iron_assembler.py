@@ -1,43 +1,200 @@
-import re
 import iron_token
 import iron_parser
+import iron_chr
+import iron_cycles
+import iron_patch
+from iron_macro import MacroExpander
+from iron_optimize import OptimizationReport, Optimizer
+from iron_image import PrgImage
+from iron_output import atomic_output, copy_file_into, write_all
 from number_reader import read
 import os
-from typing import Union
+from itertools import chain
+from typing import Iterable, Iterator, Mapping, Union
+
+
+def find_source_file(input_dir: str = "input") -> str:
+	for file in os.listdir(input_dir):
+		if file.endswith(".asm") or file.endswith(".s"):
+			return input_dir + "/" + file
+	raise FileNotFoundError("Can't find source file!")
+
+
+def _read_file(file_path: str, files: Union[dict[str, bytes], None] = None) -> bytes:
+	"""
+	Reads a file from disk, or from files, the in-memory files by normalized path, if they were given.
+	"""
+	if files is not None:
+		content = files.get(os.path.normpath(file_path))
+		if content is None:
+			raise FileNotFoundError(f"No file {file_path} was given")
+		return content
+	with open(file_path, mode="rb") as infile:
+		return infile.read()
 
 
 class Assembler:
-	def __init__(self, file_path: str):
+	def __init__(self, file_path: str, input_dir: str = "input", output_dir: str = "output",
+				 encode_workers: Union[int, None] = None, optimize: bool = False,
+				 files: Union[Mapping[str, bytes], None] = None, defines: Union[Mapping[str, int], None] = None):
 		self.main_asm_file = file_path
+		self.input_dir = input_dir
+		self.output_dir = output_dir
+		self.encode_workers = encode_workers  # Processes for the second pass; None or 1 encodes serially
+		self.optimize = optimize  # Run the peephole optimizer between label layout and encoding
+		self.optimization: Union[OptimizationReport, None] = None  # What the optimizer did in the last build
+		self.virtual_cart: Union[VirtualCartridge, None] = None
+		self.parser: Union[iron_parser.Parser, None] = None
+		self.included_files: list[str] = []  # Every file pulled in by .INCLUDE or .INCBIN in the last build
+		# Input files held in memory, by path; when given, they stand in for the disk, which is never read
+		self.files: Union[dict[str, bytes], None] = None
+		if files is not None:
+			self.files = {os.path.normpath(path): content for path, content in files.items()}
+		# Symbols set from outside the source, declared before its first line; the source may not declare them again
+		self.defines = {name.upper(): value for name, value in (defines or {}).items()}
+		self.conditions = iron_parser.Symbol_Library()  # Symbols declared so far, for conditional assembly
 
 	def assemble(self):
-		virtual_cart = VirtualCartridge(self.main_asm_file)
-		text_lines = self.preprocess_lines()  # Do things like removing comments, special-case line splitting, etc.
-		tokenizer = iron_token.Tokenizer(text_lines)
-		all_tokens = tokenizer.tokens
-		cart_config_strings = [token.content for token in all_tokens if token.type == "CART_CONFIG"]
-		virtual_cart.config_cart(cart_config_strings)
-		all_tokens = [token for token in all_tokens if token.type != "CART_CONFIG"]
-		parser = iron_parser.Parser(all_tokens)
-		virtual_cart.initialize_prg()
-		virtual_cart.write_all_bytes(parser.byte_obj_list)
-		virtual_cart.save()
+		self.build()
+		self.virtual_cart.save()
+
+	def build(self, tokens: Union[Iterable[iron_token.Token], None] = None) -> None:
+		"""
+		Lays out and encodes the program into a fresh VirtualCartridge, without saving it. Lexes the source file
+		unless already-lexed tokens are given.
+		"""
+		self.virtual_cart = VirtualCartridge(self.main_asm_file, self.input_dir, self.output_dir, self.files)
+		cart_config_strings, all_tokens = self.lex_tokens(tokens)
+		self.virtual_cart.config_cart(cart_config_strings)
+		self.virtual_cart.initialize_prg()
+		if not self.optimize:
+			self.parser = iron_parser.Parser(all_tokens, self.virtual_cart.prg_image, workers=self.encode_workers,
+											 files=self.files)
+		else:
+			self.parser = iron_parser.Parser(all_tokens, self.virtual_cart.prg_image, parse=False,
+											 workers=self.encode_workers, files=self.files)
+			self.parser.parse_symbols()
+			self.optimization = Optimizer(self.parser).run()
+			self.parser.parse_opcodes_and_raws()
+		if self.parser.cycle_budgets:
+			iron_cycles.check_budgets(self.parser)
+
+	def lex_tokens(
+			self, tokens: Union[Iterable[iron_token.Token], None] = None) -> tuple[list[str], list[iron_token.Token]]:
+		"""
+		Streams the source file through the lexer once, splicing in included files, expanding macros and splitting off
+		the cartridge config lines as it goes.
+		"""
+		if tokens is None and self.files is not None:
+			tokens = iron_token.lex_source(_read_file(self.main_asm_file, self.files))
+		elif tokens is None:
+			tokens = iron_token.lex_file(self.main_asm_file)
+		self.included_files = []
+		cart_config_strings = []
+		all_tokens = []
+		include_stack = (os.path.normpath(self.main_asm_file),)
+		define_tokens = [iron_token.Token(f"{name} = {value}") for name, value in self.defines.items()]
+		self.conditions = iron_parser.Symbol_Library()
+		self.conditions.add_symbols([token.content for token in define_tokens])
+		tokens = chain(define_tokens, self.expand_includes(tokens, self.main_asm_file, include_stack))
+		for token in MacroExpander().expand(tokens):
+			if token.type == "CART_CONFIG":
+				cart_config_strings.append(token.content)
+			else:
+				all_tokens.append(token)
+		return cart_config_strings, all_tokens
+
+	def expand_includes(self, tokens: Iterable[iron_token.Token], file_path: str,
+						include_stack: tuple[str, ...]) -> Iterator[iron_token.Token]:
+		"""
+		Replaces each .INCLUDE with the tokens of the file it names, recursively, and rewrites each .INCBIN to name its
+		file relative to the working directory. Paths are relative to the including file. All files included by one
+		file are lexed together, so they can be lexed in parallel. Conditional blocks are replaced by the branch their
+		condition picks, which is only lexed then, judged by the symbols declared before them.
+		"""
+		tokens = list(tokens)
+		base_dir = os.path.dirname(file_path)
+		include_paths = [
+			self.resolve_include(token.content, base_dir, self.files)[0] for token in tokens
+			if token.type == "RAW_DATA" and token.content.startswith(".INCLUDE ")
+		]
+		if self.files is not None:
+			lexed_files = {path: iron_token.lex_source(self.files[path]) for path in include_paths}
+		else:
+			lexed_files = iron_token.lex_files(include_paths) if include_paths else {}
+		for token in tokens:
+			if token.type == "CONDITIONAL":
+				if self.condition_holds(token):
+					first_line_no, lines = token.branches[0]
+				elif len(token.branches) == 2:
+					first_line_no, lines = token.branches[1]
+				else:
+					continue
+				yield from self.expand_includes(iron_token.lex_lines(lines, first_line_no), file_path, include_stack)
+				continue
+			if token.type == "SYMBOL":
+				name = token.content.split("=", 1)[0].strip()
+				if name in self.defines:
+					raise ValueError(f"{name} is set from outside the source, so it can't be declared again on line "
+									 f"{token.line_no}; declare it inside .IFNDEF {name} to give it a default")
+				try:
+					self.conditions.add_symbols([token.content])
+				except (ValueError, NameError):
+					pass  # Reported by the parser
+			if token.type == "RAW_DATA" and token.content.startswith((".INCLUDE ", ".INCBIN ")):
+				path, args = self.resolve_include(token.content, base_dir, self.files)
+				self.included_files.append(path)
+				if token.content.startswith(".INCBIN "):
+					token = token.copy()
+					token.content = " ".join([".INCBIN", f'"{path}"'] + args)
+				elif args:
+					raise ValueError(f"Unexpected arguments after the file name in [{token.content}]")
+				elif path in include_stack:
+					raise ValueError(f"Circular .INCLUDE of {path} (line {token.line_no} of {file_path})")
+				else:
+					yield from self.expand_includes(lexed_files[path], path, include_stack + (path,))
+					continue
+			yield token
+
+	def condition_holds(self, token: iron_token.Token) -> bool:
+		"""
+		Evaluates the condition of a `.IF`, `.IFDEF` or `.IFNDEF` against the symbols declared before it.
+		"""
+		directive, _, condition = token.content.partition(" ")
+		if condition == "":
+			raise ValueError(f"{directive} on line {token.line_no} needs a condition")
+		if directive in (".IFDEF", ".IFNDEF"):
+			if " " in condition:
+				raise ValueError(f"Expected one symbol name in [{token.content}] on line {token.line_no}")
+			return (condition in self.conditions.symbols) == (directive == ".IFDEF")
+		for operator, equal in (("<>", False), ("=", True)):
+			if operator in condition:
+				left, right = condition.split(operator, 1)
+				return (self.condition_value(left, token) == self.condition_value(right, token)) == equal
+		return self.condition_value(condition, token) != 0
+
+	def condition_value(self, text: str, token: iron_token.Token) -> int:
+		try:
+			return self.conditions.get_value(text.strip())
+		except NameError as error:
+			raise ValueError(
+				f"{error}, in [{token.content}] on line {token.line_no}; conditions can only use symbols declared "
+				f"before them") from None
+
+	@staticmethod
+	def resolve_include(content: str, base_dir: str,
+						files: Union[dict[str, bytes], None] = None) -> tuple[str, list[str]]:
+		file_name, args = iron_token.split_file_argument(content)
+		path = os.path.normpath(os.path.join(base_dir, file_name))
+		if not (os.path.isfile(path) if files is None else path in files):
+			raise FileNotFoundError(f"Can't find included file {path}, in [{content}]")
+		return path, args
 
 	def preprocess_lines(self) -> list[str]:
 		"""
 		Returns a list of strings, with whitespaces collapsed, comments removed, all uppercased, with no empty lines.
 		"""
-		with open(self.main_asm_file) as infile:
-			file_content = infile.read()
-		file_content = re.sub(pattern=r":([^+-])", repl=r":\g<1>\n", string=file_content)
-		out_lines = []
-		for line in file_content.split("\n"):
-			processed_line = line.upper().split(";")[0].strip()  # Removes comments, uppercases, strips whitespace
-			if processed_line == "":
-				continue
-			processed_line = re.sub(r"[ \t]+", " ", processed_line)
-			out_lines.append(processed_line)
-		return out_lines
+		return [token.content for token in iron_token.lex_file(self.main_asm_file)]
 
 
 class VirtualCartridge:
@@ -58,7 +215,8 @@ class VirtualCartridge:
 		"FAMICOM_NETWORK": 12
 	}
 
-	def __init__(self, prg_file: str) -> None:
+	def __init__(self, prg_file: str, input_dir: str = "input", output_dir: str = "output",
+				 files: Union[dict[str, bytes], None] = None) -> None:
 		self.prg_size: list[int] = [2]
 		self.chr_size: list[int] = [1]
 		self.mirror_mode: int = 1
@@ -74,13 +232,21 @@ class VirtualCartridge:
 		self.byte_13: int = 0
 		self.misc_roms: list[str] = []
 		self.default_device: int = 1
+		self.fill_byte: int = 0
+		self.prg_bank_size: int = 0x4000
 
 		self.prg_file = prg_file
+		self.input_dir = input_dir
+		self.output_dir = output_dir
+		self.files = files  # In-memory input files by normalized path, read instead of the disk if given
 		self.out_file = ""
 		self.chr_file = ""
+		self.chr_dedupe: bool = False
+		self.patch_format: str = ""
+		self.patch_only: bool = False
 
-		self.prg = bytearray(0)
-		self.prg_counter = 0
+		self.prg_image = PrgImage(0)
+		self.prg = self.prg_image.buffer
 
 	def config_cart(self, conf_list: list[str]) -> None:
 		for i in conf_list:
@@ -93,8 +259,18 @@ class VirtualCartridge:
 				self.arg_count_validate(config_args, 1)
 				self.out_file = config_args[1]
 			case "!CHR_FILE":
-				self.arg_count_validate(config_args, 1)
+				self.arg_count_validate(config_args, 1, 2)
+				if len(config_args) == 3:
+					self.set_validate(config_args, 2, ["DEDUPE"])
 				self.chr_file = config_args[1]
+				self.chr_dedupe = len(config_args) == 3
+			case "!PATCH":
+				self.arg_count_validate(config_args, 1, 2)
+				self.set_validate(config_args, 1, iron_patch.PATCH_FORMATS)
+				if len(config_args) == 3:
+					self.set_validate(config_args, 2, ["ONLY"])
+				self.patch_format = config_args[1]
+				self.patch_only = len(config_args) == 3
 			case "!PRG_SIZE":
 				self.arg_count_validate(config_args, 1, 2)
 				if len(config_args) == 2:
@@ -180,23 +356,46 @@ class VirtualCartridge:
 				self.arg_count_validate(config_args, 1)
 				self.range_validate(config_args, 1, 0x3A)
 				self.default_device = read(config_args[1])
+			case "!FILL_BYTE":
+				self.arg_count_validate(config_args, 1)
+				self.range_validate(config_args, 1, 0xFF)
+				self.fill_byte = read(config_args[1])
+			case "!PRG_BANK_SIZE":
+				self.arg_count_validate(config_args, 1)
+				bank_size = read(config_args[1])
+				if bank_size not in (0x1000, 0x2000, 0x4000, 0x8000):
+					raise ValueError(
+						f"Invalid value [{config_args[1]}] for argument 1 of {config_args[0]}; should be one of $1000, "
+						f"$2000, $4000, $8000")
+				self.prg_bank_size = bank_size
 
 	def initialize_prg(self) -> None:
 		if len(self.prg_size) == 1:
 			prg_size = self.prg_size[0] << 14
 		else:
 			prg_size = self.prg_size[0] << self.prg_size[1]
-		self.prg = bytearray(prg_size)
+		self.prg_image = PrgImage(prg_size, self.fill_byte, self.prg_bank_size)
+		self.prg = self.prg_image.buffer
+
+	@property
+	def prg_counter(self) -> int:
+		return self.prg_image.cursor
 
 	def write_bytes_progressive(self, raw_bytes: bytes) -> None:
-		bytes_len = len(raw_bytes)
-		self.prg[self.prg_counter:self.prg_counter + bytes_len] = raw_bytes
-		self.prg_counter += bytes_len
+		self.prg_image.write(raw_bytes)
 
 	def write_all_bytes(self, bytes_list: list[bytes]) -> None:
 		for obj in bytes_list:
 			self.write_bytes_progressive(obj)
 
+	def prg_offset(self) -> int:
+		"""
+		Returns where the PRG-ROM starts within the output file.
+		"""
+		if self.trainer == "":
+			return 16
+		return 16 + os.path.getsize(self.input_path(self.trainer))
+
 	def header(self) -> bytes:
 		header_bytes = bytearray(b"NES\x1A\x00\x00\x00\x08" + b"\x00" * 8)
 		if len(self.prg_size) == 1:
@@ -231,28 +430,112 @@ class VirtualCartridge:
 		header_bytes[15] = self.default_device
 		return bytes(header_bytes)
 
-	def save(self) -> None:
+	def resolve_paths(self) -> None:
+		"""
+		Fills in the default output file name, and looks for a CHR file in the input directory if none was configured.
+		"""
 		if self.out_file == "":
-			self.out_file = "".join(self.prg_file.removeprefix("input/").split(".")[:-1]) + ".nes"
+			self.out_file = "".join(self.prg_file.removeprefix(self.input_dir + "/").split(".")[:-1]) + ".nes"
 		self.out_file = self.out_file.lower()
 		if self.chr_file == "":
-			for file in os.listdir("input"):
-				if file.endswith(".chr"):
-					self.chr_file = file
-					break
+			self.chr_file = self.find_chr_file()
 		if self.chr_file == "":
 			raise FileNotFoundError("CHR file unspecified!")
-		with open("output/" + self.out_file, mode="wb") as out_file:
-			out_file.write(self.header())
+
+	def output_path(self) -> str:
+		self.resolve_paths()
+		return self.output_dir + "/" + self.out_file
+
+	def input_path(self, file_name: str) -> str:
+		return self.input_dir + "/" + file_name
+
+	def patch_path(self) -> str:
+		return os.path.splitext(self.output_path())[0] + "." + self.patch_format.lower()
+
+	def previous_rom_path(self) -> str:
+		return self.output_path() + ".prev"
+
+	def save(self) -> None:
+		"""
+		Writes the ROM. With `!PATCH`, first writes a patch to it from the previous build, if there was one; with
+		`!PATCH ... ONLY`, the patch is written instead, and the ROM only if there wasn't one yet. The ROM then stays
+		the first build, so the previous one is kept next to it, with `.prev` added to its name, to patch from.
+		"""
+		previous_path = self.output_path()
+		if self.patch_only and os.path.exists(self.previous_rom_path()):
+			previous_path = self.previous_rom_path()
+		if self.patch_format != "" and os.path.exists(self.output_path()):
+			rom = self.rom_bytes()
+			iron_patch.write_patch(previous_path, rom, self.patch_path(), self.patch_format)
+			with atomic_output(self.previous_rom_path() if self.patch_only else self.output_path()) as out_file:
+				write_all(out_file, rom)
+			return
+		if os.path.exists(self.previous_rom_path()):
+			os.remove(self.previous_rom_path())  # Left from builds of a ROM that has since been deleted
+		with atomic_output(self.output_path()) as out_file:
+			write_all(out_file, self.header())
 			if self.trainer != "":
-				with open("input/" + self.trainer, mode="rb") as trainer_file:
-					out_file.write(trainer_file.read())
-			out_file.write(self.prg)
-			with open("input/" + self.chr_file, mode="rb") as chr_file:
-				out_file.write(chr_file.read())
+				copy_file_into(out_file, self.input_path(self.trainer))
+			for prg_chunk in self.prg_image.chunks():
+				write_all(out_file, prg_chunk)
+			if iron_chr.is_image(self.chr_file):
+				write_all(out_file, self.chr_bytes())
+			else:
+				copy_file_into(out_file, self.input_path(self.chr_file))
 			for misc_rom in self.misc_roms:
-				with open("input/" + misc_rom, mode="rb") as misc_file:
-					out_file.write(misc_file.read())
+				copy_file_into(out_file, self.input_path(misc_rom))
+
+	def rom_bytes(self) -> bytes:
+		"""
+		Returns the same ROM that save writes, built in memory instead.
+		"""
+		self.resolve_paths()
+		parts = [self.header()]
+		if self.trainer != "":
+			parts.append(_read_file(self.input_path(self.trainer), self.files))
+		parts.extend(self.prg_image.chunks())
+		parts.append(self.chr_bytes())
+		parts.extend(_read_file(self.input_path(misc_rom), self.files) for misc_rom in self.misc_roms)
+		return b"".join(parts)
+
+	def chr_bytes(self) -> bytes:
+		"""
+		Returns the CHR-ROM, converting it first if the CHR file is an image. Converted images are cached in the output
+		directory by content, so they're only converted again when they change.
+		"""
+		self.resolve_paths()
+		if not iron_chr.is_image(self.chr_file):
+			return _read_file(self.input_path(self.chr_file), self.files)
+		if len(self.chr_size) == 1:
+			chr_size = self.chr_size[0] << 13
+		else:
+			chr_size = self.chr_size[0] << self.chr_size[1]
+		if self.files is not None:
+			return iron_chr.convert_image(
+				_read_file(self.input_path(self.chr_file), self.files), chr_size, self.chr_dedupe, self.chr_file)
+		return iron_chr.image_to_chr(
+			self.input_path(self.chr_file), chr_size, self.chr_dedupe, os.path.join(self.output_dir, "chr_cache"))
+
+	def input_files(self) -> list[str]:
+		"""
+		Returns the paths of the input files that go into the ROM alongside the PRG.
+		"""
+		self.resolve_paths()
+		file_names = ([self.trainer] if self.trainer != "" else []) + [self.chr_file] + self.misc_roms
+		return [self.input_path(file_name) for file_name in file_names]
+
+	def find_chr_file(self) -> str:
+		if self.files is not None:
+			for path in self.files:
+				file_name = os.path.basename(path)
+				if file_name.endswith(".chr") and os.path.normpath(self.input_path(file_name)) == path:
+					return file_name
+			return ""
+		with os.scandir(self.input_dir) as entries:
+			for entry in entries:
+				if entry.name.endswith(".chr"):
+					return entry.name
+		return ""
 
 	@staticmethod
 	def arg_count_validate(args: list[str], min_val: int, max_val: Union[int, None] = None) -> None:
@@ -0,0 +1,150 @@
+"""
+Batch assembly: builds many projects in parallel in a pool of reused worker processes, and reports which succeeded.
+Run with `python iron_batch.py <manifest.json | project dir | source file>... [-j N] [--report report.json]`.
+
+A manifest is a JSON list. Each entry is either a path (a project directory holding input/ and output/, or a source
+file inside an input directory) or an object with any of "name", "project", "source", "input_dir" and "output_dir".
+Relative paths in a manifest are relative to the manifest itself.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Union
+
+from iron_assembler import Assembler, find_source_file
+
+
+class BatchJob:
+	def __init__(self, name: str, source: str, input_dir: str, output_dir: str) -> None:
+		self.name = name
+		self.source = source  # Empty to pick the first .asm/.s file in input_dir
+		self.input_dir = input_dir
+		self.output_dir = output_dir
+
+	@classmethod
+	def from_path(cls, path: str) -> "BatchJob":
+		if os.path.isdir(path):
+			return cls(os.path.basename(os.path.normpath(path)), "", os.path.join(path, "input"),
+					   os.path.join(path, "output"))
+		input_dir = os.path.dirname(path) or "."
+		return cls(os.path.basename(path), path, input_dir, _sibling_output_dir(input_dir))
+
+	@classmethod
+	def from_entry(cls, entry: Union[str, dict], base_dir: str) -> "BatchJob":
+		if isinstance(entry, str):
+			return cls.from_path(os.path.join(base_dir, entry))
+		if not isinstance(entry, dict):
+			raise ValueError(f"Invalid manifest entry {entry!r}; expected a path or an object.")
+		unknown_keys = set(entry) - {"name", "project", "source", "input_dir", "output_dir"}
+		if unknown_keys:
+			raise ValueError(f"Unknown key(s) {', '.join(sorted(unknown_keys))} in manifest entry {entry!r}.")
+		if "project" in entry:
+			job = cls.from_path(os.path.join(base_dir, entry["project"]))
+		elif "source" in entry:
+			job = cls.from_path(os.path.join(base_dir, entry["source"]))
+		elif "input_dir" in entry:
+			input_dir = os.path.join(base_dir, entry["input_dir"])
+			job = cls(os.path.basename(os.path.normpath(input_dir)), "", input_dir, _sibling_output_dir(input_dir))
+		else:
+			raise ValueError(f"Manifest entry {entry!r} needs a project, source or input_dir.")
+		if "source" in entry:
+			job.source = os.path.join(base_dir, entry["source"])
+		if "input_dir" in entry:
+			job.input_dir = os.path.join(base_dir, entry["input_dir"])
+		if "output_dir" in entry:
+			job.output_dir = os.path.join(base_dir, entry["output_dir"])
+		job.name = entry.get("name", job.name)
+		return job
+
+
+def _sibling_output_dir(input_dir: str) -> str:
+	return os.path.join(os.path.dirname(os.path.abspath(input_dir)), "output")
+
+
+class JobResult:
+	def __init__(self, name: str, ok: bool, seconds: float, output_path: str = "", error: str = "") -> None:
+		self.name = name
+		self.ok = ok
+		self.seconds = seconds
+		self.output_path = output_path
+		self.error = error
+
+	def to_dict(self) -> dict:
+		return {
+			"name": self.name, "ok": self.ok, "seconds": round(self.seconds, 4), "output": self.output_path,
+			"error": self.error
+		}
+
+
+def run_job(job: BatchJob) -> JobResult:
+	"""
+	Assembles one job. Errors are caught and reported rather than raised, so one broken project can't stop the batch.
+	"""
+	start = time.perf_counter()
+	try:
+		source = job.source or find_source_file(job.input_dir)
+		os.makedirs(job.output_dir, exist_ok=True)
+		assembler = Assembler(source, job.input_dir, job.output_dir, encode_workers=1)  # Jobs already run in parallel
+		assembler.assemble()
+		return JobResult(job.name, True, time.perf_counter() - start, assembler.virtual_cart.output_path())
+	except Exception as error:
+		return JobResult(job.name, False, time.perf_counter() - start, error=f"{type(error).__name__}: {error}")
+
+
+def load_jobs(paths: list[str]) -> list[BatchJob]:
+	jobs = []
+	for path in paths:
+		if path.endswith(".json"):
+			with open(path) as manifest_file:
+				manifest = json.load(manifest_file)
+			if not isinstance(manifest, list):
+				raise ValueError(f"Manifest {path} should contain a JSON list of jobs.")
+			base_dir = os.path.dirname(path)
+			jobs.extend(BatchJob.from_entry(entry, base_dir) for entry in manifest)
+		else:
+			jobs.append(BatchJob.from_path(path))
+	return jobs
+
+
+def run_batch(jobs: list[BatchJob], workers: Union[int, None] = None) -> list[JobResult]:
+	"""
+	Assembles every job, in parallel unless only one worker is asked for. Results come back in job order.
+	"""
+	if workers == 1 or len(jobs) <= 1:
+		return [run_job(job) for job in jobs]
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		return list(executor.map(run_job, jobs))
+
+
+def print_report(results: list[JobResult], wall_time: float) -> None:
+	name_width = max([len(result.name) for result in results] + [4])
+	for result in results:
+		status = "ok" if result.ok else "FAILED"
+		detail = result.output_path if result.ok else result.error
+		print(f"{result.name:<{name_width}}  {status:<6}  {result.seconds:>7.2f} s  {detail}")
+	failed = sum(not result.ok for result in results)
+	print(f"{len(results) - failed} succeeded, {failed} failed, in {wall_time:.2f} s.")
+
+
+def main() -> None:
+	arg_parser = argparse.ArgumentParser(description="Assemble many projects in parallel")
+	arg_parser.add_argument("paths", nargs="+", help="JSON manifests, project directories or source files")
+	arg_parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes; defaults to CPU count")
+	arg_parser.add_argument("--report", help="also write the results to this JSON file")
+	args = arg_parser.parse_args()
+
+	start = time.perf_counter()
+	results = run_batch(load_jobs(args.paths), args.jobs)
+	print_report(results, time.perf_counter() - start)
+	if args.report:
+		with open(args.report, "w") as report_file:
+			json.dump([result.to_dict() for result in results], report_file, indent=2)
+	if not all(result.ok for result in results):
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
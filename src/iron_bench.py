@@ -0,0 +1,661 @@
+"""
+Throughput benchmarks for the assembler's hot paths.
+Run with e.g. `python iron_bench.py lexer --lines 200000`, `python iron_bench.py encode --workers 1 2 4` for the
+parallel encoder, or `python iron_bench.py suite --json results.json` for the per-stage suite, whose JSON output can be
+checked against an earlier run with `--compare`.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import iron_assembler
+import iron_link
+import iron_parser
+import iron_token
+import iron_watch
+from typing import Union
+
+
+def generate_source(line_count: int, seed: int = 65) -> str:
+	"""
+	Builds a deterministic, assemblable source made mostly of data tables, with some code, labels, anonymous loops and
+	comments mixed in. The PRG size is chosen to fit whatever was generated.
+	"""
+	rng = random.Random(seed)
+	opcodes = [
+		("LDA #$44", 2), ("STA $0200,X", 3), ("INX", 1), ("lda $10  ; load", 2), ("JMP (VEC)", 3), ("ASL A", 1),
+		("RTS", 1), ("\tldy #<VEC", 2)
+	]
+	lines = ["VEC = $0010"]
+	prg_bytes = 0
+	while len(lines) < line_count:
+		roll = rng.random()
+		if roll < 0.6:
+			values = " ".join(f"${rng.randrange(256):02X}" for _ in range(16))
+			lines.append(f"    .BYTE {values}")
+			prg_bytes += 16
+		elif roll < 0.65:
+			lines.append(f"table_{len(lines)}: .WORD table_{len(lines)} $1234")
+			prg_bytes += 4
+		elif roll < 0.67:
+			lines.extend([":", "    DEX", "\tbne :-"])
+			prg_bytes += 3
+		elif roll < 0.7:
+			lines.append("; " + "comment " * rng.randrange(1, 6))
+		else:
+			opcode, size = rng.choice(opcodes)
+			lines.append("    " + opcode)
+			prg_bytes += size
+	lines.insert(0, f"!PRG_SIZE {prg_bytes // 0x4000 + 1}")
+	return "\n".join(lines) + "\n"
+
+
+def legacy_lex(file_path: str) -> list[iron_token.Token]:
+	"""
+	The original two-stage front end (whole-file preprocess followed by the Tokenizer), kept as a reference point.
+	"""
+	with open(file_path) as infile:
+		file_content = infile.read()
+	file_content = re.sub(pattern=r":([^+-])", repl=r":\g<1>\n", string=file_content)
+	out_lines = []
+	for line in file_content.split("\n"):
+		processed_line = line.upper().split(";")[0].strip()
+		if processed_line == "":
+			continue
+		processed_line = re.sub(r"[ \t]+", " ", processed_line)
+		out_lines.append(processed_line)
+	return iron_token.Tokenizer(out_lines).tokens
+
+
+def legacy_get_relative(anon_labels: list[iron_parser.Label], current_pos: int, label_name: str) -> bytes:
+	"""
+	The original linear-scan anonymous label lookup, kept as a reference point.
+	"""
+	anon_offset = label_name.count("+") - label_name.count("-")
+	if anon_offset > 0:
+		anon_offset -= 1
+	current_anon_region = 0
+	while current_pos > anon_labels[current_anon_region].short_addr:
+		current_anon_region += 1
+		if current_anon_region >= len(anon_labels):
+			break
+	target_label = anon_labels[current_anon_region + anon_offset]
+	return (target_label.short_addr - current_pos).to_bytes(length=1, signed=True)
+
+
+def legacy_save(cart: iron_assembler.VirtualCartridge) -> None:
+	"""
+	The original save step, which reads every input file fully into memory before writing it, kept as a reference point.
+	"""
+	with open("output/" + cart.out_file, mode="wb") as out_file:
+		out_file.write(cart.header())
+		if cart.trainer != "":
+			with open("input/" + cart.trainer, mode="rb") as trainer_file:
+				out_file.write(trainer_file.read())
+		out_file.write(cart.prg)
+		with open("input/" + cart.chr_file, mode="rb") as chr_file:
+			out_file.write(chr_file.read())
+		for misc_rom in cart.misc_roms:
+			with open("input/" + misc_rom, mode="rb") as misc_file:
+				out_file.write(misc_file.read())
+
+
+def _peak_memory(func) -> int:
+	tracemalloc.start()
+	try:
+		func()
+		return tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+
+
+def _best_time(func, repeat: int) -> float:
+	best = float("inf")
+	for _ in range(repeat):
+		start = time.perf_counter()
+		func()
+		best = min(best, time.perf_counter() - start)
+	return best
+
+
+def bench_lexer(line_count: int, repeat: int) -> None:
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		source_path = os.path.join(tmp_dir, "bench.asm")
+		with open(source_path, "w") as outfile:
+			outfile.write(generate_source(line_count))
+
+		legacy_tokens = [token.content for token in legacy_lex(source_path)]
+		new_tokens = [token.content for token in iron_token.lex_file(source_path)]
+		if legacy_tokens != new_tokens:
+			raise ValueError("Lexer output differs from the legacy front end!")
+
+		legacy_time = _best_time(lambda: legacy_lex(source_path), repeat)
+		new_time = _best_time(lambda: list(iron_token.lex_file(source_path)), repeat)
+	print(f"{'path':<10}{'seconds':>10}{'lines/sec':>14}")
+	print(f"{'legacy':<10}{legacy_time:>10.3f}{line_count / legacy_time:>14,.0f}")
+	print(f"{'lexer':<10}{new_time:>10.3f}{line_count / new_time:>14,.0f}")
+	print(f"speedup: {legacy_time / new_time:.2f}x")
+
+
+def bench_anon_labels(sizes: list[int], lookups: int, legacy_max: int) -> None:
+	rng = random.Random(65)
+	print(f"{'labels':>10}{'bisect us/ref':>16}{'legacy us/ref':>16}")
+	for size in sizes:
+		sym_lib = iron_parser.Symbol_Library()
+		for i in range(size):
+			sym_lib.add_label(":", i * 4)
+		ref_names = [":-", ":--", ":---", ":+", ":++", ":+++"]
+		refs = [(rng.randrange(8, size * 4 - 8), rng.choice(ref_names)) for _ in range(lookups)]
+
+		def run_new() -> None:
+			for pos, name in refs:
+				sym_lib.get_relative(pos, name)
+		new_time = _best_time(run_new, 3) / lookups * 1e6
+
+		if size <= legacy_max:
+			for pos, name in refs:
+				if legacy_get_relative(sym_lib.anon_labels, pos, name) != sym_lib.get_relative(pos, name):
+					raise ValueError(f"Lookup mismatch for {name} at {pos}")
+
+			def run_legacy() -> None:
+				for pos, name in refs:
+					legacy_get_relative(sym_lib.anon_labels, pos, name)
+			legacy_col = f"{_best_time(run_legacy, 1) / lookups * 1e6:>16.2f}"
+		else:
+			legacy_col = f"{'skipped':>16}"
+		print(f"{size:>10,}{new_time:>16.2f}{legacy_col}")
+
+
+def bench_save(sizes_mib: list[int], repeat: int) -> None:
+	"""
+	Times VirtualCartridge.save on images split 3:1 between PRG-ROM and CHR-ROM, plus a small misc ROM, and
+	reports the Python heap peak of each writer.
+	"""
+	start_dir = os.getcwd()
+	print(f"{'image MiB':>10}{'legacy s':>10}{'stream s':>10}{'MiB/s':>10}{'legacy peak':>14}{'stream peak':>14}")
+	try:
+		for size_mib in sizes_mib:
+			with tempfile.TemporaryDirectory() as tmp_dir:
+				os.chdir(tmp_dir)
+				os.mkdir("input")
+				os.mkdir("output")
+				chr_size = size_mib << 18
+				prg_size = chr_size * 3
+				with open("input/bench.chr", "wb") as chr_file:
+					chr_file.write(random.Random(size_mib).randbytes(chr_size))
+				with open("input/MISC.BIN", "wb") as misc_file:
+					misc_file.write(bytes(range(256)) * 16)
+				cart = iron_assembler.VirtualCartridge("input/bench.asm")
+				cart.config_cart(
+					[f"!PRG_SIZE {prg_size >> 14}", f"!CHR_SIZE {chr_size >> 13}", "!MISC_ROMS MISC.BIN"])
+				cart.initialize_prg()
+				cart.prg_image.write(random.Random(-size_mib).randbytes(prg_size // 2))
+				cart.save()
+				with open("output/" + cart.out_file, "rb") as out_file:
+					streamed = out_file.read()
+				legacy_save(cart)
+				with open("output/" + cart.out_file, "rb") as out_file:
+					if out_file.read() != streamed:
+						raise ValueError(f"Streamed output differs from the legacy writer at {size_mib} MiB!")
+
+				del streamed
+				legacy_time = _best_time(lambda: legacy_save(cart), repeat)
+				stream_time = _best_time(cart.save, repeat)
+				legacy_peak = _peak_memory(lambda: legacy_save(cart))
+				stream_peak = _peak_memory(cart.save)
+				os.chdir(start_dir)
+			print(f"{size_mib:>10}{legacy_time:>10.3f}{stream_time:>10.3f}{size_mib / stream_time:>10.0f}"
+				  f"{legacy_peak / 2**20:>11.1f} MiB{stream_peak / 2**20:>11.1f} MiB")
+	finally:
+		os.chdir(start_dir)
+
+
+def bench_watch(line_count: int, edits: int) -> None:
+	"""
+	Times watch-mode rebuilds after single-line edits to a generated project, checking each patched ROM against a
+	from-scratch build.
+	"""
+	rng = random.Random(65)
+	start_dir = os.getcwd()
+	try:
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			os.chdir(tmp_dir)
+			os.mkdir("input")
+			os.mkdir("output")
+			with open("input/BENCH.CHR", "wb") as chr_file:
+				chr_file.write(bytes(0x2000))
+			source_lines = generate_source(line_count).splitlines(keepends=True)
+			source_lines.insert(1, "!CHR_FILE BENCH.CHR\n")
+			with open("input/bench.asm", "w") as source_file:
+				source_file.writelines(source_lines)
+			watcher = iron_watch.Watcher("input/bench.asm")
+			full_time = _best_time(watcher.rebuild, 1)
+			print(f"initial build of {line_count:,} lines: {full_time * 1000:.0f} ms")
+
+			edit_kinds = [
+				("same-size opcode edit", "LDA #$44", lambda: f"LDA #${rng.randrange(256):02X}"),
+				("same-size data edit", ".BYTE ", lambda: ".BYTE " + " ".join(["$5A"] * 16)),
+				("comment-only edit", "LDA #$44", lambda: f"LDA #$44 ; note {rng.random()}"),
+				("size-changing edit", "INX", lambda: "INX\n    INY"),
+			]
+			print(f"{'edit':<24}{'median ms':>10}{'max ms':>10}  result")
+			for kind, marker, make_line in edit_kinds:
+				candidates = [i for i, line in enumerate(source_lines) if marker in line]
+				times = []
+				message = ""
+				for _ in range(edits if kind != "size-changing edit" else 1):
+					line_index = rng.choice(candidates)
+					indent = source_lines[line_index][:len(source_lines[line_index]) - len(source_lines[line_index].lstrip())]
+					source_lines[line_index] = indent + make_line() + "\n"
+					with open("input/bench.asm", "w") as source_file:
+						source_file.writelines(source_lines)
+					start = time.perf_counter()
+					message = watcher.rebuild()
+					times.append(time.perf_counter() - start)
+				with open(watcher.assembler.virtual_cart.output_path(), "rb") as out_file:
+					patched = out_file.read()
+				iron_assembler.Assembler("input/bench.asm").assemble()
+				with open(watcher.assembler.virtual_cart.output_path(), "rb") as out_file:
+					if out_file.read() != patched:
+						raise ValueError(f"Watch-mode output differs from a full build after a {kind}!")
+				times.sort()
+				print(f"{kind:<24}{times[len(times) // 2] * 1000:>10.2f}{times[-1] * 1000:>10.2f}  {message}")
+	finally:
+		os.chdir(start_dir)
+
+
+_CODE_OPCODES = [
+	("LDA #$44", 2), ("LDA ZP_PTR", 2), ("STA $0200,X", 3), ("LDA ($10),Y", 3), ("LDA ($10,X)", 3), ("INX", 1),
+	("JMP (VEC)", 3), ("ADC #<PPUCTRL", 2), ("AND #>PPUCTRL", 2), ("CMP $0300,Y", 3), ("ASL A", 1), ("DEY", 1),
+	("BIT $2002", 3), ("JSR $C000", 3), ("STX ZP_PTR,Y", 2), ("ROL $0400", 3), ("RTS", 1)
+]
+
+
+def _code_lines(rng: random.Random, line_count: int) -> tuple[list[str], int]:
+	lines = []
+	prg_bytes = 0
+	while len(lines) < line_count:
+		if rng.random() < 0.02:
+			lines.extend([f"loop_{len(lines)}:", "    DEX", f"    BNE loop_{len(lines)}"])
+			prg_bytes += 3
+		else:
+			opcode, size = rng.choice(_CODE_OPCODES)
+			lines.append("    " + opcode)
+			prg_bytes += size
+	return lines, prg_bytes
+
+
+def _table_lines(rng: random.Random, line_count: int) -> tuple[list[str], int]:
+	lines = []
+	prg_bytes = 0
+	while len(lines) < line_count:
+		if rng.random() < 0.75:
+			lines.append("    .BYTE " + " ".join(f"${rng.randrange(256):02X}" for _ in range(16)))
+			prg_bytes += 16
+		else:
+			words = [rng.choice(["VEC", "PPUCTRL", f"${rng.randrange(0x10000):04X}"]) for _ in range(8)]
+			lines.append("    .WORD " + " ".join(words))
+			prg_bytes += 16
+	return lines, prg_bytes
+
+
+def _label_lines(rng: random.Random, line_count: int) -> tuple[list[str], int]:
+	# Opcodes can only reference labels that are already declared; .WORD can reference any label
+	lines = ["label_0:"]
+	label_count = 1
+	prg_bytes = 0
+	while len(lines) < line_count:
+		roll = rng.random()
+		if roll < 0.4:
+			lines.append(f"label_{label_count}:")
+			label_count += 1
+		elif roll < 0.6:
+			lines.append(f"    JMP label_{rng.randrange(label_count)}")
+			prg_bytes += 3
+		elif roll < 0.8:
+			lines.append(f"    LDA label_{rng.randrange(label_count)},X")
+			prg_bytes += 3
+		else:
+			lines.append(f"    .WORD label_{rng.randrange(label_count)} label_{label_count - 1}")
+			prg_bytes += 4
+	return lines, prg_bytes
+
+
+def _anon_lines(rng: random.Random, line_count: int) -> tuple[list[str], int]:
+	block = [":", "    DEX", "    BNE :-", "    BEQ :+", "    INY", ":", "    BPL :--"]
+	lines = []
+	while len(lines) < line_count:
+		lines.extend(block)
+	lines.extend([":", "    RTS"])
+	return lines, 8 * (len(lines) // len(block)) + 1
+
+
+def _pad_lines(rng: random.Random, line_count: int) -> tuple[list[str], int]:
+	# .PAD targets are 16-bit numbers, so gaps stop once the cursor gets near the top of that range
+	lines = []
+	prg_bytes = 0
+	while len(lines) < line_count:
+		opcode, size = rng.choice(_CODE_OPCODES)
+		lines.append("    " + opcode)
+		prg_bytes += size
+		if rng.random() < 0.05 and prg_bytes < 0xF000:
+			prg_bytes += rng.randrange(1, 256)
+			lines.append(f"    .PAD ${prg_bytes:04X}")
+	return lines, prg_bytes
+
+
+def _large_prg_lines(rng: random.Random, line_count: int) -> tuple[list[str], int]:
+	lines, prg_bytes = _code_lines(rng, line_count)
+	return lines, max(prg_bytes, 0x100 << 14)  # At least 4 MiB of PRG-ROM, mostly fill
+
+
+BENCH_SCENARIOS = {
+	"code": _code_lines, "tables": _table_lines, "labels": _label_lines, "anon": _anon_lines, "pad": _pad_lines,
+	"large-prg": _large_prg_lines
+}
+SUITE_STAGES = (
+	"preprocess", "tokenizer", "lex", "configure", "parse_symbols", "parse_labels", "parse_opcodes_and_raws", "save"
+)
+_ASSEMBLE_STAGES = ("lex", "configure", "parse_symbols", "parse_labels", "parse_opcodes_and_raws", "save")
+
+
+def generate_scenario(scenario: str, line_count: int, seed: int = 65) -> str:
+	"""
+	Builds a deterministic, assemblable source of about line_count lines that stresses one part of the assembler. The
+	PRG size is chosen to fit whatever was generated.
+	"""
+	lines, prg_bytes = BENCH_SCENARIOS[scenario](random.Random(seed), line_count)
+	header = [f"!PRG_SIZE {prg_bytes // 0x4000 + 1}", "VEC = $0010", "ZP_PTR = $10", "PPUCTRL = $2000"]
+	return "\n".join(header + lines) + "\n"
+
+
+def _run_stages(source_path: str, timings: dict[str, float], peaks: Union[dict[str, int], None] = None) -> None:
+	"""
+	Runs one build stage by stage, keeping the fastest time seen for each stage in timings. If peaks is given, the
+	build runs under tracemalloc and each stage's heap peak is recorded instead.
+	"""
+	def stage(name: str, func):
+		if peaks is not None:
+			tracemalloc.reset_peak()
+		start = time.perf_counter()
+		result = func()
+		elapsed = time.perf_counter() - start
+		if peaks is not None:
+			peaks[name] = tracemalloc.get_traced_memory()[1]
+		else:
+			timings[name] = min(timings.get(name, float("inf")), elapsed)
+		return result
+
+	assembler = iron_assembler.Assembler(source_path)
+	lines = stage("preprocess", assembler.preprocess_lines)
+	stage("tokenizer", lambda: iron_token.Tokenizer(lines))
+	del lines
+	cart_config_strings, tokens = stage("lex", assembler.lex_tokens)
+	cart = iron_assembler.VirtualCartridge(source_path)
+
+	def configure() -> None:
+		cart.config_cart(cart_config_strings)
+		cart.initialize_prg()
+
+	stage("configure", configure)
+	parser = iron_parser.Parser(tokens, cart.prg_image, parse=False)
+	stage("parse_symbols", parser.parse_symbols)
+	stage("parse_labels", parser.parse_labels)
+	stage("parse_opcodes_and_raws", parser.parse_opcodes_and_raws)
+	stage("save", cart.save)
+
+
+def bench_suite(scenarios: list[str], scales: list[int], repeat: int) -> dict:
+	"""
+	Times each stage of a build of every scenario at every scale, and reports throughput and heap peaks. There is no
+	separate write_all_bytes stage to time, since parse_opcodes_and_raws encodes straight into the PRG image.
+	"""
+	results = []
+	start_dir = os.getcwd()
+	try:
+		for scenario in scenarios:
+			for line_count in scales:
+				with tempfile.TemporaryDirectory() as tmp_dir:
+					os.chdir(tmp_dir)
+					os.mkdir("input")
+					os.mkdir("output")
+					with open("input/bench.chr", "wb") as chr_file:
+						chr_file.write(bytes(0x2000))
+					source = generate_scenario(scenario, line_count)
+					with open("input/bench.asm", "w") as source_file:
+						source_file.write(source)
+
+					timings: dict[str, float] = {}
+					for _ in range(repeat):
+						_run_stages("input/bench.asm", timings)
+					peaks: dict[str, int] = {}
+					tracemalloc.start()
+					try:
+						_run_stages("input/bench.asm", timings, peaks)
+					finally:
+						tracemalloc.stop()
+					assemble_time = _best_time(iron_assembler.Assembler("input/bench.asm").assemble, repeat)
+					rom_size = os.path.getsize("output/bench.nes")
+					os.chdir(start_dir)
+
+				source_lines = source.count("\n")
+				stages = {
+					name: {
+						"seconds": round(timings[name], 6), "lines_per_sec": round(source_lines / timings[name]),
+						"peak_bytes": peaks[name]
+					} for name in SUITE_STAGES
+				}
+				results.append({
+					"scenario": scenario, "lines": source_lines, "source_bytes": len(source), "rom_bytes": rom_size,
+					"stages": stages, "assemble_seconds": round(assemble_time, 6),
+					"assemble_lines_per_sec": round(source_lines / assemble_time),
+					"rom_bytes_per_sec": round(rom_size / assemble_time), "peak_bytes": max(peaks.values())
+				})
+	finally:
+		os.chdir(start_dir)
+	return {
+		"benchmark": "suite", "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "python": platform.python_version(),
+		"implementation": platform.python_implementation(), "machine": platform.machine(), "repeat": repeat,
+		"results": results
+	}
+
+
+def bench_encode(scenario: str, line_count: int, worker_counts: list[int], repeat: int) -> None:
+	"""
+	Times the second pass (parse_opcodes_and_raws) over one layout with each number of worker processes, checking that
+	every run produces the same image as the serial encoder.
+	"""
+	start_dir = os.getcwd()
+	try:
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			os.chdir(tmp_dir)
+			os.mkdir("input")
+			with open("input/bench.asm", "w") as source_file:
+				source_file.write(generate_scenario(scenario, line_count))
+			cart_config_strings, tokens = iron_assembler.Assembler("input/bench.asm").lex_tokens()
+			cart = iron_assembler.VirtualCartridge("input/bench.asm")
+			cart.config_cart(cart_config_strings)
+			cart.initialize_prg()
+			parser = iron_parser.Parser(tokens, cart.prg_image, parse=False)
+			parser.parse_symbols()
+			parser.parse_labels()
+
+			def encode(workers: int) -> tuple[bytes, list[tuple[int, int]]]:
+				cart.initialize_prg()
+				parser.prg_image = cart.prg_image
+				parser.workers = workers
+				parser.parse_opcodes_and_raws()
+				return bytes(cart.prg_image.buffer), cart.prg_image.all_fill_extents()
+
+			serial_image = encode(1)
+			print(f"{scenario} x {line_count:,} lines: {len(parser.token_list):,} tokens, {os.cpu_count()} CPU(s)")
+			print(f"{'workers':<10}{'chunks':>8}{'seconds':>10}{'speedup':>10}")
+			serial_time = None
+			for workers in worker_counts:
+				if encode(workers) != serial_image:
+					raise ValueError(f"Encoding with {workers} worker(s) differs from the serial encoder!")
+				seconds = _best_time(lambda: encode(workers), repeat)
+				serial_time = serial_time or seconds
+				chunks = len(parser.chunk_ranges(workers)) if workers > 1 else 1
+				print(f"{workers:<10}{chunks:>8}{seconds:>10.3f}{serial_time / seconds:>9.2f}x")
+	finally:
+		os.chdir(start_dir)
+
+
+def bench_link(module_count: int, line_count: int) -> None:
+	"""
+	Times a modular build from scratch, a rebuild with nothing changed, and a rebuild after editing one module, against
+	assembling the same code as one source file.
+	"""
+	start_dir = os.getcwd()
+	rng = random.Random(65)
+	try:
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			os.chdir(tmp_dir)
+			os.mkdir("input")
+			os.mkdir("output")
+			with open("input/bench.chr", "wb") as chr_file:
+				chr_file.write(bytes(0x2000))
+			module_lines = []
+			prg_bytes = 0
+			for index in range(module_count):
+				lines, size = _code_lines(rng, line_count)
+				lines = [line.replace("loop_", f"m{index}_loop_") for line in lines]  # Labels are global across modules
+				module_lines.append([f"module_{index}:"] + lines + [f"    JMP module_{max(index - 1, 0)}"])
+				prg_bytes += size + 3
+			header = [f"!PRG_SIZE {prg_bytes // 0x4000 + 1}", "VEC = $0010", "ZP_PTR = $10", "PPUCTRL = $2000"]
+			modules = []
+			for index, lines in enumerate(module_lines):
+				modules.append(f"input/module_{index:03}.asm")
+				with open(modules[-1], "w") as module_file:
+					module_file.write("\n".join(header + lines) + "\n")
+
+			start = time.perf_counter()
+			iron_link.build(modules)
+			cold_time = time.perf_counter() - start
+			start = time.perf_counter()
+			compiled = iron_link.build(modules)[1]
+			link_time = time.perf_counter() - start
+			with open(modules[module_count // 2], "a") as module_file:
+				module_file.write("    NOP\n")
+			start = time.perf_counter()
+			iron_link.build(modules)
+			edit_time = time.perf_counter() - start
+
+			with open("input/single.asm", "w") as single_file:
+				single_file.write("\n".join(header + [line for lines in module_lines for line in lines]) + "\n")
+			single_time = _best_time(iron_assembler.Assembler("input/single.asm").assemble, 1)
+	finally:
+		os.chdir(start_dir)
+	print(f"{module_count} modules x {line_count:,} lines")
+	print(f"{'build':<28}{'seconds':>10}")
+	print(f"{'one source file':<28}{single_time:>10.3f}")
+	print(f"{'modules, from scratch':<28}{cold_time:>10.3f}")
+	print(f"{'modules, unchanged':<28}{link_time:>10.3f}  ({len(compiled)} compiled)")
+	print(f"{'modules, one edited':<28}{edit_time:>10.3f}")
+
+
+def print_suite(report: dict) -> None:
+	for result in report["results"]:
+		print(f"{result['scenario']} x {result['lines']:,} lines: assembled in {result['assemble_seconds']:.3f} s "
+			  f"({result['assemble_lines_per_sec']:,} lines/s), peak heap {result['peak_bytes'] / 2**20:.1f} MiB")
+		for name, stage in result["stages"].items():
+			print(f"    {name:<24}{stage['seconds']:>10.4f} s{stage['lines_per_sec']:>14,} lines/s"
+				  f"{stage['peak_bytes'] / 2**20:>10.1f} MiB")
+
+
+def compare_suite(report: dict, baseline: dict, threshold: float) -> bool:
+	"""
+	Prints how each stage's time changed against a baseline report, and returns False if any got slower by more than
+	the threshold ratio.
+	"""
+	baseline_results = {(result["scenario"], result["lines"]): result for result in baseline["results"]}
+	ok = True
+	for result in report["results"]:
+		old_result = baseline_results.get((result["scenario"], result["lines"]))
+		if old_result is None:
+			continue
+		times = {name: stage["seconds"] for name, stage in result["stages"].items()}
+		times["assemble"] = result["assemble_seconds"]
+		old_times = {name: stage["seconds"] for name, stage in old_result["stages"].items()}
+		old_times["assemble"] = old_result["assemble_seconds"]
+		for name, seconds in times.items():
+			if name not in old_times or old_times[name] == 0:
+				continue
+			ratio = seconds / old_times[name]
+			flag = "  REGRESSION" if ratio > threshold else ""
+			ok = ok and ratio <= threshold
+			print(f"{result['scenario']:<10}{result['lines']:>10,}  {name:<24}{ratio:>7.2f}x{flag}")
+	return ok
+
+
+def main() -> None:
+	arg_parser = argparse.ArgumentParser(description="Iron-65 benchmarks")
+	subparsers = arg_parser.add_subparsers(dest="bench", required=True)
+	lexer_parser = subparsers.add_parser("lexer", help="source lexing throughput against the legacy front end")
+	lexer_parser.add_argument("--lines", type=int, default=200_000)
+	lexer_parser.add_argument("--repeat", type=int, default=3)
+	anon_parser = subparsers.add_parser("anon", help="anonymous label resolution at increasing label counts")
+	anon_parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+	anon_parser.add_argument("--lookups", type=int, default=2_000)
+	anon_parser.add_argument(
+		"--legacy-max", type=int, default=100_000, help="largest size to also time the linear scan at")
+	save_parser = subparsers.add_parser("save", help="ROM writing time against the legacy read-everything writer")
+	save_parser.add_argument("--sizes", type=int, nargs="+", default=[1, 4, 16, 64], help="image sizes in MiB")
+	save_parser.add_argument("--repeat", type=int, default=3)
+	watch_parser = subparsers.add_parser("watch", help="watch-mode rebuild time after one-line edits")
+	watch_parser.add_argument("--lines", type=int, default=100_000)
+	watch_parser.add_argument("--edits", type=int, default=20)
+	encode_parser = subparsers.add_parser("encode", help="second-pass encoding time with 1 to N worker processes")
+	encode_parser.add_argument("--scenario", choices=list(BENCH_SCENARIOS), default="code")
+	encode_parser.add_argument("--lines", type=int, default=200_000)
+	encode_parser.add_argument(
+		"--workers", type=int, nargs="+", default=list(range(1, (os.cpu_count() or 1) + 1)),
+		help="worker counts to time, starting with 1 for the serial baseline; defaults to 1 to the CPU count")
+	encode_parser.add_argument("--repeat", type=int, default=3)
+	link_parser = subparsers.add_parser("link", help="modular builds from scratch, unchanged and after one edit")
+	link_parser.add_argument("--modules", type=int, default=50)
+	link_parser.add_argument("--lines", type=int, default=2_000, help="source lines per module")
+	suite_parser = subparsers.add_parser("suite", help="per-stage build times, throughput and heap peaks")
+	suite_parser.add_argument("--scenarios", nargs="+", choices=list(BENCH_SCENARIOS), default=list(BENCH_SCENARIOS))
+	suite_parser.add_argument("--scales", type=int, nargs="+", default=[1_000, 10_000, 100_000], help="source lines")
+	suite_parser.add_argument("--repeat", type=int, default=3)
+	suite_parser.add_argument("--json", help="write the results to this JSON file")
+	suite_parser.add_argument("--compare", help="JSON results of an earlier run to compare stage times against")
+	suite_parser.add_argument(
+		"--threshold", type=float, default=1.1, help="slowdown ratio that counts as a regression in --compare")
+	args = arg_parser.parse_args()
+	if args.bench == "lexer":
+		bench_lexer(args.lines, args.repeat)
+	elif args.bench == "anon":
+		bench_anon_labels(args.sizes, args.lookups, args.legacy_max)
+	elif args.bench == "save":
+		bench_save(args.sizes, args.repeat)
+	elif args.bench == "watch":
+		bench_watch(args.lines, args.edits)
+	elif args.bench == "encode":
+		bench_encode(args.scenario, args.lines, args.workers, args.repeat)
+	elif args.bench == "link":
+		bench_link(args.modules, args.lines)
+	elif args.bench == "suite":
+		report = bench_suite(args.scenarios, args.scales, args.repeat)
+		print_suite(report)
+		if args.json:
+			with open(args.json, "w") as json_file:
+				json.dump(report, json_file, indent=2)
+		if args.compare:
+			with open(args.compare) as baseline_file:
+				baseline = json.load(baseline_file)
+			if not compare_suite(report, baseline, args.threshold):
+				sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
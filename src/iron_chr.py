@@ -0,0 +1,251 @@
+"""
+Converts indexed PNG and BMP images into CHR-ROM, for `!CHR_FILE` lines that name an image rather than a `.chr`.
+The image is cut into 8x8 tiles, left to right and then top to bottom, and each pixel's palette index, modulo 4, is
+packed into the tile's two bitplanes. Duplicate tiles can be dropped, which renumbers the ones after them.
+
+With NumPy installed, decoding, slicing and packing are done on whole arrays at once; without it, each tile row is
+packed as a single integer. Converted CHR is cached by a hash of the image and the conversion settings, in memory and
+in a directory next to the output, so unchanged art is only converted once.
+"""
+import hashlib
+import os
+import struct
+import zlib
+from typing import Union
+
+try:
+	import numpy
+except ImportError:  # Optional; only makes converting large images faster
+	numpy = None
+
+from iron_output import atomic_output
+
+IMAGE_EXTENSIONS = (".PNG", ".BMP")
+TILE_BYTES = 16
+_CACHE_VERSION = b"1"  # Change when converting the same image would give different bytes
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_PLANE_BITS = 0x0101010101010101
+_GATHER_BITS = 0x0102040810204080  # Multiplying by this moves the low bit of each byte into the top byte, in order
+_converted: dict[bytes, bytes] = {}  # Converted CHR by cache key, oldest first
+_CONVERTED_ENTRIES = 16
+
+
+def is_image(file_name: str) -> bool:
+	return file_name.upper().endswith(IMAGE_EXTENSIONS)
+
+
+def image_to_chr(image_path: str, chr_size: int, dedupe: bool = False, cache_dir: Union[str, None] = None) -> bytes:
+	"""
+	Returns chr_size bytes of CHR-ROM holding the tiles of an image, padded with blank tiles. Raises ValueError if the
+	image can't be read or the tiles don't fit.
+	"""
+	with open(image_path, mode="rb") as image_file:
+		content = image_file.read()
+	key = hashlib.blake2b(content, digest_size=16)
+	key.update(b"%s:%d:%d" % (_CACHE_VERSION, chr_size, dedupe))
+	digest = key.digest()
+	chr_data = _converted.get(digest)
+	if chr_data is not None:
+		return chr_data
+	cache_path = None if cache_dir is None else os.path.join(cache_dir, key.hexdigest() + ".chr")
+	if cache_path is not None and os.path.exists(cache_path):
+		with open(cache_path, mode="rb") as cache_file:
+			chr_data = cache_file.read()
+	else:
+		chr_data = convert_image(content, chr_size, dedupe, image_path)
+		if cache_path is not None:
+			os.makedirs(cache_dir, exist_ok=True)
+			with atomic_output(cache_path) as cache_file:
+				cache_file.write(chr_data)
+	while len(_converted) >= _CONVERTED_ENTRIES:
+		del _converted[next(iter(_converted))]
+	_converted[digest] = chr_data
+	return chr_data
+
+
+def convert_image(content: bytes, chr_size: int, dedupe: bool = False, name: str = "image") -> bytes:
+	"""
+	Converts the bytes of an image file, as image_to_chr does, but without caching anything.
+	"""
+	width, height, pixels = read_image(content, name)
+	tiles = pack_tiles(width, height, pixels)
+	if dedupe:
+		tiles = dedupe_tiles(tiles)
+	if len(tiles) > chr_size:
+		raise ValueError(f"{name} has {len(tiles) // TILE_BYTES} tiles, but CHR-ROM only holds "
+						 f"{chr_size // TILE_BYTES}")
+	return tiles + bytes(chr_size - len(tiles))
+
+
+def read_image(content: bytes, name: str = "image") -> tuple[int, int, bytes]:
+	"""
+	Decodes a PNG or BMP with 1, 2, 4 or 8 bits per pixel, palette or grayscale, into its width, height and one byte
+	per pixel, row by row.
+	"""
+	if content.startswith(_PNG_SIGNATURE):
+		return _read_png(content, name)
+	if content.startswith(b"BM"):
+		return _read_bmp(content, name)
+	raise ValueError(f"{name} isn't a PNG or BMP image")
+
+
+def _read_png(content: bytes, name: str) -> tuple[int, int, bytes]:
+	pos = len(_PNG_SIGNATURE)
+	header = None
+	compressed = []
+	while pos + 8 <= len(content):
+		length, chunk_type = struct.unpack_from(">I4s", content, pos)
+		data = content[pos + 8:pos + 8 + length]
+		pos += 12 + length
+		if chunk_type == b"IHDR":
+			header = struct.unpack(">IIBBBBB", data)
+		elif chunk_type == b"IDAT":
+			compressed.append(data)
+		elif chunk_type == b"IEND":
+			break
+	if header is None:
+		raise ValueError(f"{name} has no PNG header")
+	width, height, depth, color_type, _, _, interlace = header
+	if color_type not in (0, 3) or depth not in (1, 2, 4, 8):
+		raise ValueError(f"{name} must be a palette or grayscale PNG of at most 8 bits per pixel")
+	if interlace:
+		raise ValueError(f"{name} is an interlaced PNG, which isn't supported")
+	try:
+		raw = zlib.decompress(b"".join(compressed))
+	except zlib.error as error:
+		raise ValueError(f"{name} has corrupt PNG data: {error}") from None
+	row_bytes = (width * depth + 7) // 8
+	if len(raw) < height * (row_bytes + 1):
+		raise ValueError(f"{name} has less PNG data than its size needs")
+	rows = _unfilter(raw, height, row_bytes, name)
+	pixels = _unpack_pixels(rows, width, height, row_bytes, depth)
+	if color_type == 0 and depth > 2:
+		pixels = pixels.translate(bytes(value >> (depth - 2) for value in range(0x100)))  # Four shades of gray
+	return width, height, pixels
+
+
+def _unfilter(raw: bytes, height: int, row_bytes: int, name: str) -> bytes:
+	"""
+	Undoes PNG's per-row filters, for images of at most one byte per pixel.
+	"""
+	rows = bytearray(height * row_bytes)
+	previous = bytes(row_bytes)
+	for y in range(height):
+		start = y * (row_bytes + 1)
+		filter_type = raw[start]
+		row = raw[start + 1:start + 1 + row_bytes]
+		if filter_type == 0:
+			pass
+		elif filter_type == 2:
+			row = _add_rows(row, previous)
+		elif filter_type == 1:
+			row = _running_sum(row)
+		elif filter_type in (3, 4):
+			row = bytearray(row)
+			for x in range(row_bytes):
+				left = row[x - 1] if x else 0
+				up = previous[x]
+				if filter_type == 3:
+					row[x] = (row[x] + (left + up) // 2) & 0xFF
+				else:
+					up_left = previous[x - 1] if x else 0
+					estimate = left + up - up_left
+					left_distance, up_distance = abs(estimate - left), abs(estimate - up)
+					up_left_distance = abs(estimate - up_left)
+					if left_distance <= up_distance and left_distance <= up_left_distance:
+						predictor = left
+					elif up_distance <= up_left_distance:
+						predictor = up
+					else:
+						predictor = up_left
+					row[x] = (row[x] + predictor) & 0xFF
+		else:
+			raise ValueError(f"{name} has an unknown PNG filter {filter_type}")
+		rows[y * row_bytes:(y + 1) * row_bytes] = row
+		previous = rows[y * row_bytes:(y + 1) * row_bytes]
+	return bytes(rows)
+
+
+def _add_rows(row: bytes, previous: bytes) -> bytes:
+	if numpy is not None:
+		total = numpy.frombuffer(row, dtype=numpy.uint8) + numpy.frombuffer(previous, dtype=numpy.uint8)
+		return total.tobytes()
+	return bytes((value + above) & 0xFF for value, above in zip(row, previous))
+
+
+def _running_sum(row: bytes) -> bytes:
+	if numpy is not None:
+		return numpy.cumsum(numpy.frombuffer(row, dtype=numpy.uint8), dtype=numpy.uint8).tobytes()
+	out = bytearray(row)
+	for x in range(1, len(out)):
+		out[x] = (out[x] + out[x - 1]) & 0xFF
+	return bytes(out)
+
+
+def _read_bmp(content: bytes, name: str) -> tuple[int, int, bytes]:
+	if len(content) < 34:
+		raise ValueError(f"{name} is too short to be a BMP")
+	pixel_offset, = struct.unpack_from("<I", content, 10)
+	width, height, _, depth, compression = struct.unpack_from("<iiHHI", content, 18)
+	if depth not in (1, 4, 8) or compression != 0:
+		raise ValueError(f"{name} must be an uncompressed BMP with 1, 4 or 8 bits per pixel")
+	bottom_up = height > 0
+	height = abs(height)
+	row_bytes = (width * depth + 7) // 8
+	stride = (row_bytes + 3) & ~3  # Rows are padded to 4 bytes
+	if pixel_offset + stride * height > len(content):
+		raise ValueError(f"{name} has less pixel data than its size needs")
+	order = range(height - 1, -1, -1) if bottom_up else range(height)
+	rows = b"".join(content[pixel_offset + y * stride:pixel_offset + y * stride + row_bytes] for y in order)
+	return width, height, _unpack_pixels(rows, width, height, row_bytes, depth)
+
+
+def _unpack_pixels(rows: bytes, width: int, height: int, row_bytes: int, depth: int) -> bytes:
+	"""
+	Spreads packed rows, leftmost pixel in the high bits, out to a byte per pixel.
+	"""
+	if depth == 8:
+		return rows
+	if numpy is not None:
+		packed = numpy.frombuffer(rows, dtype=numpy.uint8).reshape(height, row_bytes)
+		shifts = numpy.arange(8 - depth, -1, -depth, dtype=numpy.uint8)
+		pixels = (packed[:, :, None] >> shifts) & ((1 << depth) - 1)
+		return numpy.ascontiguousarray(pixels.reshape(height, -1)[:, :width]).tobytes()
+	spread = [
+		bytes((value >> shift) & ((1 << depth) - 1) for shift in range(8 - depth, -1, -depth)) for value in range(0x100)
+	]
+	return b"".join(
+		b"".join(spread[value] for value in rows[y * row_bytes:(y + 1) * row_bytes])[:width] for y in range(height))
+
+
+def pack_tiles(width: int, height: int, pixels: bytes) -> bytes:
+	"""
+	Packs a byte-per-pixel image into CHR tiles: 8 bytes of each tile's low bitplane, then 8 of its high one.
+	"""
+	if width % 8 or height % 8:
+		raise ValueError(f"Images must be a whole number of 8x8 tiles, not {width}x{height}")
+	if numpy is not None:
+		tiles = numpy.frombuffer(pixels, dtype=numpy.uint8).reshape(height // 8, 8, width // 8, 8)
+		tiles = tiles.transpose(0, 2, 1, 3).reshape(-1, 8, 8)
+		low = numpy.packbits(tiles & 1, axis=2)
+		high = numpy.packbits((tiles >> 1) & 1, axis=2)
+		return numpy.concatenate((low, high), axis=1).tobytes()
+	out = bytearray()
+	for tile_y in range(0, height, 8):
+		for tile_x in range(0, width, 8):
+			low, high = bytearray(8), bytearray(8)
+			for row in range(8):
+				start = (tile_y + row) * width + tile_x
+				packed = int.from_bytes(pixels[start:start + 8], "big")
+				low[row] = ((packed & _PLANE_BITS) * _GATHER_BITS) >> 56 & 0xFF
+				high[row] = ((packed >> 1 & _PLANE_BITS) * _GATHER_BITS) >> 56 & 0xFF
+			out += low
+			out += high
+	return bytes(out)
+
+
+def dedupe_tiles(tiles: bytes) -> bytes:
+	"""
+	Drops every tile that repeats an earlier one, keeping the rest in order.
+	"""
+	return b"".join(dict.fromkeys(tiles[pos:pos + TILE_BYTES] for pos in range(0, len(tiles), TILE_BYTES)))
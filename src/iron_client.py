@@ -0,0 +1,154 @@
+"""
+Thin client for the assembler daemon in iron_server.py. It only imports the standard library, so it starts quickly.
+Run with `python iron_client.py [source] [--project DIR] [--config LINE]... [-o out.nes]`, or `--ping` / `--stop`.
+
+Messages in both directions are framed as two big-endian 32-bit lengths, then a UTF-8 JSON header of the first length,
+then a binary payload of the second. A request's header holds "op" ("assemble", "ping" or "stop"); an assemble request
+also holds "input_dir", "output_dir", "name" (the source file name, for includes and the default output name) and
+"config" (a list of extra `!` configuration lines that override the source's), and its payload is the source text. A
+reply's header holds "ok", "diagnostics" (a list of objects with "severity" and "message"), "output_path", "cached"
+and "seconds", and its payload is the assembled ROM.
+"""
+import argparse
+import json
+import os
+import socket
+import struct
+import sys
+import tempfile
+from typing import Iterable, Union
+
+DEFAULT_SOCKET_PATH = os.path.join(
+	tempfile.gettempdir(), f"iron-65-{os.getuid() if hasattr(os, 'getuid') else 'user'}.sock")
+_FRAME = struct.Struct(">II")
+_MAX_MESSAGE_SIZE = 1 << 28
+
+
+def send_message(sock: socket.socket, header: dict, payload: Union[bytes, bytearray, memoryview] = b"") -> None:
+	header_bytes = json.dumps(header).encode("utf-8")
+	sock.sendall(_FRAME.pack(len(header_bytes), len(payload)) + header_bytes)
+	if len(payload) > 0:
+		sock.sendall(payload)
+
+
+def recv_message(sock: socket.socket) -> Union[tuple[dict, bytes], None]:
+	"""
+	Reads one message, or returns None if the other end closed the connection cleanly before sending one.
+	"""
+	frame = _recv_exactly(sock, _FRAME.size, allow_eof=True)
+	if frame is None:
+		return None
+	header_size, payload_size = _FRAME.unpack(frame)
+	if header_size + payload_size > _MAX_MESSAGE_SIZE:
+		raise ValueError(f"Message of {header_size + payload_size} bytes is too large")
+	header = json.loads(_recv_exactly(sock, header_size).decode("utf-8"))
+	if not isinstance(header, dict):
+		raise ValueError("Message header should be a JSON object")
+	return header, _recv_exactly(sock, payload_size)
+
+
+def _recv_exactly(sock: socket.socket, size: int, allow_eof: bool = False) -> Union[bytes, None]:
+	buffer = bytearray(size)
+	view = memoryview(buffer)
+	received = 0
+	while received < size:
+		step = sock.recv_into(view[received:])
+		if step == 0:
+			if allow_eof and received == 0:
+				return None
+			raise ConnectionError("Connection closed in the middle of a message")
+		received += step
+	return bytes(buffer)
+
+
+class AssemblerClient:
+	def __init__(self, socket_path: str = DEFAULT_SOCKET_PATH) -> None:
+		if not hasattr(socket, "AF_UNIX"):
+			raise OSError("The assembler daemon needs Unix domain sockets, which this platform doesn't have.")
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			self.sock.connect(socket_path)
+		except OSError:
+			self.sock.close()
+			raise
+
+	def __enter__(self) -> "AssemblerClient":
+		return self
+
+	def __exit__(self, *exc_info) -> None:
+		self.close()
+
+	def close(self) -> None:
+		self.sock.close()
+
+	def request(self, header: dict, payload: bytes = b"") -> tuple[dict, bytes]:
+		send_message(self.sock, header, payload)
+		reply = recv_message(self.sock)
+		if reply is None:
+			raise ConnectionError("The assembler daemon closed the connection without replying")
+		return reply
+
+	def assemble(self, source: bytes, input_dir: str, output_dir: str, name: str = "main.asm",
+				 config: Iterable[str] = ()) -> tuple[dict, bytes]:
+		"""
+		Assembles source text as if it were the file name in input_dir. Returns the reply header and the ROM, which is
+		empty if assembly failed.
+		"""
+		return self.request({
+			"op": "assemble", "input_dir": os.path.abspath(input_dir), "output_dir": os.path.abspath(output_dir),
+			"name": name, "config": list(config)
+		}, source)
+
+	def ping(self) -> dict:
+		return self.request({"op": "ping"})[0]
+
+	def stop(self) -> dict:
+		return self.request({"op": "stop"})[0]
+
+
+def _find_source_file(input_dir: str) -> str:
+	for file in sorted(os.listdir(input_dir)):
+		if file.endswith(".asm") or file.endswith(".s"):
+			return os.path.join(input_dir, file)
+	raise FileNotFoundError("Can't find source file!")
+
+
+def main() -> None:
+	arg_parser = argparse.ArgumentParser(description="Assemble through a running iron_server.py daemon")
+	arg_parser.add_argument("source", nargs="?", help="source file; defaults to the first .asm/.s in the input dir")
+	arg_parser.add_argument("--project", default=".", help="directory holding input/ and output/; defaults to .")
+	arg_parser.add_argument(
+		"--config", action="append", default=[], metavar="LINE", help="extra configuration line, e.g. '!MAPPER 2'")
+	arg_parser.add_argument("-o", "--output", help="where to write the ROM; defaults to the usual output path")
+	arg_parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH, help="path of the daemon's socket")
+	arg_parser.add_argument("--ping", action="store_true", help="print the daemon's status and exit")
+	arg_parser.add_argument("--stop", action="store_true", help="stop the daemon")
+	args = arg_parser.parse_args()
+
+	with AssemblerClient(args.socket) as client:
+		if args.ping or args.stop:
+			print(json.dumps(client.stop() if args.stop else client.ping(), indent=2))
+			return
+		input_dir = os.path.join(args.project, "input")
+		source_path = args.source or _find_source_file(input_dir)
+		with open(source_path, mode="rb") as source_file:
+			source = source_file.read()
+		if args.source:
+			input_dir = os.path.dirname(source_path) or "."
+		output_dir = os.path.join(os.path.dirname(os.path.abspath(input_dir)), "output")
+		reply, rom = client.assemble(source, input_dir, output_dir, os.path.basename(source_path), args.config)
+
+	for diagnostic in reply["diagnostics"]:
+		print(f"{diagnostic['severity']}: {diagnostic['message']}", file=sys.stderr)
+	if not reply["ok"]:
+		sys.exit(1)
+	out_path = args.output or reply["output_path"]
+	os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+	with open(out_path, mode="wb") as out_file:
+		out_file.write(rom)
+	cached = " (cached)" if reply["cached"] else ""
+	print(f"Wrote {out_path} in {reply['seconds'] * 1000:.1f} ms{cached}.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,576 @@
+"""
+A headless 6502 for timing assembled routines: it runs a label of a built program on the PRG image until the label's
+RTS or RTI, or a cycle limit, and reports the exact cycles taken, the memory read and written, and where the cycles
+went. Instructions are decoded from the parser's opcode table and timed from iron_cycles, so only the official
+instructions the assembler can encode are run. Like the NES's CPU, it has no decimal mode.
+
+Memory is 2 KiB of RAM mirrored up to $2000, 8 KiB of PRG-RAM at $6000, and PRG-ROM at $8000, which starts out as the
+first 16 KiB bank at $8000 and the last at $C000 (or the whole PRG-ROM, mirrored, if it's 32 KiB or less). Running a
+label maps its bank in where it's assembled to load. I/O from $2000 to $5FFF is stubbed: writes are only counted, and
+reads give 0, apart from $2002 which reports vblank, so that waits for it finish. Writes to PRG-ROM are counted with
+the I/O, and otherwise ignored.
+
+Run with `python iron_cpu.py <label> [source file] [--limit cycles] [--fail-over cycles] [--json report.json]`.
+"""
+import argparse
+import json
+import sys
+from bisect import bisect_right
+from collections import Counter
+from typing import Callable, Iterable, Union
+
+from iron_assembler import Assembler, find_source_file
+from iron_cycles import base_cycles, has_page_penalty
+from iron_parser import Label, Parser
+from number_reader import read
+
+_CARRY, _ZERO, _INTERRUPT, _DECIMAL, _BREAK, _UNUSED, _OVERFLOW, _NEGATIVE = 1, 2, 4, 8, 0x10, 0x20, 0x40, 0x80
+_RETURN_ADDRESS = 0xFFFF  # Where a run returns to; nothing runs from there, since it's the IRQ vector
+_WINDOW_SIZE = 0x2000  # PRG-ROM is mapped in 8 KiB windows
+_DEFAULT_CYCLE_LIMIT = 1_000_000
+_BRANCH_FLAGS = {
+	"BPL": (_NEGATIVE, False), "BMI": (_NEGATIVE, True), "BVC": (_OVERFLOW, False), "BVS": (_OVERFLOW, True),
+	"BCC": (_CARRY, False), "BCS": (_CARRY, True), "BNE": (_ZERO, False), "BEQ": (_ZERO, True)
+}
+_FLAG_INSTRUCTIONS = {
+	"CLC": (_CARRY, False), "SEC": (_CARRY, True), "CLI": (_INTERRUPT, False), "SEI": (_INTERRUPT, True),
+	"CLV": (_OVERFLOW, False), "CLD": (_DECIMAL, False), "SED": (_DECIMAL, True)
+}
+
+
+def _default_io_read(address: int) -> int:
+	return 0x80 if address == 0x2002 else 0
+
+
+# Opcode to mnemonic, addressing mode, length, cycles, and whether it takes a cycle more if its address crosses a page
+_DECODE: list[Union[tuple[str, str, int, int, bool], None]] = [None] * 0x100
+for _mnemonic, _modes in Parser._INSTRUCTIONS.items():
+	for _addr_mode, _opcode in _modes.items():
+		_DECODE[_opcode] = (
+			_mnemonic, _addr_mode, Parser._ADDR_MODE_LENGTHS[_addr_mode], base_cycles(_mnemonic, _addr_mode),
+			has_page_penalty(_mnemonic, _addr_mode))
+
+
+class RunResult:
+	"""
+	What running a routine did. cycles and instructions run from its first instruction to its return, inclusive.
+	hotspots holds the number of runs and the cycles taken by each instruction address.
+	"""
+	def __init__(self, address: int) -> None:
+		self.address = address
+		self.returned = False  # Whether it returned, rather than reaching the cycle limit
+		self.cycles = 0
+		self.instructions = 0
+		self.stack_depth = 0  # Most bytes the routine pushed at once
+		self.reads: set[int] = set()  # Addresses of RAM, PRG-RAM and PRG-ROM read as data
+		self.writes: set[int] = set()
+		self.io_reads: Counter[int] = Counter()
+		self.io_writes: Counter[int] = Counter()
+		self.hotspots: dict[int, list[int]] = {}
+		self.names: dict[int, str] = {}  # Names for instruction addresses, filled in by run_label
+
+	def top_hotspots(self, count: int = 10) -> list[tuple[int, int, int]]:
+		"""
+		Returns the address, runs and cycles of the instructions that took the most cycles.
+		"""
+		ranked = sorted(self.hotspots.items(), key=lambda item: item[1][1], reverse=True)[:count]
+		return [(address, runs, cycles) for address, (runs, cycles) in ranked]
+
+	def summary(self, hotspot_count: int = 10) -> str:
+		ending = "returned" if self.returned else "stopped at the cycle limit"
+		lines = [
+			f"${self.address:04X} {ending} after {self.cycles:,} cycle(s) and {self.instructions:,} instruction(s), "
+			f"using {self.stack_depth} byte(s) of stack",
+			f"read:       {_ranges(self.reads) or '-'}",
+			f"written:    {_ranges(self.writes) or '-'}",
+			f"I/O reads:  {_counts(self.io_reads) or '-'}",
+			f"I/O writes: {_counts(self.io_writes) or '-'}",
+			"",
+			f"{'address':<9}{'runs':>10}{'cycles':>12}{'share':>8}  instruction at"
+		]
+		for address, runs, cycles in self.top_hotspots(hotspot_count):
+			share = cycles / self.cycles if self.cycles else 0
+			lines.append(f"${address:04X}    {runs:>10,}{cycles:>12,}{share:>8.1%}  {self.names.get(address, '')}")
+		return "\n".join(lines)
+
+	def to_dict(self) -> dict:
+		return {
+			"address": self.address,
+			"returned": self.returned,
+			"cycles": self.cycles,
+			"instructions": self.instructions,
+			"stack_depth": self.stack_depth,
+			"reads": sorted(self.reads),
+			"writes": sorted(self.writes),
+			"io_reads": {f"${address:04X}": count for address, count in sorted(self.io_reads.items())},
+			"io_writes": {f"${address:04X}": count for address, count in sorted(self.io_writes.items())},
+			"hotspots": [
+				{"address": address, "name": self.names.get(address, ""), "runs": runs, "cycles": cycles}
+				for address, runs, cycles in self.top_hotspots(len(self.hotspots))
+			]
+		}
+
+
+class Cpu:
+	def __init__(self, prg: bytes, io_read: Callable[[int], int] = _default_io_read) -> None:
+		if not prg or len(prg) % 0x4000:
+			raise ValueError(f"PRG-ROM must be a whole number of 16 KiB banks, not {len(prg):#x} bytes")
+		self.prg = prg
+		self.io_read = io_read
+		self.ram = bytearray(0x800)
+		self.prg_ram = bytearray(0x2000)
+		self.a = self.x = self.y = 0
+		self.sp = 0xFD
+		self.p = _UNUSED | _INTERRUPT
+		self.pc = 0
+		self.result = RunResult(0)
+		# PRG-ROM offset of each 8 KiB window from $8000 up
+		if len(prg) <= 0x8000:
+			self.windows = [offset % len(prg) for offset in range(0, 0x8000, _WINDOW_SIZE)]
+		else:
+			self.windows = [0, _WINDOW_SIZE, len(prg) - 0x4000, len(prg) - _WINDOW_SIZE]
+
+	def map_rom(self, address: int, prg_offset: int, size: int) -> None:
+		"""
+		Maps size bytes of PRG-ROM, from prg_offset, in at a CPU address. All three must be multiples of 8 KiB.
+		"""
+		if address < 0x8000 or address % _WINDOW_SIZE or prg_offset % _WINDOW_SIZE or size % _WINDOW_SIZE:
+			raise ValueError(f"Can't map {size:#x} bytes of PRG-ROM at ${address:04X}; only whole 8 KiB windows from "
+							 f"$8000 can be mapped")
+		if prg_offset + size > len(self.prg) or address + size > 0x10000:
+			raise ValueError(f"Can't map {size:#x} bytes from PRG offset {prg_offset:#x} at ${address:04X}")
+		for window in range(size // _WINDOW_SIZE):
+			self.windows[(address - 0x8000) // _WINDOW_SIZE + window] = prg_offset + window * _WINDOW_SIZE
+
+	def rom_offset(self, address: int) -> int:
+		"""
+		Returns the PRG-ROM offset mapped in at an address of $8000 or more.
+		"""
+		return self.windows[(address - 0x8000) // _WINDOW_SIZE] + address % _WINDOW_SIZE
+
+	def fetch(self, address: int) -> int:
+		"""
+		Reads a byte of code, which doesn't count as touching memory.
+		"""
+		if address >= 0x8000:
+			return self.prg[self.windows[(address - 0x8000) // _WINDOW_SIZE] + address % _WINDOW_SIZE]
+		if address < 0x2000:
+			return self.ram[address & 0x7FF]
+		if address >= 0x6000:
+			return self.prg_ram[address - 0x6000]
+		return self.io_read(address)
+
+	def read(self, address: int) -> int:
+		if 0x2000 <= address < 0x6000:
+			self.result.io_reads[address] += 1
+			return self.io_read(address)
+		self.result.reads.add(address)
+		return self.fetch(address)
+
+	def write(self, address: int, value: int) -> None:
+		if address < 0x2000:
+			self.ram[address & 0x7FF] = value
+			self.result.writes.add(address)
+		elif 0x6000 <= address < 0x8000:
+			self.prg_ram[address - 0x6000] = value
+			self.result.writes.add(address)
+		else:
+			self.result.io_writes[address] += 1
+
+	def push(self, value: int) -> None:
+		self.ram[0x100 + self.sp] = value
+		self.sp = (self.sp - 1) & 0xFF
+
+	def pull(self) -> int:
+		self.sp = (self.sp + 1) & 0xFF
+		return self.ram[0x100 + self.sp]
+
+	def set_flag(self, flag: int, on: bool) -> None:
+		self.p = self.p | flag if on else self.p & ~flag
+
+	def set_nz(self, value: int) -> int:
+		self.p = (self.p & ~(_NEGATIVE | _ZERO)) | (value & _NEGATIVE) | (0 if value else _ZERO)
+		return value
+
+	def call(self, address: int, cycle_limit: int = _DEFAULT_CYCLE_LIMIT, interrupt: bool = False) -> RunResult:
+		"""
+		Runs the routine at an address until it returns, with RTI if it's an interrupt handler or RTS otherwise, or
+		until it has taken cycle_limit cycles. Registers and memory are left as the routine leaves them.
+		"""
+		self.result = result = RunResult(address)
+		if interrupt:
+			self.push(_RETURN_ADDRESS >> 8)
+			self.push(_RETURN_ADDRESS & 0xFF)
+			self.push(self.p | _UNUSED)
+		else:
+			self.push((_RETURN_ADDRESS - 1) >> 8)
+			self.push((_RETURN_ADDRESS - 1) & 0xFF)
+		start_sp = lowest_sp = self.sp
+		self.pc = address
+		hotspots = result.hotspots
+		while self.pc != _RETURN_ADDRESS and result.cycles < cycle_limit:
+			pc = self.pc
+			cycles = self.step()
+			result.cycles += cycles
+			result.instructions += 1
+			hotspot = hotspots.get(pc)
+			if hotspot is None:
+				hotspots[pc] = [1, cycles]
+			else:
+				hotspot[0] += 1
+				hotspot[1] += cycles
+			if self.sp < lowest_sp:
+				lowest_sp = self.sp
+		result.returned = self.pc == _RETURN_ADDRESS
+		result.stack_depth = start_sp - lowest_sp
+		return result
+
+	def step(self) -> int:
+		"""
+		Runs one instruction, and returns the cycles it took.
+		"""
+		pc = self.pc
+		opcode = self.fetch(pc)
+		decoded = _DECODE[opcode]
+		if decoded is None:
+			raise ValueError(f"Unknown opcode ${opcode:02X} at ${pc:04X}")
+		mnemonic, addr_mode, length, cycles, page_penalty = decoded
+		self.pc = (pc + length) & 0xFFFF
+		address, crossed = self.operand_address(addr_mode, pc)
+		if page_penalty and crossed:
+			cycles += 1
+		return cycles + _EXECUTE[mnemonic](self, addr_mode, address)
+
+	def operand_address(self, addr_mode: str, pc: int) -> tuple[int, bool]:
+		"""
+		Returns the address an instruction at pc works on, and whether indexing it crossed a page. Branches give their
+		target.
+		"""
+		if addr_mode in ("IMPLIED", "ACCUMULATOR"):
+			return 0, False
+		if addr_mode == "IMMEDIATE":
+			return (pc + 1) & 0xFFFF, False
+		operand = self.fetch((pc + 1) & 0xFFFF)
+		if addr_mode == "ZERO_PAGE":
+			return operand, False
+		if addr_mode == "ZERO_PAGE_X":
+			return (operand + self.x) & 0xFF, False
+		if addr_mode == "ZERO_PAGE_Y":
+			return (operand + self.y) & 0xFF, False
+		if addr_mode == "RELATIVE":
+			return (pc + 2 + operand - (0x100 if operand & 0x80 else 0)) & 0xFFFF, False
+		if addr_mode == "X_INDIRECT":
+			pointer = (operand + self.x) & 0xFF
+			return self.read(pointer) | self.read((pointer + 1) & 0xFF) << 8, False
+		if addr_mode == "INDIRECT_Y":
+			base = self.read(operand) | self.read((operand + 1) & 0xFF) << 8
+			address = (base + self.y) & 0xFFFF
+			return address, (base ^ address) & 0xFF00 != 0
+		base = operand | self.fetch((pc + 2) & 0xFFFF) << 8
+		if addr_mode == "ABSOLUTE":
+			return base, False
+		if addr_mode == "INDIRECT":  # The pointer's high byte comes from the same page, as on the real CPU
+			return self.read(base) | self.read((base & 0xFF00) | ((base + 1) & 0xFF)) << 8, False
+		address = (base + (self.x if addr_mode == "ABSOLUTE_X" else self.y)) & 0xFFFF
+		return address, (base ^ address) & 0xFF00 != 0
+
+	def operand_value(self, addr_mode: str, address: int) -> int:
+		if addr_mode == "IMMEDIATE":
+			return self.fetch(address)
+		if addr_mode == "ACCUMULATOR":
+			return self.a
+		return self.read(address)
+
+	def store_result(self, addr_mode: str, address: int, value: int) -> None:
+		if addr_mode == "ACCUMULATOR":
+			self.a = value
+		else:
+			self.write(address, value)
+
+
+def _add(cpu: Cpu, value: int) -> None:
+	total = cpu.a + value + (cpu.p & _CARRY)
+	cpu.set_flag(_CARRY, total > 0xFF)
+	cpu.set_flag(_OVERFLOW, ~(cpu.a ^ value) & (cpu.a ^ total) & 0x80 != 0)
+	cpu.a = cpu.set_nz(total & 0xFF)
+
+
+def _compare(cpu: Cpu, register: int, value: int) -> None:
+	cpu.set_flag(_CARRY, register >= value)
+	cpu.set_nz((register - value) & 0xFF)
+
+
+def _shift(cpu: Cpu, addr_mode: str, address: int, left: bool, rotate: bool) -> int:
+	value = cpu.operand_value(addr_mode, address)
+	carry_in = cpu.p & _CARRY if rotate else 0
+	if left:
+		cpu.set_flag(_CARRY, value & 0x80 != 0)
+		value = (value << 1 | carry_in) & 0xFF
+	else:
+		cpu.set_flag(_CARRY, value & 1 != 0)
+		value = value >> 1 | carry_in << 7
+	cpu.store_result(addr_mode, address, cpu.set_nz(value))
+	return 0
+
+
+def _branch(cpu: Cpu, mnemonic: str, target: int) -> int:
+	flag, when_set = _BRANCH_FLAGS[mnemonic]
+	if (cpu.p & flag != 0) != when_set:
+		return 0
+	next_pc = cpu.pc
+	cpu.pc = target
+	return 2 if (next_pc ^ target) & 0xFF00 else 1
+
+
+def _jsr(cpu: Cpu, address: int) -> int:
+	return_address = (cpu.pc - 1) & 0xFFFF
+	cpu.push(return_address >> 8)
+	cpu.push(return_address & 0xFF)
+	cpu.pc = address
+	return 0
+
+
+def _rts(cpu: Cpu) -> int:
+	low = cpu.pull()
+	cpu.pc = (low | cpu.pull() << 8) + 1 & 0xFFFF
+	return 0
+
+
+def _rti(cpu: Cpu) -> int:
+	cpu.p = cpu.pull() & ~_BREAK | _UNUSED
+	low = cpu.pull()
+	cpu.pc = low | cpu.pull() << 8
+	return 0
+
+
+def _brk(cpu: Cpu) -> int:
+	return_address = (cpu.pc + 1) & 0xFFFF  # BRK skips a padding byte
+	cpu.push(return_address >> 8)
+	cpu.push(return_address & 0xFF)
+	cpu.push(cpu.p | _BREAK | _UNUSED)
+	cpu.p |= _INTERRUPT
+	cpu.pc = cpu.fetch(0xFFFE) | cpu.fetch(0xFFFF) << 8
+	return 0
+
+
+def _set_register(name: str) -> Callable[[Cpu, str, int], int]:
+	def load(cpu: Cpu, addr_mode: str, address: int) -> int:
+		setattr(cpu, name, cpu.set_nz(cpu.operand_value(addr_mode, address)))
+		return 0
+	return load
+
+
+def _store_register(name: str) -> Callable[[Cpu, str, int], int]:
+	def store(cpu: Cpu, addr_mode: str, address: int) -> int:
+		cpu.write(address, getattr(cpu, name))
+		return 0
+	return store
+
+
+def _transfer(source: str, destination: str) -> Callable[[Cpu, str, int], int]:
+	def transfer(cpu: Cpu, addr_mode: str, address: int) -> int:
+		setattr(cpu, destination, cpu.set_nz(getattr(cpu, source)))
+		return 0
+	return transfer
+
+
+def _step_register(name: str, step: int) -> Callable[[Cpu, str, int], int]:
+	def change(cpu: Cpu, addr_mode: str, address: int) -> int:
+		setattr(cpu, name, cpu.set_nz((getattr(cpu, name) + step) & 0xFF))
+		return 0
+	return change
+
+
+def _step_memory(step: int) -> Callable[[Cpu, str, int], int]:
+	def change(cpu: Cpu, addr_mode: str, address: int) -> int:
+		cpu.write(address, cpu.set_nz((cpu.read(address) + step) & 0xFF))
+		return 0
+	return change
+
+
+def _logic(function: Callable[[int, int], int]) -> Callable[[Cpu, str, int], int]:
+	def apply(cpu: Cpu, addr_mode: str, address: int) -> int:
+		cpu.a = cpu.set_nz(function(cpu.a, cpu.operand_value(addr_mode, address)))
+		return 0
+	return apply
+
+
+def _compare_register(name: str) -> Callable[[Cpu, str, int], int]:
+	def compare(cpu: Cpu, addr_mode: str, address: int) -> int:
+		_compare(cpu, getattr(cpu, name), cpu.operand_value(addr_mode, address))
+		return 0
+	return compare
+
+
+def _flag_instruction(mnemonic: str) -> Callable[[Cpu, str, int], int]:
+	flag, on = _FLAG_INSTRUCTIONS[mnemonic]
+
+	def set_flag(cpu: Cpu, addr_mode: str, address: int) -> int:
+		cpu.set_flag(flag, on)
+		return 0
+	return set_flag
+
+
+def _branch_instruction(mnemonic: str) -> Callable[[Cpu, str, int], int]:
+	return lambda cpu, addr_mode, address: _branch(cpu, mnemonic, address)
+
+
+def _bit(cpu: Cpu, addr_mode: str, address: int) -> int:
+	value = cpu.read(address)
+	cpu.p = (cpu.p & ~(_NEGATIVE | _OVERFLOW | _ZERO)) | (value & (_NEGATIVE | _OVERFLOW)) | (
+		0 if cpu.a & value else _ZERO)
+	return 0
+
+
+def _pla(cpu: Cpu, addr_mode: str, address: int) -> int:
+	cpu.a = cpu.set_nz(cpu.pull())
+	return 0
+
+
+def _plp(cpu: Cpu, addr_mode: str, address: int) -> int:
+	cpu.p = cpu.pull() & ~_BREAK | _UNUSED
+	return 0
+
+
+def _jmp(cpu: Cpu, addr_mode: str, address: int) -> int:
+	cpu.pc = address
+	return 0
+
+
+# Each takes the CPU, addressing mode and operand address, and returns any cycles on top of the instruction's base
+_EXECUTE: dict[str, Callable[[Cpu, str, int], int]] = {
+	"ADC": lambda cpu, addr_mode, address: _add(cpu, cpu.operand_value(addr_mode, address)) or 0,
+	"SBC": lambda cpu, addr_mode, address: _add(cpu, cpu.operand_value(addr_mode, address) ^ 0xFF) or 0,
+	"AND": _logic(lambda a, value: a & value),
+	"ORA": _logic(lambda a, value: a | value),
+	"EOR": _logic(lambda a, value: a ^ value),
+	"ASL": lambda cpu, addr_mode, address: _shift(cpu, addr_mode, address, left=True, rotate=False),
+	"LSR": lambda cpu, addr_mode, address: _shift(cpu, addr_mode, address, left=False, rotate=False),
+	"ROL": lambda cpu, addr_mode, address: _shift(cpu, addr_mode, address, left=True, rotate=True),
+	"ROR": lambda cpu, addr_mode, address: _shift(cpu, addr_mode, address, left=False, rotate=True),
+	"BIT": _bit,
+	"CMP": _compare_register("a"),
+	"CPX": _compare_register("x"),
+	"CPY": _compare_register("y"),
+	"LDA": _set_register("a"),
+	"LDX": _set_register("x"),
+	"LDY": _set_register("y"),
+	"STA": _store_register("a"),
+	"STX": _store_register("x"),
+	"STY": _store_register("y"),
+	"INC": _step_memory(1),
+	"DEC": _step_memory(-1),
+	"INX": _step_register("x", 1),
+	"DEX": _step_register("x", -1),
+	"INY": _step_register("y", 1),
+	"DEY": _step_register("y", -1),
+	"TAX": _transfer("a", "x"),
+	"TAY": _transfer("a", "y"),
+	"TXA": _transfer("x", "a"),
+	"TYA": _transfer("y", "a"),
+	"TSX": _transfer("sp", "x"),
+	"PHA": lambda cpu, addr_mode, address: cpu.push(cpu.a) or 0,
+	"PHP": lambda cpu, addr_mode, address: cpu.push(cpu.p | _BREAK | _UNUSED) or 0,
+	"PLA": _pla,
+	"PLP": _plp,
+	"JMP": _jmp,
+	"JSR": lambda cpu, addr_mode, address: _jsr(cpu, address),
+	"RTS": lambda cpu, addr_mode, address: _rts(cpu),
+	"RTI": lambda cpu, addr_mode, address: _rti(cpu),
+	"BRK": lambda cpu, addr_mode, address: _brk(cpu),
+	"NOP": lambda cpu, addr_mode, address: 0,
+	**{mnemonic: _flag_instruction(mnemonic) for mnemonic in _FLAG_INSTRUCTIONS},
+	**{mnemonic: _branch_instruction(mnemonic) for mnemonic in _BRANCH_FLAGS}
+}
+
+
+def run_label(assembler: Assembler, name: str, cycle_limit: int = _DEFAULT_CYCLE_LIMIT, interrupt: bool = False,
+			  registers: Union[dict[str, int], None] = None) -> RunResult:
+	"""
+	Runs a label of a built program on a fresh Cpu, with the bank it's in mapped in where it loads. registers gives
+	starting values for any of "a", "x" and "y".
+	"""
+	parser = assembler.parser
+	label = parser.sym_lib.labels.get(name.upper())
+	if label is None:
+		raise ValueError(f"No label named {name}")
+	cpu = Cpu(b"".join(assembler.virtual_cart.prg_image.chunks()))
+	bank_size = parser.prg_image.bank_size
+	bank_start = label.bank * bank_size
+	bank_address = parser.cpu_address(bank_start)
+	if bank_address % _WINDOW_SIZE == 0 and bank_size % _WINDOW_SIZE == 0 and bank_address + bank_size <= 0x10000:
+		cpu.map_rom(bank_address, bank_start, bank_size)
+	if cpu.rom_offset(label.absolute_addr) != label.short_addr:
+		raise ValueError(f"Can't map {name} in at ${label.absolute_addr:04X}")
+	for register, value in (registers or {}).items():
+		if register not in ("a", "x", "y") or not 0 <= value <= 0xFF:
+			raise ValueError(f"Can't start with {register} = {value}")
+		setattr(cpu, register, value)
+	result = cpu.call(label.absolute_addr, cycle_limit, interrupt)
+	result.names = _instruction_names(cpu, parser.sym_lib.labels.values(), result.hotspots)
+	return result
+
+
+def _instruction_names(cpu: Cpu, labels: Iterable[Label], addresses: Iterable[int]) -> dict[int, str]:
+	"""
+	Names each address as the label at or before it, plus an offset, using the labels that are mapped in.
+	"""
+	mapped = sorted(
+		(label.absolute_addr, label.name) for label in labels
+		if label.absolute_addr >= 0x8000 and cpu.rom_offset(label.absolute_addr) == label.short_addr)
+	names = {}
+	for address in addresses:
+		index = bisect_right(mapped, (address, "\uffff")) - 1
+		if index >= 0:
+			label_address, name = mapped[index]
+			names[address] = name if address == label_address else f"{name}+{address - label_address}"
+	return names
+
+
+def _ranges(addresses: set[int]) -> str:
+	"""
+	Formats addresses as runs, such as "$0010-$0011, $0300".
+	"""
+	runs = []
+	for address in sorted(addresses):
+		if runs and address == runs[-1][1] + 1:
+			runs[-1][1] = address
+		else:
+			runs.append([address, address])
+	return ", ".join(f"${start:04X}" if start == end else f"${start:04X}-${end:04X}" for start, end in runs)
+
+
+def _counts(counter: Counter[int]) -> str:
+	return ", ".join(f"${address:04X} x{count}" for address, count in sorted(counter.items()))
+
+
+def main() -> None:
+	arg_parser = argparse.ArgumentParser(description="Assemble a project, then run one of its routines and time it")
+	arg_parser.add_argument("label", help="the routine to run, until it returns")
+	arg_parser.add_argument("source", nargs="?", help="source file; defaults to the first .asm/.s in input/")
+	arg_parser.add_argument("--limit", type=int, default=_DEFAULT_CYCLE_LIMIT, help="cycles to stop after")
+	arg_parser.add_argument("--interrupt", action="store_true", help="run it as an interrupt handler, ending in RTI")
+	for register in ("a", "x", "y"):
+		arg_parser.add_argument(f"-{register}", type=read, default=0, help=f"starting value of {register.upper()}")
+	arg_parser.add_argument("--hotspots", type=int, default=10, help="number of hotspots to list")
+	arg_parser.add_argument(
+		"--fail-over", type=int, help="exit with an error if it takes more cycles than this, or doesn't return")
+	arg_parser.add_argument("--json", help="write the report to this JSON file instead of printing it")
+	args = arg_parser.parse_args()
+
+	assembler = Assembler(args.source or find_source_file())
+	assembler.build()
+	result = run_label(
+		assembler, args.label, args.limit, args.interrupt, {"a": args.a, "x": args.x, "y": args.y})
+	if args.json:
+		with open(args.json, "w") as report_file:
+			json.dump(result.to_dict(), report_file, indent=2)
+	else:
+		print(result.summary(args.hotspots), file=sys.stderr)
+	if args.fail_over is not None and (not result.returned or result.cycles > args.fail_over):
+		print(f"{args.label} took {result.cycles:,} cycle(s), over the {args.fail_over:,} allowed", file=sys.stderr)
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
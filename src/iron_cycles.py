@@ -0,0 +1,477 @@
+"""
+6502 instruction timings, in CPU cycles, for the instructions and addressing modes the parser knows, and a static
+timing report built on them: the cycles each label's code takes, the branches and indexed reads that take an extra
+cycle crossing a page, and the worst case of routines, which `.MAXCYCLES <cycles>` after a label turns into a limit the
+build enforces. Loops are bounded by `.LOOPS <iterations>` after the branch back to their start.
+Run with `python iron_cycles.py [source file] [--sort max] [--json report.json]`, or `python main.py --cycles`.
+"""
+import argparse
+import json
+import sys
+from bisect import bisect_left, bisect_right
+from operator import attrgetter
+from typing import Union
+
+from iron_parser import Instruction, Parser
+
+
+_IMPLIED_CYCLES = {"PHA": 3, "PHP": 3, "PLA": 4, "PLP": 4, "RTS": 6, "RTI": 6, "BRK": 7}
+_READ_MODIFY_WRITE = frozenset(("ASL", "LSR", "ROL", "ROR", "INC", "DEC"))
+_STORES = frozenset(("STA", "STX", "STY"))
+_MODE_CYCLES = {
+	"IMPLIED": 2, "ACCUMULATOR": 2, "IMMEDIATE": 2, "RELATIVE": 2, "ZERO_PAGE": 3, "ZERO_PAGE_X": 4, "ZERO_PAGE_Y": 4,
+	"ABSOLUTE": 4, "ABSOLUTE_X": 4, "ABSOLUTE_Y": 4, "INDIRECT": 5, "X_INDIRECT": 6, "INDIRECT_Y": 5
+}
+_PAGE_CROSS_MODES = ("ABSOLUTE_X", "ABSOLUTE_Y", "INDIRECT_Y")
+_ZERO_SIZE_DIRECTIVES = (".ORG", ".MAXCYCLES", ".LOOPS")
+SORT_KEYS = ("address", "name", "line", "min", "max", "routine")
+
+
+def base_cycles(mnemonic: str, addr_mode: str) -> int:
+	"""
+	Returns the cycles an instruction takes, not counting a taken branch or an indexed read that crosses a page.
+	"""
+	if addr_mode == "IMPLIED":
+		return _IMPLIED_CYCLES.get(mnemonic, 2)
+	if mnemonic == "JMP" and addr_mode == "ABSOLUTE":
+		return 3
+	if mnemonic == "JSR":
+		return 6
+	cycles = _MODE_CYCLES[addr_mode]
+	if mnemonic in _READ_MODIFY_WRITE and addr_mode != "ACCUMULATOR":
+		cycles += 3 if addr_mode in ("ABSOLUTE_X", "ABSOLUTE_Y") else 2
+	elif mnemonic in _STORES and addr_mode in _PAGE_CROSS_MODES:
+		cycles += 1  # Stores always take the page-crossing cycle
+	return cycles
+
+
+def has_page_penalty(mnemonic: str, addr_mode: str) -> bool:
+	"""
+	Whether an instruction takes an extra cycle when its indexed address lands on a different page from its base.
+	"""
+	return addr_mode in _PAGE_CROSS_MODES and mnemonic not in _STORES and mnemonic not in _READ_MODIFY_WRITE
+
+
+class LabelTiming:
+	"""
+	The cycles the code at a label takes. min_cycles and max_cycles cover its straight-line block, from the label to the
+	next label, jump or return, including leaving early through a branch. routine_cycles is the most it can take to
+	reach a return, following branches, jumps and calls, or None if that can't be bounded.
+	"""
+	__slots__ = ("name", "address", "line_no", "min_cycles", "max_cycles", "routine_cycles")
+
+	def __init__(self, name: str, address: int, line_no: int, min_cycles: int, max_cycles: int,
+				 routine_cycles: Union[int, None]) -> None:
+		self.name = name
+		self.address = address
+		self.line_no = line_no  # Of the label's first instruction
+		self.min_cycles = min_cycles
+		self.max_cycles = max_cycles
+		self.routine_cycles = routine_cycles
+
+
+class PageCrossing:
+	"""
+	A branch that takes an extra cycle because it crosses a page, or an indexed read from a table that straddles one.
+	"""
+	__slots__ = ("line_no", "address", "text", "reason")
+
+	def __init__(self, line_no: int, address: int, text: str, reason: str) -> None:
+		self.line_no = line_no
+		self.address = address
+		self.text = text
+		self.reason = reason
+
+
+class CycleReport:
+	def __init__(self) -> None:
+		self.labels: list[LabelTiming] = []
+		self.crossings: list[PageCrossing] = []
+
+	def sorted_labels(self, key: str = "address") -> list[LabelTiming]:
+		"""
+		Sorts the labels by address, name or line, or by one of their cycle counts ("min", "max" or "routine"), most
+		first.
+		"""
+		if key in ("address", "name"):
+			return sorted(self.labels, key=attrgetter(key))
+		if key == "line":
+			return sorted(self.labels, key=attrgetter("line_no"))
+		if key not in SORT_KEYS:
+			raise ValueError(f"Can't sort by {key}; expected one of {', '.join(SORT_KEYS)}")
+		count = attrgetter(f"{key}_cycles")
+		return sorted(self.labels, key=lambda timing: -1 if count(timing) is None else count(timing), reverse=True)
+
+	def summary(self, sort_key: str = "address") -> str:
+		lines = [f"{'label':<24}{'address':>8}{'line':>7}{'min':>7}{'max':>7}{'routine':>9}"]
+		for timing in self.sorted_labels(sort_key):
+			routine = "-" if timing.routine_cycles is None else timing.routine_cycles
+			lines.append(f"{timing.name:<24}{f'${timing.address:04X}':>8}{timing.line_no:>7}{timing.min_cycles:>7}"
+						 f"{timing.max_cycles:>7}{routine:>9}")
+		lines.append("")
+		lines.append(f"{'line':>6}  {'address':<9}page crossing")
+		for crossing in sorted(self.crossings, key=attrgetter("line_no")):
+			lines.append(f"{crossing.line_no:>6}  {f'${crossing.address:04X}':<9}{crossing.text}: {crossing.reason}")
+		lines.append(f"{len(self.labels)} label(s) timed, {len(self.crossings)} page crossing(s)")
+		return "\n".join(lines)
+
+	def to_dict(self, sort_key: str = "address") -> dict:
+		return {
+			"labels": [
+				{attribute: getattr(timing, attribute) for attribute in LabelTiming.__slots__}
+				for timing in self.sorted_labels(sort_key)
+			],
+			"page_crossings": [
+				{attribute: getattr(crossing, attribute) for attribute in PageCrossing.__slots__}
+				for crossing in sorted(self.crossings, key=attrgetter("line_no"))
+			]
+		}
+
+	def write_json(self, file_path: str, sort_key: str = "address") -> None:
+		with open(file_path, "w") as report_file:
+			json.dump(self.to_dict(sort_key), report_file, indent=2)
+
+
+def analyze(parser: Parser) -> CycleReport:
+	"""
+	Times the code at each label of a laid-out and encoded program.
+	"""
+	timing = _Timing(parser)
+	report = CycleReport()
+	report.crossings = timing.crossings
+	for name, label in parser.sym_lib.labels.items():
+		index = timing.code_at(label.short_addr)
+		if index is None:
+			continue  # Data, not code
+		min_cycles, max_cycles = timing.block_cycles(index)
+		try:
+			routine_cycles = timing.worst_case(index)
+		except ValueError:
+			routine_cycles = None
+		report.labels.append(LabelTiming(
+			name, label.absolute_addr, parser.token_list[index].line_no, min_cycles, max_cycles, routine_cycles))
+	return report
+
+
+def check_budgets(parser: Parser) -> None:
+	"""
+	Raises ValueError if any routine marked with `.MAXCYCLES <cycles>` could take more cycles than that to return, or
+	can't be bounded.
+	"""
+	timing = _Timing(parser)
+	problems = []
+	for name, budget, line_no in parser.cycle_budgets:
+		index = timing.code_at(parser.sym_lib.labels[name].short_addr)
+		if index is None:
+			problems.append(f"{name} isn't followed by code, for .MAXCYCLES on line {line_no}")
+			continue
+		try:
+			worst = timing.worst_case(index)
+		except ValueError as error:
+			problems.append(f"Can't bound the cycles {name} takes, for .MAXCYCLES on line {line_no}: {error}")
+			continue
+		if worst > budget:
+			problems.append(
+				f"{name} can take up to {worst} cycles, over the {budget} allowed by .MAXCYCLES on line {line_no}")
+	if problems:
+		raise ValueError("\n".join(problems))
+
+
+class _Timing:
+	"""
+	Per-instruction timing of a laid-out program, with the worst case from each instruction to a return worked out
+	as it's asked for.
+	"""
+	def __init__(self, parser: Parser) -> None:
+		self.parser = parser
+		self.instructions = parser.instructions
+		self.positions = parser.positions
+		sym_lib = parser.sym_lib
+		self.label_positions = sorted(
+			{label.short_addr for label in sym_lib.labels.values()}.union(sym_lib.anon_positions))
+		self.label_starts = set(self.label_positions)
+		self.page_cycles: dict[int, int] = {}  # Index of each instruction that may take a page-crossing cycle
+		self.branches: dict[int, tuple[Union[int, None], int]] = {}  # Index to target index and cycles when taken
+		self.crossings: list[PageCrossing] = []
+		self.bounds: dict[int, int] = {}  # Most cycles from an index to a return
+		self.unbounded: dict[int, str] = {}  # Why an index has no bound
+		self.trips: dict[int, Union[int, None]] = {}  # Most cycles once around each bounded loop, by its branch
+		for index, instruction in enumerate(self.instructions):
+			if instruction is None:
+				continue
+			if instruction.addr_mode == "RELATIVE":
+				self.time_branch(index, instruction)
+			elif has_page_penalty(instruction.mnemonic, instruction.addr_mode):
+				self.time_indexed_read(index, instruction)
+		self.loops: list[tuple[int, int]] = []  # First instruction and branch back of each loop .LOOPS bounds
+		for index in parser.loop_bounds:
+			target = self.branches[index][0]
+			if target is not None and target <= index:
+				self.loops.append((target, index))
+
+	def time_branch(self, index: int, instruction: Instruction) -> None:
+		pos = self.positions[index]
+		offset = int.from_bytes(self.parser.encode_instruction(instruction, pos)[1:2], "little", signed=True)
+		next_addr = self.parser.cpu_address(pos + 2)
+		target_addr = next_addr + offset
+		taken_cycles = 3
+		if (next_addr ^ target_addr) & 0xFF00:
+			taken_cycles += 1
+			token = self.parser.token_list[index]
+			self.crossings.append(PageCrossing(
+				token.line_no, self.parser.cpu_address(pos), token.content,
+				f"taken, it crosses from page ${next_addr >> 8:02X} to ${target_addr >> 8:02X}"))
+		self.branches[index] = (self.code_at(pos + 2 + offset), taken_cycles)
+
+	def time_indexed_read(self, index: int, instruction: Instruction) -> None:
+		"""
+		Works out whether an indexed read can cross a page. Reads through a label, a table, cross only if the table
+		straddles a page; other addresses, and (pointer),Y reads, are assumed to cross unless they can't.
+		"""
+		if instruction.addr_mode == "INDIRECT_Y":
+			self.page_cycles[index] = 1  # The pointer is only known at run time
+			return
+		base = self.parser.sym_lib.get_value(instruction.operand)
+		table = self.table_of(instruction.operand)
+		if table is None or not table[1] <= base <= table[2]:
+			if base & 0xFF:
+				self.page_cycles[index] = 1
+			return
+		name, start, last = table
+		if base >> 8 != last >> 8:
+			self.page_cycles[index] = 1
+			token = self.parser.token_list[index]
+			self.crossings.append(PageCrossing(
+				token.line_no, self.parser.cpu_address(self.positions[index]), token.content,
+				f"table {name} (${start:04X}-${last:04X}) straddles a page"))
+
+	def table_of(self, text: str) -> Union[tuple[str, int, int], None]:
+		"""
+		Returns the name, first and last address of the table an operand reads from, if it uses exactly one label. The
+		table runs up to the next label.
+		"""
+		sym_lib = self.parser.sym_lib
+		operand = sym_lib.classify(text)
+		if operand.kind == "name":
+			names = (operand.name,)
+		elif operand.kind == "expression":
+			names = operand.expression.names
+		else:
+			return None
+		tables = [sym_lib.labels[name] for name in names if name in sym_lib.labels]
+		if len(tables) != 1:
+			return None
+		label = tables[0]
+		next_index = bisect_right(self.label_positions, label.short_addr)
+		end = self.label_positions[next_index] if next_index < len(self.label_positions) else self.parser.end_pos
+		return label.name, label.absolute_addr, label.absolute_addr + max(end - label.short_addr, 1) - 1
+
+	def code_at(self, pos: int) -> Union[int, None]:
+		"""
+		Returns the index of the instruction at a PRG position, or None if there's data or nothing there.
+		"""
+		index = bisect_left(self.positions, pos)
+		while index < len(self.positions) and self.positions[index] == pos:
+			if self.instructions[index] is not None:
+				return index
+			if self.parser.token_list[index].content.split(" ", 1)[0] not in _ZERO_SIZE_DIRECTIVES:
+				return None
+			index += 1
+		return None
+
+	def block_cycles(self, start: int) -> tuple[int, int]:
+		"""
+		Returns the fewest and most cycles the code from start takes to leave its straight-line block.
+		"""
+		fewest, most = None, 0
+		total_min = total_max = 0
+		index = start
+		while index < len(self.instructions):
+			if index != start and self.positions[index] in self.label_starts:
+				break
+			instruction = self.instructions[index]
+			if instruction is None:
+				if self.parser.token_list[index].content.split(" ", 1)[0] not in _ZERO_SIZE_DIRECTIVES:
+					break
+				index += 1
+				continue
+			if index in self.branches:
+				taken_cycles = self.branches[index][1]
+				fewest = total_min + taken_cycles if fewest is None else min(fewest, total_min + taken_cycles)
+				most = max(most, total_max + taken_cycles)
+				total_min += 2
+				total_max += 2
+			else:
+				cycles = base_cycles(instruction.mnemonic, instruction.addr_mode)
+				total_min += cycles
+				total_max += cycles + self.page_cycles.get(index, 0)
+				if instruction.mnemonic in ("JMP", "RTS", "RTI", "BRK"):
+					break
+			index += 1
+		return total_min if fewest is None else min(fewest, total_min), max(most, total_max)
+
+	def worst_case(self, start: int) -> int:
+		"""
+		Returns the most cycles the code from start can take to reach an RTS or RTI, counting the whole of each call
+		on the way. A loop bounded with .LOOPS counts all but its last time around at its first instruction, and is
+		then followed as if its branch back weren't taken. Raises ValueError if it can loop without a bound, or reaches
+		something that can't be followed.
+		"""
+		stack = [start]
+		path: set[int] = set()  # Indexes whose successors are still being worked out
+		try:
+			self.check_entry(None, start)
+			while stack:
+				index = stack[-1]
+				if index in self.bounds:
+					stack.pop()
+					continue
+				if index in self.unbounded:
+					raise ValueError(self.unbounded[index])
+				choices = self.successors(index)
+				for _, afters in choices:
+					for after in afters:
+						self.check_entry(index, after)
+				pending = [after for _, afters in choices for after in afters if after not in self.bounds]
+				if not pending:
+					self.bounds[index] = self.loop_cycles(index) + max(
+						cycles + sum(self.bounds[after] for after in afters) for cycles, afters in choices)
+					path.discard(index)
+					stack.pop()
+					continue
+				path.add(index)
+				for after in pending:
+					if after in path:
+						raise ValueError(f"it can loop back to line {self.parser.token_list[after].line_no}")
+				stack.extend(pending)
+		except ValueError as error:
+			for index in path.union((stack[-1],)):
+				self.unbounded[index] = str(error)
+			raise
+		return self.bounds[start]
+
+	def check_entry(self, index: Union[int, None], after: int) -> None:
+		"""
+		Raises ValueError if going from index to after, or starting at after if index is None, enters a bounded loop
+		anywhere but its first instruction, where the rest of its iterations are counted.
+		"""
+		for first, branch in self.loops:
+			if first < after <= branch and (index is None or not first <= index <= branch):
+				raise ValueError(
+					f"it enters the loop ending on line {self.parser.token_list[branch].line_no} after its first "
+					f"instruction, on line {self.parser.token_list[after].line_no}")
+
+	def loop_cycles(self, index: int, inside: Union[int, None] = None) -> int:
+		"""
+		Returns the cycles of the extra iterations of the bounded loops that start at index, or of only those inside
+		the one whose branch back is at index inside.
+		"""
+		cycles = 0
+		for first, branch in self.loops:
+			if first == index and (inside is None or branch < inside):
+				trip = self.trip_cycles(first, branch)
+				if trip is not None:
+					cycles += (self.parser.loop_bounds[branch][0] - 1) * trip
+		return cycles
+
+	def trip_cycles(self, first: int, branch: int) -> Union[int, None]:
+		"""
+		Returns the most cycles one time around a bounded loop takes, from its first instruction through taking its
+		branch back, or None if nothing in it gets back to the branch. Code that leaves the loop is followed elsewhere.
+		"""
+		if branch in self.trips:
+			if self.trips[branch] == -1:
+				raise ValueError(f"the loop ending on line {self.parser.token_list[branch].line_no} calls itself")
+			return self.trips[branch]
+		self.trips[branch] = -1  # Being worked out
+		to_branch: dict[int, Union[int, None, ValueError]] = {branch: self.branches[branch][1]}
+		for index in range(branch - 1, first - 1, -1):
+			try:
+				most = None
+				for cycles, afters in self.successors(index):
+					if not afters:
+						continue  # A return, which leaves the loop
+					for after in afters:
+						self.check_entry(index, after)
+					after = afters[-1]  # Any others are routines called on the way
+					if not first <= after <= branch:
+						continue
+					if after <= index:
+						raise ValueError(f"it can loop back to line {self.parser.token_list[after].line_no}")
+					rest = to_branch.get(after)
+					if isinstance(rest, ValueError):
+						raise rest
+					if rest is not None:
+						trip = cycles + sum(self.worst_case(call) for call in afters[:-1]) + rest
+						most = trip if most is None else max(most, trip)
+				if most is not None:
+					most += self.loop_cycles(index, branch if index == first else None)
+				to_branch[index] = most
+			except ValueError as error:
+				to_branch[index] = error  # Only matters if the loop can get here
+		trip = to_branch[first]
+		if isinstance(trip, ValueError):
+			del self.trips[branch]
+			raise trip
+		self.trips[branch] = trip
+		return trip
+
+	def successors(self, index: int) -> list[tuple[int, tuple[int, ...]]]:
+		"""
+		Returns the ways on from an instruction, each as the cycles it takes that way and the indexes whose worst cases
+		add to it: the next instruction, a branch or jump target, or a called routine and then the next instruction.
+		"""
+		if index >= len(self.instructions):
+			raise ValueError("it runs off the end of the program")
+		instruction = self.instructions[index]
+		token = self.parser.token_list[index]
+		if instruction is None:
+			if token.content.split(" ", 1)[0] in _ZERO_SIZE_DIRECTIVES:
+				return [(0, (index + 1,))]
+			raise ValueError(f"it runs into data on line {token.line_no}")
+		if index in self.branches:
+			target, taken_cycles = self.branches[index]
+			if target is None:
+				raise ValueError(f"[{token.content}] on line {token.line_no} doesn't branch to an instruction")
+			if index in self.parser.loop_bounds:
+				if target > index:
+					raise ValueError(
+						f".LOOPS on line {self.parser.loop_bounds[index][1]} follows a branch that doesn't go back")
+				return [(2, (index + 1,))]  # Its other iterations are counted at the loop's first instruction
+			return [(2, (index + 1,)), (taken_cycles, (target,))]
+		mnemonic = instruction.mnemonic
+		cycles = base_cycles(mnemonic, instruction.addr_mode) + self.page_cycles.get(index, 0)
+		if mnemonic in ("RTS", "RTI"):
+			return [(cycles, ())]
+		if mnemonic == "BRK":
+			raise ValueError(f"BRK on line {token.line_no} goes to the IRQ handler")
+		if mnemonic in ("JMP", "JSR"):
+			label = self.parser.sym_lib.labels.get(instruction.operand) if instruction.addr_mode == "ABSOLUTE" else None
+			target = None if label is None else self.code_at(label.short_addr)
+			if target is None:
+				raise ValueError(f"[{token.content}] on line {token.line_no} doesn't go straight to a label's code")
+			return [(cycles, (target,) if mnemonic == "JMP" else (target, index + 1))]
+		return [(cycles, (index + 1,))]
+
+
+def main() -> None:
+	# iron_assembler imports this module to check budgets, so it can only be imported once both are loaded
+	from iron_assembler import Assembler, find_source_file
+
+	arg_parser = argparse.ArgumentParser(description="Assemble a project and report how many cycles its code takes")
+	arg_parser.add_argument("source", nargs="?", help="source file; defaults to the first .asm/.s in input/")
+	arg_parser.add_argument("--sort", choices=SORT_KEYS, default="address", help="order of the labels")
+	arg_parser.add_argument("--json", help="write the report to this JSON file instead of printing it")
+	args = arg_parser.parse_args()
+
+	assembler = Assembler(args.source or find_source_file())
+	assembler.build()
+	report = analyze(assembler.parser)
+	if args.json:
+		report.write_json(args.json, args.sort)
+	else:
+		print(report.summary(args.sort), file=sys.stderr)
+
+
+if __name__ == "__main__":
+	main()
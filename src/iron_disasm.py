@@ -0,0 +1,254 @@
+"""
+A disassembler for round-trip checking the encoder: its source re-assembles to exactly the bytes it was made from.
+Opcodes are decoded through a flat 256-entry table built from the parser's own instruction and length tables, in a
+linear sweep from the start of the image. Bytes that aren't an instruction the assembler would encode the same way,
+such as unused opcodes, absolute addressing of zero page and branches into the middle of an instruction, come out as
+`.BYTE`. Branch targets get labels, since branch operands can only be labels or forward offsets.
+
+NumPy, if it's installed, classifies every byte of the image at once; without it, the same work is done in plain
+Python, with the same output.
+Run with `python iron_disasm.py <rom.nes | prg.bin> [-o out.asm] [--check]`, or `python iron_disasm.py --fuzz <bytes>`
+to round-trip random bytes.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from typing import Union
+
+try:
+	import numpy
+except ImportError:  # Optional; only makes classifying large images faster
+	numpy = None
+
+import iron_token
+from iron_image import PrgImage
+from iron_parser import Parser
+
+_OPERAND_FORMATS = {
+	"IMPLIED": "", "ACCUMULATOR": " A", "IMMEDIATE": " #${:02X}", "ZERO_PAGE": " ${:02X}", "ZERO_PAGE_X": " ${:02X},X",
+	"ZERO_PAGE_Y": " ${:02X},Y", "ABSOLUTE": " ${:04X}", "ABSOLUTE_X": " ${:04X},X", "ABSOLUTE_Y": " ${:04X},Y",
+	"INDIRECT": " (${:04X})", "X_INDIRECT": " (${:02X},X)", "INDIRECT_Y": " (${:02X}),Y", "RELATIVE": " {}"
+}
+_WORD_MODES = ("ABSOLUTE", "ABSOLUTE_X", "ABSOLUTE_Y")  # Assembled as zero page if their address fits a byte
+_PADDED_MODES = ("X_INDIRECT", "INDIRECT_Y")  # A byte operand, then a zero the parser pads them out with
+_BYTES_PER_LINE = 16
+
+# Opcode to mnemonic, addressing mode and length, or None for the opcodes the assembler has no instruction for
+OPCODE_TABLE: list[Union[tuple[str, str, int], None]] = [None] * 0x100
+for _mnemonic, _modes in Parser._INSTRUCTIONS.items():
+	for _addr_mode, _opcode in _modes.items():
+		OPCODE_TABLE[_opcode] = (_mnemonic, _addr_mode, Parser._ADDR_MODE_LENGTHS[_addr_mode])
+_LENGTHS = [1 if entry is None else entry[2] for entry in OPCODE_TABLE]
+# Whether an opcode's third byte must be zero (True) or not (False) for the assembler to encode it the same way
+_ZERO_THIRD_BYTE: list[Union[bool, None]] = [
+	None if entry is None else True if entry[1] in _PADDED_MODES else False if entry[1] in _WORD_MODES else None
+	for entry in OPCODE_TABLE
+]
+_IS_BRANCH = [entry is not None and entry[1] == "RELATIVE" for entry in OPCODE_TABLE]
+_DATA, _NO_OPERAND, _BYTE_OPERAND, _WORD_OPERAND, _BRANCH = range(5)
+_KINDS = [
+	_DATA if entry is None else _BRANCH if entry[1] == "RELATIVE" else _NO_OPERAND if entry[2] == 1
+	else _BYTE_OPERAND if entry[2] == 2 or entry[1] in _PADDED_MODES else _WORD_OPERAND
+	for entry in OPCODE_TABLE
+]
+_HEX_BYTES = [f"${value:02X}" for value in range(0x100)]
+_TEMPLATES = [
+	None if entry is None else entry[0] + _OPERAND_FORMATS[entry[1]] for entry in OPCODE_TABLE
+]
+
+
+def unit_lengths(data: bytes) -> list[int]:
+	"""
+	Returns, for every offset, the length of the instruction starting there, or 1 if the byte there has to be data.
+	"""
+	if numpy is not None:
+		return _unit_lengths_numpy(data)
+	size = len(data)
+	lengths = [_LENGTHS[opcode] for opcode in data]
+	for pos in range(size):
+		length = lengths[pos]
+		if length == 1:
+			continue
+		zero_third_byte = _ZERO_THIRD_BYTE[data[pos]]
+		if pos + length > size or zero_third_byte is not None and (data[pos + 2] == 0) != zero_third_byte:
+			lengths[pos] = 1
+	return lengths
+
+
+def _unit_lengths_numpy(data: bytes) -> list[int]:
+	opcodes = numpy.frombuffer(data, dtype=numpy.uint8)
+	lengths = numpy.array(_LENGTHS, dtype=numpy.int64)[opcodes]
+	lengths[numpy.arange(len(data)) + lengths > len(data)] = 1
+	third_bytes = numpy.zeros(len(data), dtype=numpy.uint8)
+	third_bytes[:-2] = opcodes[2:]
+	checked = numpy.array([rule is not None for rule in _ZERO_THIRD_BYTE])[opcodes]
+	must_be_zero = numpy.array([rule is True for rule in _ZERO_THIRD_BYTE])[opcodes]
+	lengths[checked & (lengths == 3) & ((third_bytes == 0) != must_be_zero)] = 1
+	return lengths.tolist()
+
+
+def decode(data: bytes) -> tuple[list[int], list[int]]:
+	"""
+	Sweeps data from the start, returning the offset and length of each instruction or data byte. A branch is only
+	kept as an instruction if it lands on the start of another.
+	"""
+	lengths = unit_lengths(data)
+	size = len(data)
+	is_start = bytearray(size)
+	pending = []  # Starts whose branches haven't been checked
+	pos = 0
+	while pos < size:
+		is_start[pos] = 1
+		pending.append(pos)
+		pos += lengths[pos]
+	branches_to: dict[int, list[int]] = {}  # Kept branches by target, to check again if it stops being a start
+	while pending:
+		pos = pending.pop()
+		if not is_start[pos] or lengths[pos] != 2 or not _IS_BRANCH[data[pos]]:
+			continue
+		target = _branch_target(data, pos)
+		if 0 <= target < size and is_start[target]:
+			branches_to.setdefault(target, []).append(pos)
+			continue
+		lengths[pos] = 1
+		# Its operand byte becomes data too, so the sweep goes on from there until it meets a start again, dropping
+		# the starts its new instructions cover
+		run = pos + 1
+		while run < size and not is_start[run]:
+			is_start[run] = 1
+			pending.append(run)
+			end = run + lengths[run]
+			for covered in range(run + 1, min(end, size)):
+				if is_start[covered]:
+					is_start[covered] = 0
+					pending.extend(branches_to.pop(covered, ()))
+			run = end
+	units = [pos for pos, flag in enumerate(is_start) if flag]
+	return units, [lengths[pos] for pos in units]
+
+
+def _branch_target(data: bytes, pos: int) -> int:
+	offset = data[pos + 1]
+	return pos + 2 + offset - (0x100 if offset & 0x80 else 0)
+
+
+def disassemble(data: bytes) -> str:
+	"""
+	Returns source that assembles, from the start of PRG-ROM, back into data.
+	"""
+	units, lengths = decode(data)
+	labels = {
+		_branch_target(data, pos) for pos, length in zip(units, lengths) if length == 2 and _IS_BRANCH[data[pos]]
+	}
+	lines = []
+	append = lines.append
+	data_run: list[str] = []
+	for pos, length in zip(units, lengths):
+		if pos in labels:
+			if data_run:
+				append(".BYTE " + " ".join(data_run))
+				data_run = []
+			append(f"L_{pos:05X}:")
+		opcode = data[pos]
+		kind = _KINDS[opcode] if length == _LENGTHS[opcode] else _DATA
+		if kind == _DATA:
+			data_run.append(_HEX_BYTES[opcode])
+			if len(data_run) == _BYTES_PER_LINE:
+				append(".BYTE " + " ".join(data_run))
+				data_run = []
+			continue
+		if data_run:
+			append(".BYTE " + " ".join(data_run))
+			data_run = []
+		if kind == _NO_OPERAND:
+			append(_TEMPLATES[opcode])
+		elif kind == _BYTE_OPERAND:
+			append(_TEMPLATES[opcode].format(data[pos + 1]))
+		elif kind == _WORD_OPERAND:
+			append(_TEMPLATES[opcode].format(data[pos + 1] | data[pos + 2] << 8))
+		else:
+			append(_TEMPLATES[opcode].format(f"L_{_branch_target(data, pos):05X}"))
+	if data_run:
+		append(".BYTE " + " ".join(data_run))
+	append("")
+	return "\n".join(lines)
+
+
+def round_trip(data: bytes) -> Union[int, None]:
+	"""
+	Disassembles data, assembles the source again, and returns the offset of the first byte that came out different,
+	or None if they're all the same.
+	"""
+	source = disassemble(data)
+	prg_image = PrgImage(len(data))
+	Parser(iron_token.lex_source(source.encode(iron_token.SOURCE_ENCODING)), prg_image)
+	reassembled = prg_image.materialize()
+	if reassembled == data:
+		return None
+	return next(pos for pos in range(len(data)) if reassembled[pos] != data[pos])
+
+
+def read_prg(file_path: str) -> bytes:
+	"""
+	Reads the PRG-ROM out of an iNES file, or the whole of any other file.
+	"""
+	with open(file_path, mode="rb") as rom_file:
+		content = rom_file.read()
+	if content[:4] != b"NES\x1a":
+		return content
+	prg_size = content[4] * 0x4000
+	if content[7] & 0x0C == 0x08 and content[9] & 0x0F == 0x0F:  # NES 2.0 exponent and multiplier, in byte 4
+		prg_size = 2 ** (content[4] >> 2) * ((content[4] & 3) * 2 + 1)
+	elif content[7] & 0x0C == 0x08:  # NES 2.0 keeps the high bits of the bank count in byte 9
+		prg_size = (content[4] | (content[9] & 0x0F) << 8) * 0x4000
+	prg_start = 16 + (512 if content[6] & 0x04 else 0)
+	if prg_start + prg_size > len(content):
+		raise ValueError(f"{file_path} is shorter than the {prg_size:#x} bytes of PRG-ROM its header gives")
+	return content[prg_start:prg_start + prg_size]
+
+
+def main() -> None:
+	arg_parser = argparse.ArgumentParser(description="Disassemble PRG-ROM into source that assembles back into it")
+	arg_parser.add_argument("rom", nargs="?", help="an iNES ROM, or a raw PRG-ROM image")
+	arg_parser.add_argument("-o", "--output", help="write the source to this file instead of stdout")
+	arg_parser.add_argument("--check", action="store_true", help="assemble the source again and compare the bytes")
+	arg_parser.add_argument("--fuzz", type=int, metavar="BYTES", help="round-trip this many random bytes instead")
+	arg_parser.add_argument("--seed", type=int, help="seed for --fuzz")
+	args = arg_parser.parse_args()
+	if (args.rom is None) == (args.fuzz is None):
+		arg_parser.error("give either a ROM or --fuzz")
+
+	if args.fuzz is not None:
+		seed = random.randrange(2 ** 32) if args.seed is None else args.seed
+		data = random.Random(seed).randbytes(args.fuzz)
+		start = time.perf_counter()
+		units, _ = decode(data)
+		seconds = time.perf_counter() - start
+		mismatch = round_trip(data)
+		print(f"Seed {seed}: decoded {len(units):,} instruction(s) and data byte(s) at "
+			  f"{len(units) / max(seconds, 1e-9):,.0f} per second", file=sys.stderr)
+		if mismatch is not None:
+			print(f"Round trip differs at offset {mismatch:#x}", file=sys.stderr)
+			sys.exit(1)
+		print("Round trip matches.", file=sys.stderr)
+		return
+
+	data = read_prg(args.rom)
+	source = disassemble(data)
+	if args.output:
+		with open(args.output, "w", encoding=iron_token.SOURCE_ENCODING) as out_file:
+			out_file.write(source)
+	else:
+		sys.stdout.write(source)
+	if args.check:
+		mismatch = round_trip(data)
+		if mismatch is not None:
+			print(f"{os.path.basename(args.rom)}: round trip differs at offset {mismatch:#x}", file=sys.stderr)
+			sys.exit(1)
+		print(f"{os.path.basename(args.rom)}: round trip matches.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,165 @@
+"""
+Constant expressions in operands and directives, such as `TABLE+1`, `(SCREEN_W*ROW)+COL` or `END-START`.
+Each expression is parsed once into nested closures, with every part that doesn't use a name folded into a constant
+while parsing, so evaluating it again after labels move is a few calls rather than another parse.
+"""
+import operator
+import re
+from typing import Callable, Union
+
+from number_reader import try_read
+
+Lookup = Callable[[str], int]  # Gives the value of a name, or raises NameError
+_Node = Union[int, Callable[[Lookup], int]]
+
+OPERATOR_CHARS = frozenset("+-*/%&|^~()<>")
+_OPERAND = re.compile(
+	r"\s*(?:(\$[0-9A-F_]+|%[01_]+|0X[0-9A-F_]+|0B[01_]+|0D[0-9_]+|[0-9][0-9_]*)|([A-Z_@][A-Z0-9_.@]*)|([-+~(]))")
+_OPERATOR = re.compile(r"\s*(<<|>>|[-+*/%&|^)])")
+
+
+def _divide(left: int, right: int) -> int:
+	if right == 0:
+		raise ValueError("division by zero")
+	return left // right
+
+
+def _modulo(left: int, right: int) -> int:
+	if right == 0:
+		raise ValueError("division by zero")
+	return left % right
+
+
+def _shift_left(left: int, right: int) -> int:
+	if not 0 <= right <= 16:
+		raise ValueError(f"shift by {right}")
+	return left << right
+
+
+def _shift_right(left: int, right: int) -> int:
+	if not 0 <= right <= 16:
+		raise ValueError(f"shift by {right}")
+	return left >> right
+
+
+# Loosest-binding first, as in C
+_BINARY_OPERATORS: dict[str, tuple[int, Callable[[int, int], int]]] = {
+	"|": (1, operator.or_), "^": (2, operator.xor), "&": (3, operator.and_), "<<": (4, _shift_left),
+	">>": (4, _shift_right), "+": (5, operator.add), "-": (5, operator.sub), "*": (6, operator.mul), "/": (6, _divide),
+	"%": (6, _modulo)
+}
+_UNARY_OPERATORS: dict[str, Callable[[int], int]] = {"-": operator.neg, "+": operator.pos, "~": operator.invert}
+
+
+class Expression:
+	"""
+	A compiled expression. `evaluate(lookup)` gives its value, looking up each name it uses with `lookup`. If it uses
+	no names, it's folded to `constant`.
+	"""
+	__slots__ = ("text", "names", "constant", "evaluate")
+
+	def __init__(self, text: str, names: frozenset[str], node: _Node) -> None:
+		self.text = text
+		self.names = names
+		if isinstance(node, int):
+			self.constant: Union[int, None] = node
+			self.evaluate: Callable[[Lookup], int] = lambda lookup: node
+		else:
+			self.constant = None
+			self.evaluate = node
+
+	def word_value(self, lookup: Lookup, byte_select: bool = False) -> int:
+		"""
+		Evaluates to a 16-bit value. A negative value is allowed, as two's complement, only if just one byte of it is
+		used.
+		"""
+		try:
+			value = self.evaluate(lookup)
+		except ValueError as error:
+			raise ValueError(f"Invalid expression {self.text}: {error}") from None
+		if not (0 <= value <= 0xFFFF or byte_select and -0x8000 <= value < 0):
+			raise ValueError(f"Expression {self.text} is {value}, outside $0000-$FFFF")
+		return value & 0xFFFF
+
+
+def compile_expression(text: str) -> Expression:
+	"""
+	Parses an expression of numbers, names, parentheses, unary `-`, `+` and `~`, and the binary operators `*`, `/`,
+	`%`, `+`, `-`, `<<`, `>>`, `&`, `^` and `|`, with C's precedence. Raises ValueError if it's malformed.
+	"""
+	parser = _ExpressionParser(text.strip().upper())
+	node = parser.parse()
+	return Expression(parser.text, frozenset(parser.names), node)
+
+
+class _ExpressionParser:
+	def __init__(self, text: str) -> None:
+		self.text = text
+		self.pos = 0
+		self.names: set[str] = set()
+
+	def parse(self) -> _Node:
+		node = self.binary(1)
+		if self.text[self.pos:].strip():
+			raise self.error(f"unexpected {self.text[self.pos:].strip()}")
+		return node
+
+	def error(self, problem: str) -> ValueError:
+		return ValueError(f"Invalid expression {self.text}: {problem}")
+
+	def binary(self, min_precedence: int) -> _Node:
+		left = self.unary()
+		while True:
+			match = _OPERATOR.match(self.text, self.pos)
+			if match is None or match.group(1) == ")":
+				return left
+			precedence, function = _BINARY_OPERATORS[match.group(1)]
+			if precedence < min_precedence:
+				return left
+			self.pos = match.end()
+			right = self.binary(precedence + 1)
+			try:
+				left = _combine(function, left, right)
+			except ValueError as error:
+				raise self.error(str(error)) from None
+
+	def unary(self) -> _Node:
+		match = _OPERAND.match(self.text, self.pos)
+		if match is None:
+			rest = self.text[self.pos:].strip()
+			raise self.error(f"expected a number or name before {rest}" if rest else "ends with an operator")
+		self.pos = match.end()
+		number, name, prefix = match.groups()
+		if number:
+			value = try_read(number)
+			if value is None:
+				raise ValueError(f"Could not parse number {number}")
+			return value
+		if name:
+			self.names.add(name)
+			return lambda lookup: lookup(name)
+		if prefix == "(":
+			node = self.binary(1)
+			match = _OPERATOR.match(self.text, self.pos)
+			if match is None or match.group(1) != ")":
+				raise self.error("missing )")
+			self.pos = match.end()
+			return node
+		function = _UNARY_OPERATORS[prefix]
+		node = self.unary()
+		if isinstance(node, int):
+			return function(node)
+		return lambda lookup: function(node(lookup))
+
+
+def _combine(function: Callable[[int, int], int], left: _Node, right: _Node) -> _Node:
+	"""
+	Joins two operands with a binary operator, folding them if both are constant.
+	"""
+	if isinstance(left, int):
+		if isinstance(right, int):
+			return function(left, right)
+		return lambda lookup: function(left, right(lookup))
+	if isinstance(right, int):
+		return lambda lookup: function(left(lookup), right)
+	return lambda lookup: function(left(lookup), right(lookup))
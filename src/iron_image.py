@@ -0,0 +1,88 @@
+from typing import Iterator
+
+_FILL_BLOCK_SIZE = 1 << 16
+
+
+class PrgImage:
+	"""
+	A preallocated PRG-ROM buffer that the parser writes into directly through a memoryview cursor.
+	Regions skipped over by .PAD or .BANK, and whatever is left unused at the end, are only recorded as fill extents;
+	they are materialized with the fill byte when the image is written out.
+	"""
+
+	def __init__(self, size: int, fill_byte: int = 0, bank_size: int = 0x4000) -> None:
+		self.size = size
+		self.fill_byte = fill_byte
+		self.bank_size = bank_size
+		self.buffer = bytearray(size)
+		self.view = memoryview(self.buffer)
+		self.cursor = 0
+		self.fill_extents: list[tuple[int, int]] = []
+
+	def write(self, raw_bytes: bytes) -> None:
+		end = self.cursor + len(raw_bytes)
+		if end > self.size:
+			raise ValueError(
+				f"PRG-ROM overflow: writing {len(raw_bytes)} byte(s) at {self.cursor:#x} exceeds the PRG size of "
+				f"{self.size:#x} bytes.")
+		self.view[self.cursor:end] = raw_bytes
+		self.cursor = end
+
+	def seek(self, pos: int) -> None:
+		"""
+		Moves the cursor without recording a fill extent, for patching bytes that have already been written.
+		"""
+		if not 0 <= pos <= self.size:
+			raise ValueError(f"Position {pos:#x} is outside the PRG size of {self.size:#x} bytes.")
+		self.cursor = pos
+
+	def skip_to(self, target_pos: int) -> None:
+		if target_pos < self.cursor:
+			raise ValueError(f"Can't pad backwards from {self.cursor:#x} to {target_pos:#x}.")
+		if target_pos > self.size:
+			raise ValueError(
+				f"PRG-ROM overflow: padding to {target_pos:#x} exceeds the PRG size of {self.size:#x} bytes.")
+		if target_pos > self.cursor:
+			self.fill_extents.append((self.cursor, target_pos))
+		self.cursor = target_pos
+
+	def all_fill_extents(self) -> list[tuple[int, int]]:
+		"""
+		Returns the recorded fill extents plus the unused tail, in order.
+		"""
+		if self.cursor < self.size:
+			return self.fill_extents + [(self.cursor, self.size)]
+		return list(self.fill_extents)
+
+	def chunks(self) -> Iterator[memoryview]:
+		"""
+		Yields the image front to back as views over the buffer, substituting the fill byte for every fill extent.
+		"""
+		if self.fill_byte == 0:  # The buffer starts zeroed, so the fill extents are already in place
+			yield self.view
+			return
+		fill_block = memoryview(bytes([self.fill_byte]) * min(_FILL_BLOCK_SIZE, self.size))
+		pos = 0
+		for start, end in self.all_fill_extents():
+			if start > pos:
+				yield self.view[pos:start]
+			while start < end:
+				step = min(end - start, len(fill_block))
+				yield fill_block[:step]
+				start += step
+			pos = end
+		if pos < self.size:
+			yield self.view[pos:]
+
+	def materialize(self) -> bytearray:
+		"""
+		Writes the fill byte into every fill extent in place and returns the finished buffer.
+		"""
+		if self.fill_byte != 0:
+			fill_block = memoryview(bytes([self.fill_byte]) * min(_FILL_BLOCK_SIZE, self.size))
+			for start, end in self.all_fill_extents():
+				while start < end:
+					step = min(end - start, len(fill_block))
+					self.view[start:start + step] = fill_block[:step]
+					start += step
+		return self.buffer
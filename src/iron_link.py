@@ -0,0 +1,461 @@
+"""
+Separate compilation: assembles each source module into a relocatable object file, then links the objects into a ROM.
+Run with `python iron_link.py [module.asm ...] [--input-dir input] [--output-dir output] [-j N]`. With no modules
+given, every .asm/.s file in the input directory is a module, in name order. Modules are placed in PRG-ROM in order.
+
+Objects are cached in output/obj/ by the hash of their source and of every file they include, so a module that hasn't
+changed costs only reading its object back, and rebuilding an unchanged project is just a link.
+
+Inside a module, names resolve as usual. Names the module doesn't define are imported from the other modules' labels
+and symbols at link time, and are taken to be addresses, so they get absolute rather than zero page addressing. Labels
+starting with @ (such as macro-local labels) stay private to their module. A module may start with
+`.BANK <number> [address]` to be placed at the start of that bank; otherwise it follows the previous module. `.PAD`
+offsets are relative to the start of the module.
+"""
+import argparse
+import hashlib
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Union
+
+import iron_token
+from iron_assembler import Assembler, VirtualCartridge
+from iron_image import PrgImage
+from iron_output import atomic_output, write_all
+from iron_parser import Label, Operand, Parser, Symbol_Library
+from iron_token import Token
+
+OBJECT_MAGIC = b"I65OBJ\x01"  # The last byte is the format version
+_HASH_SIZE = 32
+_DATA_DIRECTIVES = (".B", ".BYTE", ".BYTES", ".W", ".WORD", ".WORDS")
+_WORD_DIRECTIVES = (".W", ".WORD", ".WORDS")
+_IMPORTED = Label("IMPORTED:", 0, 0xFFFF)  # Stands in for imports while compiling; never a zero page address
+
+
+def _hash(data: bytes) -> bytes:
+	return hashlib.blake2b(data, digest_size=_HASH_SIZE).digest()
+
+
+def _hash_file(file_path: str) -> bytes:
+	try:
+		with open(file_path, mode="rb") as infile:
+			return _hash(infile.read())
+	except OSError:
+		return b""
+
+
+class Relocation:
+	__slots__ = ("offset", "size", "operand")
+
+	def __init__(self, offset: int, size: int, operand: str) -> None:
+		self.offset = offset  # Within the module's code
+		self.size = size  # 1 or 2 bytes
+		self.operand = operand  # Operand text, including any byte select
+
+
+class ObjectModule:
+	"""
+	One assembled module: its code with zeroes where relocations go, its labels by offset, its symbols, and what the
+	linker needs to place it.
+	"""
+
+	def __init__(self, name: str, source_hash: bytes) -> None:
+		self.name = name  # The source path, for messages
+		self.source_hash = source_hash
+		self.dependencies: dict[str, bytes] = {}  # Hash of every file pulled in by .INCLUDE or .INCBIN
+		self.config: list[str] = []
+		self.bank: Union[tuple[int, int], None] = None  # Bank number and load address, if the module starts with .BANK
+		self.code = b""
+		self.fill_extents: list[tuple[int, int]] = []
+		self.labels: dict[str, int] = {}
+		self.symbols: dict[str, int] = {}
+		self.relocations: list[Relocation] = []
+
+	def is_current(self, source_hash: bytes) -> bool:
+		return source_hash == self.source_hash and all(
+			_hash_file(path) == file_hash for path, file_hash in self.dependencies.items())
+
+	def to_bytes(self) -> bytes:
+		writer = _ObjectWriter()
+		writer.parts.append(OBJECT_MAGIC + self.source_hash)
+		writer.string(self.name)
+		writer.uint(len(self.dependencies), 2)
+		for path, file_hash in self.dependencies.items():
+			writer.string(path)
+			writer.blob(file_hash, 1)
+		writer.uint(len(self.config), 2)
+		for line in self.config:
+			writer.string(line)
+		bank, load_addr = self.bank if self.bank is not None else (0xFFFF, 0)
+		writer.uint(bank, 2)
+		writer.uint(load_addr, 2)
+		writer.blob(self.code)
+		writer.uint(len(self.fill_extents), 4)
+		for start, end in self.fill_extents:
+			writer.uint(start, 4)
+			writer.uint(end, 4)
+		for table in (self.labels, self.symbols):
+			writer.uint(len(table), 4)
+			for name, value in table.items():
+				writer.string(name)
+				writer.uint(value, 4)
+		writer.uint(len(self.relocations), 4)
+		for relocation in self.relocations:
+			writer.uint(relocation.offset, 4)
+			writer.uint(relocation.size, 1)
+			writer.string(relocation.operand)
+		return b"".join(writer.parts)
+
+	@classmethod
+	def from_bytes(cls, data: bytes) -> "ObjectModule":
+		reader = _ObjectReader(data)
+		if reader.take(len(OBJECT_MAGIC)) != OBJECT_MAGIC:
+			raise ValueError("Not an object file, or one from a different version")
+		source_hash = reader.take(_HASH_SIZE)
+		obj = cls(reader.string(), source_hash)
+		for _ in range(reader.uint(2)):
+			path = reader.string()
+			obj.dependencies[path] = reader.blob(1)
+		obj.config = [reader.string() for _ in range(reader.uint(2))]
+		bank, load_addr = reader.uint(2), reader.uint(2)
+		obj.bank = (bank, load_addr) if bank != 0xFFFF else None
+		obj.code = reader.blob()
+		obj.fill_extents = [(reader.uint(4), reader.uint(4)) for _ in range(reader.uint(4))]
+		for table in (obj.labels, obj.symbols):
+			for _ in range(reader.uint(4)):
+				name = reader.string()
+				table[name] = reader.uint(4)
+		obj.relocations = [Relocation(reader.uint(4), reader.uint(1), reader.string()) for _ in range(reader.uint(4))]
+		return obj
+
+
+class _ObjectWriter:
+	def __init__(self) -> None:
+		self.parts: list[bytes] = []
+
+	def uint(self, value: int, size: int) -> None:
+		self.parts.append(value.to_bytes(size, "little"))
+
+	def blob(self, data: bytes, length_size: int = 4) -> None:
+		self.uint(len(data), length_size)
+		self.parts.append(data)
+
+	def string(self, text: str) -> None:
+		self.blob(text.encode("utf-8"), 2)
+
+
+class _ObjectReader:
+	def __init__(self, data: bytes) -> None:
+		self.data = data
+		self.pos = 0
+
+	def take(self, size: int) -> bytes:
+		end = self.pos + size
+		if end > len(self.data):
+			raise ValueError("Truncated object file")
+		chunk = self.data[self.pos:end]
+		self.pos = end
+		return chunk
+
+	def uint(self, size: int) -> int:
+		return int.from_bytes(self.take(size), "little")
+
+	def blob(self, length_size: int = 4) -> bytes:
+		return self.take(self.uint(length_size))
+
+	def string(self) -> str:
+		return self.blob(2).decode("utf-8")
+
+
+class ModuleSymbols(Symbol_Library):
+	"""
+	A symbol library for one module, which takes any name the module doesn't define to be an import rather than an
+	error.
+	"""
+
+	def _resolve(self, text: str) -> tuple[int, Union[Label, None], bool]:
+		try:
+			return super()._resolve(text)
+		except NameError:
+			operand = self.classify(text)
+			if operand.select == "^":
+				return 0, _IMPORTED, False
+			if operand.select:
+				return 0xFF, _IMPORTED, False
+			return _IMPORTED.absolute_addr, _IMPORTED, True
+
+	def get_relative(self, current_pos: int, label_name: str) -> bytes:
+		if label_name[0] != ":" and label_name not in self.labels:
+			raise ValueError(
+				f"Branch to {label_name}, which isn't a label in this module; branches can't leave a module")
+		return super().get_relative(current_pos, label_name)
+
+
+class ModuleParser(Parser):
+	"""
+	Assembles one module at offset 0, leaving a zeroed field and a Relocation wherever an operand names a label.
+	"""
+
+	def __init__(self, token_list: list[Token]) -> None:
+		super().__init__(token_list, PrgImage(0), parse=False, workers=1)
+		self.sym_lib = ModuleSymbols()
+		self.bank: Union[tuple[int, int], None] = None
+		self.relocations: list[Relocation] = []
+		self.parse_symbols()
+		self.parse_placement()
+		self.parse_labels()
+		self.sym_lib.clear_caches(labels_only=True)  # Forget stand-ins for labels that were referenced before declared
+		self.prg_image = PrgImage(self.end_pos)
+		self.parse_opcodes_and_raws()
+
+	def parse_placement(self) -> None:
+		"""
+		Takes a `.BANK <number> [address]` at the start of the module as where to place it. The linker places modules,
+		so .BANK anywhere else, and .ORG, aren't allowed.
+		"""
+		first = next((index for index, token in enumerate(self.token_list) if token.type != "LABEL"), None)
+		if first is not None and self.token_list[first].content.startswith(".BANK "):
+			args = self.token_list.pop(first).content.split(" ")
+			if not 2 <= len(args) <= 3:
+				raise ValueError(f"Expected a bank number and optional address in [{' '.join(args)}]")
+			self.bank = (self.sym_lib.get_value(args[1]), self.sym_lib.get_value(args[2]) if len(args) == 3 else 0x8000)
+		for token in self.token_list:
+			if token.type == "RAW_DATA" and token.content.split(" ", 1)[0] in (".BANK", ".ORG"):
+				raise ValueError(
+					f"[{token.content}] on line {token.line_no}: a module can only start with .BANK, and can't use "
+					f".ORG")
+
+	def pre_encode(self, instruction) -> Union[bytes, None]:
+		if instruction.addr_mode not in ("IMPLIED", "ACCUMULATOR", "RELATIVE") and self.sym_lib.depends_on_labels(
+				instruction.operand):
+			return None
+		return super().pre_encode(instruction)
+
+	def encode_instruction(self, instruction, cursor_pos: int) -> bytes:
+		if (instruction.encoded is None and instruction.addr_mode != "RELATIVE"
+				and self.sym_lib.depends_on_labels(instruction.operand)):
+			select = self.sym_lib.classify(instruction.operand).select
+			size = 1 if select or instruction.length == 2 else 2  # Immediate and zero page operands are a byte
+			self.relocations.append(Relocation(cursor_pos + 1, size, instruction.operand))
+			return instruction.pad(instruction.opcode_byte + bytes(size))
+		return super().encode_instruction(instruction, cursor_pos)
+
+	def emit_token(self, token: Token, instruction) -> None:
+		if token.type == "RAW_DATA":
+			directive, *references = token.content.split(" ")
+			if directive in _DATA_DIRECTIVES and any(map(self.sym_lib.depends_on_labels, references)):
+				is_word = directive in _WORD_DIRECTIVES
+				for reference in references:
+					if self.sym_lib.depends_on_labels(reference):
+						size = 2 if is_word and not self.sym_lib.classify(reference).select else 1
+						self.relocations.append(Relocation(self.prg_image.cursor, size, reference))
+						self.prg_image.write(bytes(2 if is_word else 1))
+					else:
+						super().emit_token(Token(f"{directive} {reference}", token.line_no), None)
+				return
+		super().emit_token(token, instruction)
+
+
+def compile_module(source_path: str, input_dir: str = "input") -> ObjectModule:
+	with open(source_path, mode="rb") as source_file:
+		source = source_file.read()
+	obj = ObjectModule(source_path, _hash(source))
+	assembler = Assembler(source_path, input_dir)
+	obj.config, tokens = assembler.lex_tokens(iron_token.lex_source(source))
+	obj.dependencies = {path: _hash_file(path) for path in assembler.included_files}
+	parser = ModuleParser(tokens)
+	obj.bank = parser.bank
+	obj.code = bytes(parser.prg_image.buffer)
+	obj.fill_extents = list(parser.prg_image.fill_extents)
+	obj.labels = {name: label.short_addr for name, label in parser.sym_lib.labels.items()}
+	obj.symbols = {name: symbol.value for name, symbol in parser.sym_lib.symbols.items()}
+	obj.relocations = parser.relocations
+	return obj
+
+
+class _Placement:
+	def __init__(self, start: int, segment_start: int, segment_addr: Union[int, None]) -> None:
+		self.start = start
+		self.segment_start = segment_start
+		self.segment_addr = segment_addr  # None until the first .BANK, while code shares one 32 KiB window at $8000
+
+	def address(self, offset: int) -> int:
+		if self.segment_addr is None:
+			return 0x8000 + ((self.start + offset) & 0x7FFF)
+		return self.segment_addr + self.start + offset - self.segment_start
+
+
+def place_modules(objects: list[ObjectModule], bank_size: int) -> list[_Placement]:
+	placements = []
+	pos = segment_start = 0
+	segment_addr = bank_end = None
+	for obj in objects:
+		if obj.bank is not None:
+			bank, segment_addr = obj.bank
+			bank_start = bank * bank_size
+			if bank_start < pos:
+				raise ValueError(
+					f"{obj.name} goes in bank {bank}, at PRG offset {bank_start:#x}, but earlier modules already run "
+					f"to {pos:#x}")
+			if segment_addr + bank_size > 0x10000:
+				raise ValueError(f"A ${bank_size:X}-byte bank can't load at ${segment_addr:X}, in {obj.name}")
+			pos = segment_start = bank_start
+			bank_end = bank_start + bank_size
+		placements.append(_Placement(pos, segment_start, segment_addr))
+		pos += len(obj.code)
+		if bank_end is not None and pos > bank_end:
+			raise ValueError(
+				f"Bank {(bank_end - 1) // bank_size} overflows its ${bank_size:X} bytes by {pos - bank_end}, in "
+				f"{obj.name}")
+	return placements
+
+
+def link(objects: list[ObjectModule], cart: VirtualCartridge) -> None:
+	"""
+	Configures the cartridge from every module's config lines, places the modules in order, copies their code into the
+	PRG image and fills in every relocation.
+	"""
+	cart.config_cart([line for obj in objects for line in obj.config])
+	cart.initialize_prg()
+	prg_image = cart.prg_image
+	placements = place_modules(objects, prg_image.bank_size)
+
+	labels: dict[str, tuple[int, int, str]] = {}  # Address, bank and module of each exported label
+	symbols: dict[str, Union[int, None]] = {}  # None if modules disagree on the value
+	for obj, placement in zip(objects, placements):
+		for name, offset in obj.labels.items():
+			if name.startswith("@"):
+				continue
+			if name in labels:
+				raise ValueError(f"Label {name} is declared in both {labels[name][2]} and {obj.name}")
+			labels[name] = (placement.address(offset), (placement.start + offset) // prg_image.bank_size, obj.name)
+		for name, value in obj.symbols.items():
+			symbols[name] = value if symbols.get(name, value) == value else None
+
+	for obj, placement in zip(objects, placements):
+		prg_image.skip_to(placement.start)
+		code = memoryview(obj.code)
+		pos = 0
+		for start, end in obj.fill_extents:
+			prg_image.write(code[pos:start])
+			prg_image.skip_to(placement.start + end)
+			pos = end
+		prg_image.write(code[pos:])
+		for relocation in obj.relocations:
+			value = _relocated_value(relocation, obj, placement, labels, symbols, prg_image.bank_size)
+			field_start = placement.start + relocation.offset
+			prg_image.view[field_start:field_start + relocation.size] = value.to_bytes(relocation.size, "little")
+
+
+def _relocated_value(relocation: Relocation, obj: ObjectModule, placement: _Placement,
+					 labels: dict[str, tuple[int, int, str]], symbols: dict[str, Union[int, None]],
+					 bank_size: int) -> int:
+	operand = Operand(relocation.operand)
+
+	def address(name: str) -> tuple[int, Union[int, None]]:
+		if name in obj.labels:
+			offset = obj.labels[name]
+			return placement.address(offset), (placement.start + offset) // bank_size
+		if name in obj.symbols:
+			return obj.symbols[name], None
+		if name in labels:
+			return labels[name][:2]
+		if symbols.get(name) is not None:
+			return symbols[name], None
+		if name in symbols:
+			raise ValueError(f"Symbol {name}, used in {obj.name}, has different values in different modules")
+		raise ValueError(f"Unknown name {name} in {obj.name}")
+
+	if operand.kind == "expression":
+		value, bank = operand.expression.word_value(lambda name: address(name)[0], operand.select != ""), None
+	else:
+		value, bank = address(operand.name)
+	if operand.select == "<":
+		value &= 0xFF
+	elif operand.select == ">":
+		value >>= 8
+	elif operand.select == "^":
+		if bank is None:
+			raise ValueError(f"Unknown label {operand.name} in {obj.name}")
+		value = bank & 0xFF
+	if value >= 1 << (8 * relocation.size):
+		raise ValueError(
+			f"{relocation.operand} in {obj.name} is ${value:X}, which doesn't fit in {relocation.size} byte(s)")
+	return value
+
+
+def object_path(source_path: str, cache_dir: str) -> str:
+	path_hash = hashlib.blake2b(os.path.abspath(source_path).encode("utf-8"), digest_size=6).hexdigest()
+	return os.path.join(cache_dir, f"{os.path.basename(source_path)}.{path_hash}.o")
+
+
+def load_objects(modules: list[str], input_dir: str, cache_dir: str,
+				 workers: Union[int, None] = None) -> tuple[list[ObjectModule], list[str]]:
+	"""
+	Returns an object for every module, reading cached objects that are still current and compiling the rest, in
+	parallel when there are several. Also returns the modules that had to be compiled.
+	"""
+	objects: list[Union[ObjectModule, None]] = []
+	for module in modules:
+		with open(module, mode="rb") as source_file:
+			source_hash = _hash(source_file.read())
+		try:
+			with open(object_path(module, cache_dir), mode="rb") as object_file:
+				obj = ObjectModule.from_bytes(object_file.read())
+		except (OSError, ValueError):
+			obj = None
+		objects.append(obj if obj is not None and obj.is_current(source_hash) else None)
+
+	stale = [module for module, obj in zip(modules, objects) if obj is None]
+	if len(stale) > 1 and workers != 1:
+		with ProcessPoolExecutor(max_workers=workers) as executor:
+			compiled = list(executor.map(compile_module, stale, [input_dir] * len(stale)))
+	else:
+		compiled = [compile_module(module, input_dir) for module in stale]
+	os.makedirs(cache_dir, exist_ok=True)
+	for obj in compiled:
+		with atomic_output(object_path(obj.name, cache_dir)) as object_file:
+			write_all(object_file, obj.to_bytes())
+	compiled_objects = iter(compiled)
+	return [obj if obj is not None else next(compiled_objects) for obj in objects], stale
+
+
+def build(modules: list[str], input_dir: str = "input", output_dir: str = "output",
+		  cache_dir: Union[str, None] = None, workers: Union[int, None] = None) -> tuple[VirtualCartridge, list[str]]:
+	"""
+	Compiles whatever modules have changed, links them all and saves the ROM. Returns the cartridge and the modules that
+	were compiled.
+	"""
+	objects, compiled = load_objects(modules, input_dir, cache_dir or os.path.join(output_dir, "obj"), workers)
+	cart = VirtualCartridge(modules[0], input_dir, output_dir)
+	link(objects, cart)
+	cart.save()
+	return cart, compiled
+
+
+def find_modules(input_dir: str = "input") -> list[str]:
+	return [input_dir + "/" + file for file in sorted(os.listdir(input_dir)) if file.endswith((".asm", ".s"))]
+
+
+def main() -> None:
+	arg_parser = argparse.ArgumentParser(description="Compile modules to cached objects and link them into a ROM")
+	arg_parser.add_argument("modules", nargs="*", help="source modules, in PRG order; defaults to the input dir's")
+	arg_parser.add_argument("--input-dir", default="input")
+	arg_parser.add_argument("--output-dir", default="output")
+	arg_parser.add_argument("--cache-dir", help="where objects are kept; defaults to obj/ in the output dir")
+	arg_parser.add_argument("-j", "--jobs", type=int, default=None, help="compile processes; defaults to CPU count")
+	args = arg_parser.parse_args()
+
+	modules = args.modules or find_modules(args.input_dir)
+	if not modules:
+		sys.exit(f"No .asm or .s modules in {args.input_dir}/")
+	start = time.perf_counter()
+	cart, compiled = build(modules, args.input_dir, args.output_dir, args.cache_dir, args.jobs)
+	print(f"Compiled {len(compiled)} of {len(modules)} module(s) and linked {cart.output_path()} in "
+		  f"{time.perf_counter() - start:.2f} s.")
+
+
+if __name__ == "__main__":
+	main()
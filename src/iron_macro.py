@@ -0,0 +1,162 @@
+"""
+Macro expansion: `.MACRO`/`.ENDM` definitions with parameters and local labels, and `.REPT`/`.ENDR` blocks, expanded
+lazily as tokens stream from the lexer to the parser.
+Each macro memoizes its expansion per argument tuple, and repeated expansions hand out the same Token objects, so
+expanding a block many times costs a reference per line rather than a new token, and the parser decodes each distinct
+line once.
+"""
+import re
+from typing import Iterable, Iterator
+
+from iron_expr import compile_expression
+from iron_parser import Parser
+from iron_token import Token
+
+_LOCAL_LABEL = re.compile(r"@\w+")
+_REGISTER_NAMES = ("A", "X", "Y")
+_MAX_DEPTH = 64
+
+
+class Macro:
+	def __init__(self, name: str, params: list[str], body: list[Token], line_no: int) -> None:
+		self.name = name
+		self.params = params
+		self.body = body
+		self.line_no = line_no
+		self.param_pattern = re.compile(r"\b(" + "|".join(map(re.escape, params)) + r")\b") if params else None
+		self.expansions: dict[tuple[str, ...], list[tuple[Token, bool]]] = {}
+
+	def expand(self, args: tuple[str, ...]) -> list[tuple[Token, bool]]:
+		"""
+		Returns the body with the arguments substituted, each token paired with whether it mentions a local label.
+		"""
+		expansion = self.expansions.get(args)
+		if expansion is not None:
+			return expansion
+		if len(args) != len(self.params):
+			raise ValueError(
+				f"Macro {self.name} (line {self.line_no}) takes {len(self.params)} argument(s), but was given "
+				f"{len(args)}: {' '.join(args)}")
+		values = dict(zip(self.params, args))
+		expansion = []
+		for token in self.body:
+			if self.param_pattern is not None and self.param_pattern.search(token.content):
+				content = self.param_pattern.sub(lambda match: values[match.group(0)], token.content)
+				token = Token(content, token.line_no)
+			expansion.append((token, "@" in token.content))
+		self.expansions[args] = expansion
+		return expansion
+
+
+class MacroExpander:
+	def __init__(self) -> None:
+		self.macros: dict[str, Macro] = {}
+		self.symbols: dict[str, int] = {}  # Symbols declared so far, for .REPT counts
+		self.expansion_count = 0
+
+	def expand(self, tokens: Iterable[Token], depth: int = 0) -> Iterator[Token]:
+		"""
+		Yields tokens with macro definitions removed and invocations and .REPT blocks expanded in their place.
+		"""
+		tokens = iter(tokens)
+		for token in tokens:
+			if token.type == "RAW_DATA":
+				directive = token.content.split(" ", 1)[0]
+				if directive == ".MACRO":
+					self.define(token, tokens)
+					continue
+				if directive == ".REPT":
+					count = self.rept_count(token)
+					block = Macro(".REPT", [], self.collect_block(token, tokens, ".REPT", ".ENDR"), token.line_no)
+					for _ in range(count):
+						yield from self.invoke(block, (), depth)
+					continue
+				if directive in (".ENDM", ".ENDR"):
+					raise ValueError(f"{directive} on line {token.line_no} has no block to end")
+			elif token.type == "SYMBOL":
+				name, value_text = token.content.split("=", 1)
+				try:
+					self.symbols[name.strip()] = self.evaluate(value_text)
+				except (ValueError, NameError):
+					pass  # Reported by the parser
+			elif token.type == "OPCODE" and self.macros:
+				name, _, rest = token.content.partition(" ")
+				macro = self.macros.get(name)
+				if macro is not None:
+					yield from self.invoke(macro, tuple(rest.split()), depth)
+					continue
+			yield token
+
+	def invoke(self, macro: Macro, args: tuple[str, ...], depth: int) -> Iterator[Token]:
+		if depth >= _MAX_DEPTH:
+			raise ValueError(f"Macros nested more than {_MAX_DEPTH} deep; does {macro.name} invoke itself?")
+		self.expansion_count += 1
+		suffix = f".{self.expansion_count}"  # Makes local labels unique to this expansion
+
+		def body_tokens() -> Iterator[Token]:
+			for token, has_locals in macro.expand(args):
+				if has_locals:
+					token = Token(_LOCAL_LABEL.sub(lambda match: match.group(0) + suffix, token.content), token.line_no)
+				yield token
+
+		yield from self.expand(body_tokens(), depth + 1)
+
+	def define(self, token: Token, tokens: Iterator[Token]) -> None:
+		name, *params = token.content.split()[1:] or [""]
+		if name == "":
+			raise ValueError(f"Missing macro name in [{token.content}] on line {token.line_no}")
+		if "," in token.content:
+			# Arguments are split on spaces only, so that ones like $10,X stay whole; parameters must match
+			raise ValueError(f"Macro parameters are separated by spaces, not commas, in [{token.content}] on line "
+							 f"{token.line_no}")
+		if name in Parser._INSTRUCTIONS:
+			raise ValueError(f"Macro name {name} on line {token.line_no} is an instruction")
+		if name in self.macros:
+			raise ValueError(
+				f"Macro {name} on line {token.line_no} is already defined on line {self.macros[name].line_no}")
+		for param in params:
+			if param in _REGISTER_NAMES or not (param[0].isalpha() or param[0] == "_"):
+				raise ValueError(f"Invalid parameter name {param} for macro {name} on line {token.line_no}")
+		if len(set(params)) != len(params):
+			raise ValueError(f"Repeated parameter name for macro {name} on line {token.line_no}")
+		self.macros[name] = Macro(name, params, self.collect_block(token, tokens, ".MACRO", ".ENDM"), token.line_no)
+
+	@staticmethod
+	def collect_block(token: Token, tokens: Iterator[Token], opener: str, closer: str) -> list[Token]:
+		"""
+		Takes the tokens up to the closer that matches token, counting nested blocks of the same kind.
+		"""
+		body = []
+		nesting = 0
+		for body_token in tokens:
+			directive = body_token.content.split(" ", 1)[0] if body_token.type == "RAW_DATA" else ""
+			if directive == ".MACRO" and opener == ".MACRO":
+				raise ValueError(
+					f"Macro defined on line {body_token.line_no} inside the macro on line {token.line_no}")
+			if directive == opener:
+				nesting += 1
+			elif directive == closer:
+				if nesting == 0:
+					return body
+				nesting -= 1
+			body.append(body_token)
+		raise ValueError(f"{opener} on line {token.line_no} has no matching {closer}")
+
+	def rept_count(self, token: Token) -> int:
+		count_text = token.content.partition(" ")[2]
+		if count_text == "":
+			raise ValueError(f"Expected one repeat count in [{token.content}] on line {token.line_no}")
+		try:
+			return self.evaluate(count_text)
+		except (ValueError, NameError):
+			raise ValueError(f"Repeat count {count_text} on line {token.line_no} isn't a number or an expression of "
+							 f"earlier symbols") from None
+
+	def evaluate(self, text: str) -> int:
+		return compile_expression(text).evaluate(self.symbol_value)
+
+	def symbol_value(self, name: str) -> int:
+		value = self.symbols.get(name)
+		if value is None:
+			raise NameError(f"Unknown name {name}")
+		return value
@@ -0,0 +1,273 @@
+"""
+Peephole optimizer: an opt-in pass between label layout and encoding that rewrites instruction patterns which waste
+cycles or bytes, lays the labels out again, and repeats until nothing more changes.
+Enable it with `python main.py --optimize`, or `Assembler(..., optimize=True)`.
+
+Only straight-line runs of code are looked at. Every label starts a fresh run with nothing known, since it may be
+jumped to from anywhere, and so do the few instructions after inline data, which may hide an entry point (as in the
+`.BYTE $2C` skip trick). The rewrites are:
+
+- tail-call: `JSR x` followed by `RTS` becomes `JMP x`.
+- jmp-to-branch: `JMP label` while a flag's value is known becomes the branch taken on it, if the label is in range,
+  in the same bank or .ORG segment, and on the branch's page, so the branch costs no more cycles than the jump.
+- redundant-load: `LDA m` is dropped when A and the N and Z flags already hold m, right after `LDA m` or a store of A
+  to m. Only RAM addresses (below $0800) known before layout count. Memory is taken not to change between the two, so
+  don't rely on this to reread a value that an interrupt handler writes.
+- redundant-flag: `CLC`, `SEC` or `CLV` is dropped when the flag is already known to have that value.
+"""
+from bisect import bisect_right
+from typing import Union
+
+import iron_cycles
+from iron_parser import Instruction, Label, Parser
+from iron_token import Token
+
+_MAX_PASSES = 16  # After this many, passes only undo branches that no longer fit, so the layout settles
+_RAM_END = 0x0800
+_AFTER_DATA_UNSAFE = 3  # Instructions after inline data that might be entered part-way through it
+_DIRECT_MODES = ("ZERO_PAGE", "ZERO_PAGE_X", "ZERO_PAGE_Y", "ABSOLUTE", "ABSOLUTE_X", "ABSOLUTE_Y")
+_FLAG_SETS = {"CLC": ("C", False), "SEC": ("C", True), "CLV": ("V", False)}
+_BRANCH_FLAGS = {
+	"BCC": ("C", False), "BCS": ("C", True), "BNE": ("Z", False), "BEQ": ("Z", True), "BPL": ("N", False),
+	"BMI": ("N", True), "BVC": ("V", False), "BVS": ("V", True)
+}
+_BRANCH_ON = {condition: mnemonic for mnemonic, condition in _BRANCH_FLAGS.items()}
+_FORGETS_ALL = frozenset(("JMP", "JSR", "RTS", "RTI", "BRK", "PLP"))
+_SETS_NZ = frozenset((
+	"LDA", "LDX", "LDY", "TAX", "TAY", "TXA", "TYA", "TSX", "PLA", "AND", "ORA", "EOR", "ADC", "SBC", "CMP", "CPX",
+	"CPY", "INC", "DEC", "INX", "INY", "DEX", "DEY", "ASL", "LSR", "ROL", "ROR", "BIT"
+))
+_SETS_NZ_FROM_A = frozenset(("LDA", "TXA", "TYA", "PLA", "AND", "ORA", "EOR", "ADC", "SBC"))
+_SETS_C = frozenset(("ADC", "SBC", "CMP", "CPX", "CPY", "ASL", "LSR", "ROL", "ROR"))
+_SETS_V = frozenset(("ADC", "SBC", "BIT"))
+# Leave A, X, Y, memory and the N and Z flags alone
+_KEEPS_A_AND_MEMORY = frozenset(("CLC", "SEC", "CLV", "CLD", "CLI", "SED", "SEI", "NOP", "PHA", "PHP", *_BRANCH_FLAGS))
+
+
+class Rewrite:
+	__slots__ = ("rule", "line_no", "before", "after", "bytes_saved", "cycles_saved")
+
+	def __init__(self, rule: str, line_no: int, before: str, after: str, bytes_saved: int, cycles_saved: int) -> None:
+		self.rule = rule
+		self.line_no = line_no
+		self.before = before
+		self.after = after  # Empty if the instruction was dropped
+		self.bytes_saved = bytes_saved
+		self.cycles_saved = cycles_saved  # Each time the code runs
+
+
+class OptimizationReport:
+	def __init__(self) -> None:
+		self.rewrites: list[Rewrite] = []
+		self.passes = 0
+
+	def bytes_saved(self) -> int:
+		return sum(rewrite.bytes_saved for rewrite in self.rewrites)
+
+	def cycles_saved(self) -> int:
+		return sum(rewrite.cycles_saved for rewrite in self.rewrites)
+
+	def summary(self) -> str:
+		lines = [f"{'line':>6}  {'rule':<15}{'bytes':>6}{'cycles':>8}  rewrite"]
+		for rewrite in sorted(self.rewrites, key=lambda rewrite: rewrite.line_no):
+			lines.append(f"{rewrite.line_no:>6}  {rewrite.rule:<15}{rewrite.bytes_saved:>6}{rewrite.cycles_saved:>8}  "
+						 f"{rewrite.before} -> {rewrite.after or '(removed)'}")
+		lines.append(f"{len(self.rewrites)} rewrite(s) in {self.passes} pass(es) saved {self.bytes_saved()} byte(s), and "
+					 f"{self.cycles_saved()} cycle(s) per run through every rewritten line")
+		return "\n".join(lines)
+
+
+class Optimizer:
+	def __init__(self, parser: Parser) -> None:
+		self.parser = parser
+		self.sym_lib = parser.sym_lib
+		self.report = OptimizationReport()
+		# Branches made from JMPs, with the JMP each replaced, so they can be undone if a later layout puts them out of
+		# range; undone JMPs are left alone from then on
+		self.branches: dict[Token, tuple[Token, Rewrite]] = {}
+		self.kept_jumps: set[Token] = set()
+		self.segment_starts: list[int] = []  # PRG positions of every .BANK and .ORG in the current layout
+		self.flags: dict[str, bool] = {}  # Flags whose value is known
+		self.a_memory: Union[tuple[str, int], None] = None  # Operand whose value A and the N and Z flags hold
+		self.nz_from_a = False  # Whether the N and Z flags reflect A
+
+	def run(self) -> OptimizationReport:
+		"""
+		Rewrites the parser's token list, which must have its symbols parsed but its labels not yet laid out, and
+		leaves it laid out for encoding.
+		"""
+		tokens = self.parser.token_list
+		while True:
+			self.parser.reset_layout(tokens)
+			self.parser.parse_labels()
+			self.report.passes += 1
+			new_tokens = self.rewrite_pass(tokens, self.report.passes < _MAX_PASSES)
+			if new_tokens is None:
+				return self.report
+			tokens = new_tokens
+
+	def rewrite_pass(self, tokens: list[Token], allow_new: bool) -> Union[list[Token], None]:
+		"""
+		Makes one pass over tokens with the current layout, and returns the rewritten tokens, or None if nothing
+		changed.
+		"""
+		parser = self.parser
+		self.segment_starts = [
+			parser.positions[index] for index, token in enumerate(parser.token_list)
+			if token.type == "RAW_DATA" and token.content.split(" ", 1)[0] in (".BANK", ".ORG")
+		]
+		output = []
+		changed = False
+		unsafe = 0
+		index = 0  # Into parser.positions and parser.instructions, which skip labels
+		i = 0
+		self.forget()
+		while i < len(tokens):
+			token = tokens[i]
+			i += 1
+			if token.type == "LABEL":
+				self.forget()
+				output.append(token)
+				continue
+			position, instruction = parser.positions[index], parser.instructions[index]
+			index += 1
+			if instruction is None:
+				self.forget()
+				unsafe = _AFTER_DATA_UNSAFE
+				output.append(token)
+				continue
+			if unsafe:
+				self.forget()
+				unsafe -= 1
+
+			if token in self.branches:
+				jump_token, rewrite = self.branches[token]
+				if not self.branch_fits(position, self.sym_lib.labels[instruction.operand], shrinking=False):
+					del self.branches[token]
+					self.kept_jumps.add(jump_token)
+					self.report.rewrites.remove(rewrite)
+					output.append(jump_token)
+					self.forget()
+					changed = True
+					continue
+
+			rewritten = None
+			if allow_new:
+				rewritten = self.rewrite(token, instruction, position, tokens[i] if i < len(tokens) else None)
+			if rewritten is None:
+				output.append(token)
+				self.step(instruction)
+				continue
+			changed = True
+			new_token, replaces_next = rewritten
+			if new_token is not None:
+				output.append(new_token)
+				self.forget()  # Only jumps are put in
+			if replaces_next:
+				i += 1
+				index += 1
+		return output if changed else None
+
+	def rewrite(self, token: Token, instruction: Instruction, position: int,
+				next_token: Union[Token, None]) -> Union[tuple[Union[Token, None], bool], None]:
+		"""
+		Returns the token to put in place of this one (None to drop it) and whether it replaces the next token too, or
+		None to keep it.
+		"""
+		mnemonic = instruction.mnemonic
+		flag_set = _FLAG_SETS.get(mnemonic)
+		if flag_set is not None and self.flags.get(flag_set[0]) == flag_set[1]:
+			self.record("redundant-flag", token, "", instruction.length,
+						iron_cycles.base_cycles(mnemonic, instruction.addr_mode))
+			return None, False
+		if mnemonic == "LDA" and self.a_memory is not None and self.ram_operand(instruction) == self.a_memory:
+			self.record("redundant-load", token, "", instruction.length,
+						iron_cycles.base_cycles(mnemonic, instruction.addr_mode))
+			return None, False
+		if (mnemonic == "JSR" and next_token is not None and next_token.type == "OPCODE"
+				and next_token.content == "RTS"):
+			jump = Token("JMP" + token.content[3:], token.line_no)
+			rts_cycles = iron_cycles.base_cycles("RTS", "IMPLIED")
+			cycles_saved = iron_cycles.base_cycles("JSR", "ABSOLUTE") + rts_cycles - iron_cycles.base_cycles(
+				"JMP", "ABSOLUTE")
+			rewrite = self.record("tail-call", token, jump.content, 1, cycles_saved)
+			rewrite.before += " / RTS"
+			return jump, True
+		if (mnemonic == "JMP" and instruction.addr_mode == "ABSOLUTE" and self.flags
+				and token not in self.kept_jumps):
+			target = self.sym_lib.labels.get(instruction.operand)
+			if target is None or not self.branch_fits(position, target, shrinking=True):
+				return None
+			branch = Token(f"{_BRANCH_ON[next(iter(self.flags.items()))]} {instruction.operand}", token.line_no)
+			self.branches[branch] = (token, self.record("jmp-to-branch", token, branch.content, 1, 0))
+			return branch, False
+		return None
+
+	def branch_fits(self, position: int, target: Label, shrinking: bool) -> bool:
+		"""
+		Whether a branch at position reaches target without leaving its segment or crossing a page. If shrinking, the
+		branch is replacing a JMP, so code after it will move back a byte.
+		"""
+		target_pos = target.short_addr - (1 if shrinking and target.short_addr > position else 0)
+		if (bisect_right(self.segment_starts, position) != bisect_right(self.segment_starts, target.short_addr)
+				or position >> 15 != target_pos >> 15):
+			return False
+		offset = target_pos - (position + 2)
+		if not -128 <= offset <= 127:
+			return False
+		target_addr = target.absolute_addr - (target.short_addr - target_pos)
+		return (target_addr - offset) >> 8 == target_addr >> 8
+
+	def ram_operand(self, instruction: Instruction) -> Union[tuple[str, int], None]:
+		"""
+		Returns the addressing mode and address of an operand that's a RAM address known before layout, or None.
+		"""
+		if instruction.addr_mode not in _DIRECT_MODES or self.sym_lib.depends_on_labels(instruction.operand):
+			return None
+		address = self.sym_lib.get_value(instruction.operand)
+		return (instruction.addr_mode, address) if address < _RAM_END else None
+
+	def record(self, rule: str, token: Token, after: str, bytes_saved: int, cycles_saved: int) -> Rewrite:
+		rewrite = Rewrite(rule, token.line_no, token.content, after, bytes_saved, cycles_saved)
+		self.report.rewrites.append(rewrite)
+		return rewrite
+
+	def forget(self) -> None:
+		self.flags = {}
+		self.a_memory = None
+		self.nz_from_a = False
+
+	def step(self, instruction: Instruction) -> None:
+		"""
+		Updates what's known after an instruction runs and falls through to the next.
+		"""
+		mnemonic, addr_mode = instruction.mnemonic, instruction.addr_mode
+		if mnemonic in _FORGETS_ALL:
+			self.forget()
+			return
+		branch = _BRANCH_FLAGS.get(mnemonic)
+		if branch is not None:
+			self.flags[branch[0]] = not branch[1]  # Falling through means the branch wasn't taken
+			return
+		flag_set = _FLAG_SETS.get(mnemonic)
+		if flag_set is not None:
+			self.flags[flag_set[0]] = flag_set[1]
+			return
+		if mnemonic in _SETS_C:
+			self.flags.pop("C", None)
+		if mnemonic in _SETS_V:
+			self.flags.pop("V", None)
+		if mnemonic in _SETS_NZ:
+			self.flags.pop("N", None)
+			self.flags.pop("Z", None)
+			self.nz_from_a = mnemonic in _SETS_NZ_FROM_A or addr_mode == "ACCUMULATOR"
+			if addr_mode == "IMMEDIATE" and mnemonic in ("LDA", "LDX", "LDY") and instruction.encoded is not None:
+				value = instruction.encoded[1]
+				self.flags["Z"] = value == 0
+				self.flags["N"] = value >= 0x80
+		if mnemonic == "LDA":
+			self.a_memory = self.ram_operand(instruction)
+		elif mnemonic == "STA":
+			self.a_memory = self.ram_operand(instruction) if self.nz_from_a else None
+		elif mnemonic not in _KEEPS_A_AND_MEMORY:
+			self.a_memory = None
@@ -0,0 +1,105 @@
+"""
+Output helpers for writing ROM images: atomic replacement of the output file, and copying input files into it
+without reading them into memory.
+"""
+import io
+import os
+from contextlib import contextmanager
+from typing import Iterator, Union
+
+_COPY_CHUNK_SIZE = 1 << 20
+_TEMP_NAME_ATTEMPTS = 100
+
+
+@contextmanager
+def atomic_output(file_path: str) -> Iterator[io.FileIO]:
+	"""
+	Opens an unbuffered temporary file next to file_path, and renames it over file_path only once the block finishes
+	without raising; on failure the temporary file is removed and any previous output is left untouched.
+	"""
+	fd, tmp_path = _create_temp_file(os.path.dirname(file_path) or ".")
+	try:
+		with open(fd, mode="wb", buffering=0) as out_file:
+			yield out_file
+		os.replace(tmp_path, file_path)
+	except BaseException:
+		try:
+			os.unlink(tmp_path)
+		except FileNotFoundError:
+			pass
+		raise
+
+
+def _create_temp_file(out_dir: str) -> tuple[int, str]:
+	"""
+	Creates a uniquely named file in out_dir with the mode an ordinary new file would get, leaving the umask to the
+	kernel rather than reading it, which can only be done by changing it.
+	"""
+	flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+	for _ in range(_TEMP_NAME_ATTEMPTS):
+		tmp_path = os.path.join(out_dir, f".{os.urandom(6).hex()}.tmp")
+		try:
+			return os.open(tmp_path, flags, 0o666), tmp_path
+		except FileExistsError:
+			continue
+	raise FileExistsError(f"Couldn't find an unused temporary file name in {out_dir}")
+
+
+def write_all(out_file: io.FileIO, data: Union[bytes, bytearray, memoryview]) -> None:
+	"""
+	Writes a buffer to an unbuffered file without copying it, retrying after short writes.
+	"""
+	view = memoryview(data)
+	while len(view) > 0:
+		written = out_file.write(view)
+		view = view[written:]
+
+
+def copy_file_into(out_file: io.FileIO, src_path: str) -> int:
+	"""
+	Appends the contents of src_path to out_file, in the kernel where the platform allows it (copy_file_range, then
+	sendfile), otherwise in bounded chunks. Returns the number of bytes copied.
+	"""
+	with open(src_path, mode="rb", buffering=0) as src_file:
+		size = os.fstat(src_file.fileno()).st_size
+		copied = _kernel_copy(src_file.fileno(), out_file.fileno(), size)
+		if copied < size:
+			src_file.seek(copied)
+			copied += _chunked_copy(src_file, out_file)
+	return copied
+
+
+def _kernel_copy(in_fd: int, out_fd: int, size: int) -> int:
+	copied = 0
+	if hasattr(os, "copy_file_range"):
+		try:
+			while copied < size:
+				step = os.copy_file_range(in_fd, out_fd, size - copied, copied)
+				if step == 0:
+					return copied
+				copied += step
+			return copied
+		except OSError:
+			pass  # Cross-device or unsupported filesystem; fall through to sendfile
+	if hasattr(os, "sendfile"):
+		try:
+			while copied < size:
+				step = os.sendfile(out_fd, in_fd, copied, size - copied)
+				if step == 0:
+					return copied
+				copied += step
+		except OSError:
+			pass  # e.g. platforms where sendfile only writes to sockets
+	return copied
+
+
+def _chunked_copy(src_file: io.FileIO, out_file: io.FileIO) -> int:
+	buffer = bytearray(_COPY_CHUNK_SIZE)
+	view = memoryview(buffer)
+	copied = 0
+	while True:
+		step = src_file.readinto(buffer)
+		if not step:
+			return copied
+		write_all(out_file, view[:step])
+		copied += step
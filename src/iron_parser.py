@@ -1,6 +1,19 @@
-from number_reader import read
-from iron_token import Token
-import re
+from number_reader import read, try_read
+from iron_expr import OPERATOR_CHARS, Expression, compile_expression
+from iron_token import Token, split_file_argument
+from iron_image import PrgImage
+from typing import Union
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor
+import mmap
+import multiprocessing
+import os
+import sys
+
+_MIN_CHUNK_TOKENS = 2_000  # Below this, forking costs more than encoding serially
+_CHUNKS_PER_WORKER = 4  # More chunks than workers, so a slow chunk doesn't leave the other workers idle
+_worker_parser: Union["Parser", None] = None  # Set only in encoding workers, to the parser they were forked with
 
 
 class Parser:
@@ -89,15 +102,30 @@ class Parser:
         "TXA": {"IMPLIED": 0x8A},
         "TYA": {"IMPLIED": 0x98},
     }
+    _OPCODE_BYTES = {
+        (instruction, addr_mode): opcode.to_bytes(1)
+        for instruction, modes in _INSTRUCTIONS.items() for addr_mode, opcode in modes.items()
+    }
 
-    def __init__(self, token_list: list[Token]):
+    def __init__(self, token_list: list[Token], prg_image: PrgImage, parse: bool = True,
+                 workers: Union[int, None] = None, files: Union[dict[str, bytes], None] = None):
         self.sym_lib = Symbol_Library()
         self.token_list: list[Token] = token_list
-        self.byte_obj_list: list[bytes] = []
+        self.prg_image = prg_image
+        self.instructions: list[Union[Instruction, None]] = []
+        self.positions: list[int] = []  # Start position of each entry in token_list, once labels are parsed
+        self.end_pos = 0  # Where the program ends, once labels are parsed
+        self.segments: list[tuple[int, int]] = []  # PRG position and CPU address of each .BANK and .ORG
+        self.cycle_budgets: list[tuple[str, int, int]] = []  # Label, cycles and line of each .MAXCYCLES
+        self.loop_bounds: dict[int, tuple[int, int]] = {}  # Iterations and line of each .LOOPS, by its branch's index
+        self.workers = workers  # Processes for the second pass; None or 1 encodes serially
+        self.files = files  # In-memory files by normalized path, read by .INCBIN instead of the disk if given
+        self._decode_cache: dict[str, Instruction] = {}
 
-        self.parse_symbols()
-        self.parse_labels()
-        self.parse_opcodes_and_raws()
+        if parse:
+            self.parse_symbols()
+            self.parse_labels()
+            self.parse_opcodes_and_raws()
 
     def parse_symbols(self) -> None:
         sym_dec_list = [token.content for token in self.token_list if token.type == "SYMBOL"]
@@ -110,17 +138,20 @@ class Parser:
             return "IMPLIED", ""
         if split_code[0] in ("BCC", "BCS", "BEQ", "BMI", "BNE", "BPL", "BVC", "BVS"):
             return "RELATIVE", split_code[1]
-        arg = split_code[1].strip().upper()
+        arg = " ".join(split_code[1:]).replace(" ,", ",").replace(", ", ",").upper()  # Expressions may have spaces
         if arg == "A":
             return "ACCUMULATOR", "A"
         if arg[0] == "#":
             return "IMMEDIATE", arg[1:]
-        if re.fullmatch(r"\(.+,X\)", arg):
-            return "X_INDIRECT", arg[1:-3]
-        if re.fullmatch(r"\(.+\),Y", arg):
-            return "INDIRECT_Y", arg[1:-3]
-        if re.fullmatch(r"\(.+\)", arg):
-            return "INDIRECT", arg[1:-1]
+        if arg[0] == "(":
+            # Only parentheses around the whole address make it indirect; (A+B)*2 is just an expression
+            close = _matching_paren(arg)
+            if close == len(arg) - 1 and arg[-3:] == ",X)":
+                return "X_INDIRECT", arg[1:-3]
+            if close == len(arg) - 3 and arg[-2:] == ",Y":
+                return "INDIRECT_Y", arg[1:-3]
+            if close == len(arg) - 1:
+                return "INDIRECT", arg[1:-1]
         if arg[-2:] == ",X":
             val = self.sym_lib.get_value(arg[:-2])
             if 0 <= val <= 0xFF:
@@ -136,161 +167,544 @@ class Parser:
             return "ZERO_PAGE", arg
         return "ABSOLUTE", arg
 
+    def decode_instruction(self, opcode: str) -> "Instruction":
+        """
+        Decodes an opcode line into its mnemonic, addressing mode and operand. Results are memoized by line text, and
+        anything that can't depend on label positions is encoded right away.
+        """
+        instruction = self._decode_cache.get(opcode)
+        if instruction is not None:
+            return instruction
+        mnemonic = opcode.split(" ")[0]
+        addr_mode, argument = self.parse_addr_mode(opcode)
+        opcode_byte = self._OPCODE_BYTES.get((mnemonic, addr_mode))
+        if opcode_byte is None:
+            if mnemonic not in self._INSTRUCTIONS:
+                raise ValueError(f"Unknown instruction {mnemonic} in [{opcode}]")
+            raise ValueError(f"Instruction {mnemonic} has no {addr_mode} addressing mode, in [{opcode}]")
+        instruction = Instruction(mnemonic, addr_mode, argument, opcode_byte, self._ADDR_MODE_LENGTHS[addr_mode])
+        instruction.encoded = self.pre_encode(instruction)
+        self._decode_cache[opcode] = instruction
+        return instruction
+
+    def pre_encode(self, instruction: "Instruction") -> Union[bytes, None]:
+        """
+        Returns the final bytes of an instruction whose operand is a literal or symbol, or None if it has to wait for
+        label layout.
+        """
+        if instruction.addr_mode in ("IMPLIED", "ACCUMULATOR"):
+            return instruction.opcode_byte
+        if instruction.addr_mode == "RELATIVE":
+            try:
+                arg_val = read(instruction.operand)
+            except ValueError:
+                return None
+            return instruction.pad(instruction.opcode_byte + arg_val.to_bytes(length=1, signed=True))
+        if self.sym_lib.depends_on_labels(instruction.operand):
+            return None
+        try:
+            arg_bytes = self.sym_lib.get_bytes(instruction.operand)
+        except (ValueError, NameError):
+            return None
+        return instruction.pad(instruction.opcode_byte + arg_bytes)
+
+    def encode_instruction(self, instruction: "Instruction", cursor_pos: int) -> bytes:
+        if instruction.encoded is not None:
+            return instruction.encoded
+        if instruction.addr_mode == "RELATIVE":
+            arg_bytes = self.sym_lib.get_relative(cursor_pos + 2, instruction.operand)
+        else:
+            arg_bytes = self.sym_lib.get_bytes(instruction.operand)
+        return instruction.pad(instruction.opcode_byte + arg_bytes)
+
     def parse_labels(self) -> None:
         cursor_pos = 0
+        segment_start, segment_addr = 0, None  # Until a .BANK or .ORG, all code shares one 32 KiB window at $8000
+        bank_end = None
+        non_label_tokens = []
+        previous = None
         for token in self.token_list:
+            if token.type != "LABEL":
+                non_label_tokens.append(token)
+                self.positions.append(cursor_pos)
             match token.type:
                 case "LABEL":
-                    self.sym_lib.add_label(token.content, cursor_pos)
+                    if segment_addr is None:
+                        cpu_addr = 0x8000 + (cursor_pos & 0x7FFF)
+                    else:
+                        cpu_addr = segment_addr + cursor_pos - segment_start
+                        if cpu_addr > 0xFFFF:
+                            raise ValueError(f"Label {token.content} is past $FFFF (at ${cpu_addr:X})")
+                    self.sym_lib.add_label(token.content, cursor_pos, cpu_addr, cursor_pos // self.prg_image.bank_size)
                 case "RAW_DATA":
+                    self.instructions.append(None)
                     args = token.content.split(" ")
                     if args[0] in [".B", ".BYTE", ".BYTES"]:
                         cursor_pos += len(args) - 1
                     elif args[0] in [".W", ".WORD", ".WORDS"]:
                         cursor_pos += 2 * (len(args) - 1)
                     elif args[0] == ".PAD":
-                        cursor_pos = read(args[1])
+                        cursor_pos = self.sym_lib.get_value(token.content.partition(" ")[2])
+                    elif args[0] == ".INCBIN":
+                        cursor_pos += self.parse_incbin(token.content)[2]
+                    elif args[0] == ".BANK":
+                        self.check_bank_size(bank_end, cursor_pos)
+                        bank_start, segment_addr = self.parse_bank(token.content)
+                        if bank_start < cursor_pos:
+                            raise ValueError(
+                                f"[{token.content}] starts at PRG offset {bank_start:#x}, but earlier code already "
+                                f"runs to {cursor_pos:#x}")
+                        cursor_pos = segment_start = bank_start
+                        bank_end = bank_start + self.prg_image.bank_size
+                        self.segments.append((segment_start, segment_addr))
+                    elif args[0] == ".ORG":
+                        if len(args) != 2:
+                            raise ValueError(f"Expected one address in [{token.content}]")
+                        segment_start, segment_addr = cursor_pos, self.sym_lib.get_value(args[1])
+                        self.segments.append((segment_start, segment_addr))
+                    elif args[0] == ".MAXCYCLES":
+                        if previous is None or previous.type != "LABEL" or previous.content.startswith(":"):
+                            raise ValueError(f"[{token.content}] on line {token.line_no} must follow a named label")
+                        budget = self.sym_lib.get_value(token.content.partition(" ")[2])
+                        self.cycle_budgets.append((previous.content.split(":")[0], budget, token.line_no))
+                    elif args[0] == ".LOOPS":
+                        branch_index = len(self.instructions) - 2
+                        if (previous is None or previous.type != "OPCODE"
+                                or self.instructions[branch_index].addr_mode != "RELATIVE"):
+                            raise ValueError(f"[{token.content}] on line {token.line_no} must follow a branch")
+                        iterations = self.sym_lib.get_value(token.content.partition(" ")[2])
+                        if iterations < 1:
+                            raise ValueError(f"[{token.content}] on line {token.line_no} needs at least one iteration")
+                        self.loop_bounds[branch_index] = (iterations, token.line_no)
                 case "OPCODE":
-                    addr_mode = self.parse_addr_mode(token.content)[0]
-                    cursor_pos += self._ADDR_MODE_LENGTHS[addr_mode]
-        self.token_list = [token for token in self.token_list if token.type != "LABEL"]
+                    instruction = self.decode_instruction(token.content)
+                    self.instructions.append(instruction)
+                    cursor_pos += instruction.length
+            previous = token
+        self.check_bank_size(bank_end, cursor_pos)
+        self.token_list = non_label_tokens
+        self.end_pos = cursor_pos
+
+    def reset_layout(self, token_list: list[Token]) -> None:
+        """
+        Forgets the label layout, so parse_labels can lay out token_list, labels included, afresh.
+        """
+        self.token_list = token_list
+        self.instructions = []
+        self.positions = []
+        self.end_pos = 0
+        self.segments = []
+        self.cycle_budgets = []
+        self.loop_bounds = {}
+        self.sym_lib.clear_labels()
+        self._decode_cache.clear()  # Addressing modes may have been picked from old label values
+
+    def cpu_address(self, pos: int) -> int:
+        """
+        Returns the CPU address of a PRG position in the current layout.
+        """
+        index = bisect_right(self.segments, pos, key=itemgetter(0))
+        if index == 0:
+            return 0x8000 + (pos & 0x7FFF)
+        segment_start, segment_addr = self.segments[index - 1]
+        return segment_addr + pos - segment_start
+
+    def parse_bank(self, content: str) -> tuple[int, int]:
+        """
+        Returns the PRG offset and CPU load address of a `.BANK <number> [address]` line. Banks load at $8000 unless
+        given an address.
+        """
+        args = content.split(" ")
+        if not 2 <= len(args) <= 3:
+            raise ValueError(f"Expected a bank number and optional address in [{content}]")
+        bank_start = self.sym_lib.get_value(args[1]) * self.prg_image.bank_size
+        load_addr = self.sym_lib.get_value(args[2]) if len(args) == 3 else 0x8000
+        if load_addr + self.prg_image.bank_size > 0x10000:
+            raise ValueError(f"A ${self.prg_image.bank_size:X}-byte bank can't load at ${load_addr:X}, in [{content}]")
+        return bank_start, load_addr
+
+    def check_bank_size(self, bank_end: Union[int, None], cursor_pos: int) -> None:
+        if bank_end is not None and cursor_pos > bank_end:
+            bank = (bank_end - 1) // self.prg_image.bank_size
+            raise ValueError(
+                f"Bank {bank} overflows its ${self.prg_image.bank_size:X} bytes by {cursor_pos - bank_end}")
+
+    def parse_incbin(self, content: str) -> tuple[str, int, int]:
+        """
+        Returns the file, offset and length of an `.INCBIN <file> [offset [length]]` line. The length defaults to the
+        rest of the file.
+        """
+        path, args = split_file_argument(content)
+        if len(args) > 2:
+            raise ValueError(f"Too many arguments in [{content}]")
+        file_size = os.path.getsize(path) if self.files is None else len(self.given_file(path))
+        offset = self.sym_lib.get_value(args[0]) if args else 0
+        length = self.sym_lib.get_value(args[1]) if len(args) == 2 else file_size - offset
+        if offset < 0 or length < 0 or offset + length > file_size:
+            raise ValueError(
+                f"Range ${offset:X} + ${length:X} is outside {path} (${file_size:X} bytes), in [{content}]")
+        return path, offset, length
+
+    def given_file(self, path: str) -> bytes:
+        content = self.files.get(os.path.normpath(path))
+        if content is None:
+            raise FileNotFoundError(f"No file {path} was given")
+        return content
 
     def parse_opcodes_and_raws(self) -> None:
-        cursor_pos = 0
-        for token in self.token_list:
-            if token.type == "RAW_DATA":
-                raw_args = token.content.split(" ")
-                if raw_args[0] in [".B", ".BYTE", ".BYTES"]:
-                    for byte_reference in raw_args[1:]:
-                        cursor_pos += 1
-                        byte = self.sym_lib.get_bytes(byte_reference)
-                        if len(byte) > 1:
-                            raise ValueError(f"Reference {byte_reference} value {byte} too large for BYTE call!")
-                        self.byte_obj_list.append(byte)
-                elif raw_args[0] in [".W", ".WORD", ".WORDS"]:
-                    for word_reference in raw_args[1:]:
-                        cursor_pos += 2
-                        word = self.sym_lib.get_bytes(word_reference)
-                        if len(word) == 1:
-                            word = word + b"\x00"
-                        self.byte_obj_list.append(word)
-                elif raw_args[0] == ".PAD":
-                    target_pos = self.sym_lib.get_value(raw_args[1])
-                    these_bytes = bytes(target_pos - cursor_pos)
-                    self.byte_obj_list.append(these_bytes)
-                    cursor_pos = target_pos
-            elif token.type == "OPCODE":
-                instruction = token.content.split(" ")[0]
-                addr_mode, argument = self.parse_addr_mode(token.content)
-                instruction_byte = self._INSTRUCTIONS[instruction][addr_mode].to_bytes(1)
-                arg_bytes = b""
-                if addr_mode == "RELATIVE":
-                    try:
-                        arg_val = read(token.content.split(" ")[1])
-                        arg_bytes = arg_val.to_bytes(length=1, signed=True)
-                    except ValueError:
-                        arg_bytes = self.sym_lib.get_relative(cursor_pos + 2, token.content.split(" ")[1])
-                elif addr_mode not in ["IMPLIED", "ACCUMULATOR"]:
-                    arg_bytes = self.sym_lib.get_bytes(argument)
-                opc_bytes = instruction_byte + arg_bytes
-                while len(opc_bytes) < self._ADDR_MODE_LENGTHS[addr_mode]:
-                    opc_bytes = opc_bytes + b"\x00"
-                self.byte_obj_list.append(opc_bytes)
-                cursor_pos += len(opc_bytes)
-            else:
-                raise NotImplementedError(
-                    "This state should be unreachable! Contact Eliana because something's broken.")
+        workers = self.encode_workers()
+        ranges = self.chunk_ranges(workers) if workers > 1 else []
+        if len(ranges) > 1:
+            self.encode_in_parallel(ranges, workers)
+            return
+        for token, instruction in zip(self.token_list, self.instructions):
+            self.emit_token(token, instruction)
+
+    def encode_workers(self) -> int:
+        if self.workers is None or "fork" not in multiprocessing.get_all_start_methods():
+            return 1
+        return self.workers
+
+    def chunk_ranges(self, workers: int) -> list[tuple[int, int]]:
+        """
+        Splits token_list into contiguous ranges of about equal length. Any split works, since parse_labels has already
+        fixed where every token starts.
+        """
+        chunk_count = max(1, min(workers * _CHUNKS_PER_WORKER, len(self.token_list) // _MIN_CHUNK_TOKENS))
+        bounds = [len(self.token_list) * i // chunk_count for i in range(chunk_count + 1)]
+        return list(zip(bounds, bounds[1:]))
+
+    def encode_range(self, start: int, end: int) -> tuple[int, bytes, list[tuple[int, int]], int]:
+        """
+        Encodes token_list[start:end] into the PRG image, returning where it starts, the bytes written, the fill
+        extents recorded and where it ends.
+        """
+        prg_image = self.prg_image
+        start_pos = self.positions[start]
+        first_extent = len(prg_image.fill_extents)
+        prg_image.seek(start_pos)
+        for token, instruction in zip(self.token_list[start:end], self.instructions[start:end]):
+            self.emit_token(token, instruction)
+        return (start_pos, bytes(prg_image.view[start_pos:prg_image.cursor]), prg_image.fill_extents[first_extent:],
+                prg_image.cursor)
+
+    def encode_in_parallel(self, ranges: list[tuple[int, int]], workers: int) -> None:
+        """
+        Encodes each range in a forked worker, which inherits the finished label layout and symbol library as a
+        copy-on-write snapshot rather than having them pickled, then copies the results into the PRG image in order.
+        The image and any error are the same as encoding serially: results are collected in token order, so the error
+        raised is the first one in the source.
+        """
+        with ProcessPoolExecutor(max_workers=min(len(ranges), workers), mp_context=multiprocessing.get_context("fork"),
+                                 initializer=_set_worker_parser, initargs=(self,)) as executor:
+            results = list(executor.map(_encode_range_in_worker, ranges))
+        prg_image = self.prg_image
+        for start_pos, encoded, fill_extents, end_pos in results:
+            prg_image.view[start_pos:start_pos + len(encoded)] = encoded
+            prg_image.fill_extents.extend(fill_extents)
+            prg_image.cursor = end_pos
+
+    def emit_token(self, token: Token, instruction: Union["Instruction", None]) -> None:
+        """
+        Encodes one RAW_DATA or OPCODE token into the PRG image at its current cursor.
+        """
+        prg_image = self.prg_image
+        if token.type == "RAW_DATA":
+            raw_args = token.content.split(" ")
+            if raw_args[0] in [".B", ".BYTE", ".BYTES"]:
+                for byte_reference in raw_args[1:]:
+                    byte = self.sym_lib.get_bytes(byte_reference)
+                    if len(byte) > 1:
+                        raise ValueError(f"Reference {byte_reference} value {byte} too large for BYTE call!")
+                    prg_image.write(byte)
+            elif raw_args[0] in [".W", ".WORD", ".WORDS"]:
+                for word_reference in raw_args[1:]:
+                    word = self.sym_lib.get_bytes(word_reference)
+                    if len(word) == 1:
+                        word = word + b"\x00"
+                    prg_image.write(word)
+            elif raw_args[0] == ".PAD":
+                prg_image.skip_to(self.sym_lib.get_value(token.content.partition(" ")[2]))
+            elif raw_args[0] == ".BANK":
+                prg_image.skip_to(self.parse_bank(token.content)[0])
+            elif raw_args[0] == ".INCBIN":
+                path, offset, length = self.parse_incbin(token.content)
+                if self.files is not None:
+                    prg_image.write(memoryview(self.given_file(path))[offset:offset + length])
+                    return
+                if length == 0:
+                    return  # Empty files can't be mapped
+                with open(path, mode="rb") as bin_file:
+                    with mmap.mmap(bin_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                        with memoryview(mapped) as view, view[offset:offset + length] as included:
+                            prg_image.write(included)
+        elif token.type == "OPCODE":
+            prg_image.write(self.encode_instruction(instruction, prg_image.cursor))
+        else:
+            raise NotImplementedError(
+                "This state should be unreachable! Contact Eliana because something's broken.")
+
+
+def _matching_paren(text: str) -> int:
+    """
+    Returns the index of the parenthesis that closes the one text starts with, or -1 if there isn't one.
+    """
+    depth = 0
+    for index, char in enumerate(text):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth == 0:
+                return index
+    return -1
+
+
+def _set_worker_parser(parser: "Parser") -> None:
+    global _worker_parser
+    _worker_parser = parser  # Forked workers inherit initargs as they are, without pickling
+
+
+def _encode_range_in_worker(token_range: tuple[int, int]) -> tuple[int, bytes, list[tuple[int, int]], int]:
+    return _worker_parser.encode_range(*token_range)
+
+
+class Instruction:
+    __slots__ = ("mnemonic", "addr_mode", "operand", "opcode_byte", "length", "encoded")
+
+    def __init__(self, mnemonic: str, addr_mode: str, operand: str, opcode_byte: bytes, length: int) -> None:
+        self.mnemonic = mnemonic
+        self.addr_mode = addr_mode
+        self.operand = operand
+        self.opcode_byte = opcode_byte
+        self.length = length
+        self.encoded: Union[bytes, None] = None
+
+    def pad(self, opc_bytes: bytes) -> bytes:
+        if len(opc_bytes) < self.length:
+            return opc_bytes + bytes(self.length - len(opc_bytes))
+        return opc_bytes
 
 
 class Symbol_Library:
     def __init__(self):
         self.symbols: dict[str, Symbol] = {}
         self.labels: dict[str, Label] = {}
-        self.anon_labels: list[Label] = []
+        self.anon_labels: list[Label] = []  # Kept sorted by position, in step with anon_positions
+        self.anon_positions: list[int] = []
+        self._operands: dict[str, Operand] = {}
+        # Resolved operands; those that depend on a label are kept apart, to be dropped if a label moves
+        self._values: dict[str, int] = {}
+        self._bytes: dict[str, bytes] = {}
+        self._label_values: dict[str, int] = {}
+        self._label_bytes: dict[str, bytes] = {}
 
     def get_relative(self, current_pos: int, label_name: str) -> bytes:
         if label_name[0] == ":":
-            anon_offset = 0
-            for char in label_name[1:]:
-                if char == "-":
-                    anon_offset -= 1
-                elif char == "+":
-                    anon_offset += 1
-                else:
-                    raise ValueError(f"Disallowed character {char} in anonymous label reference!")
+            steps = label_name[1:]
+            bad_chars = steps.replace("+", "").replace("-", "")
+            if bad_chars != "":
+                raise ValueError(f"Disallowed character {bad_chars[0]} in anonymous label reference!")
+            anon_offset = steps.count("+") - steps.count("-")
             if anon_offset > 0:
                 anon_offset -= 1
-            current_anon_region = 0
-            while current_pos > self.anon_labels[current_anon_region].short_addr:
-                current_anon_region += 1
-                if current_anon_region >= len(self.anon_labels):
-                    break
-            target_label = self.anon_labels[current_anon_region + anon_offset]
+            # Index of the first anonymous label at or after current_pos, i.e. the one ":+" refers to
+            current_anon_region = bisect_left(self.anon_positions, current_pos)
+            target_index = current_anon_region + anon_offset
+            if not 0 <= target_index < len(self.anon_labels):
+                direction = "backward" if anon_offset < 0 else "forward"
+                raise ValueError(
+                    f"Anonymous label reference {label_name} at position {current_pos:#06x} has no {direction} "
+                    f"target; only {current_anon_region} anonymous label(s) before it and "
+                    f"{len(self.anon_labels) - current_anon_region} at or after it.")
+            target_label = self.anon_labels[target_index]
         else:
             target_label = self.labels[label_name]
         return (target_label.short_addr - current_pos).to_bytes(length=1, signed=True)
 
     def get_value(self, name: str) -> int:
-        try:
-            return read(name)
-        except ValueError:
-            pass
-        if name in self.symbols:
-            return self.symbols[name].value
-        if name in self.labels:
-            return self.labels[name].absolute_addr
+        value = self._values.get(name)
+        if value is None:
+            value = self._label_values.get(name)
+            if value is None:
+                value, label, is_address = self._resolve(name)
+                if label is None:
+                    self._values[name] = value
+                else:
+                    self._label_values[name] = value
+        return value
+
+    def get_bytes(self, string_val: str) -> bytes:
+        encoded = self._bytes.get(string_val)
+        if encoded is None:
+            encoded = self._label_bytes.get(string_val)
+            if encoded is None:
+                try:
+                    value, label, is_address = self._resolve(string_val)
+                except NameError as error:
+                    if string_val.lstrip()[:1] in ("<", ">", "^"):
+                        raise
+                    raise ValueError(str(error)) from None  # Unknown plain names have always been a ValueError here
+                if value <= 0xFF and not is_address:
+                    encoded = value.to_bytes()
+                else:
+                    encoded = value.to_bytes(2, "little")
+                if label is None:
+                    self._bytes[string_val] = encoded
+                else:
+                    self._label_bytes[string_val] = encoded
+        return encoded
+
+    def classify(self, text: str) -> "Operand":
+        operand = self._operands.get(text)
+        if operand is None:
+            operand = Operand(text)
+            self._operands[sys.intern(text)] = operand
+        return operand
+
+    def _resolve(self, text: str) -> tuple[int, Union["Label", None], bool]:
+        """
+        Resolves an operand to its value, a label it depends on if any, and whether it's a label's address, which is
+        always word-sized. Callers cache the result, apart from others if it depends on a label, so it can be dropped
+        if a label moves.
+        """
+        # Bare names, the commonest case, need no classifying
+        symbol = self.symbols.get(text)
+        if symbol is not None:
+            return symbol.value, None, False
+        label = self.labels.get(text)
+        if label is not None:
+            return label.absolute_addr, label, True
+
+        operand = self.classify(text)
+        if operand.kind == "literal":
+            value = operand.literal
+        elif operand.kind == "malformed":
+            raise ValueError(f"Could not parse number {operand.name}")
+        elif operand.kind == "expression":
+            if operand.select == "^":
+                raise ValueError(f"^ needs a label, not the expression {operand.name}")
+            value = operand.expression.word_value(self.name_value, operand.select != "")
+            label = next((self.labels[name] for name in operand.expression.names if name in self.labels), None)
+        elif operand.name in self.symbols:
+            value = self.symbols[operand.name].value
+        elif operand.name in self.labels:
+            label = self.labels[operand.name]
+            value = label.absolute_addr
+        elif operand.select:
+            raise NameError(f"Unknown reference {operand.name}")
+        else:
+            raise NameError(f"Unknown name {operand.name}")
+
+        if operand.select == "<":
+            value &= 0xFF
+        elif operand.select == ">":
+            value >>= 8
+        elif operand.select == "^":
+            if label is None:
+                raise NameError(f"Unknown label {operand.name}")
+            value = label.bank & 0xFF
+        return value, label, label is not None and not operand.select and operand.kind == "name"
+
+    def name_value(self, name: str) -> int:
+        """
+        Looks up a name used in an expression.
+        """
+        symbol = self.symbols.get(name)
+        if symbol is not None:
+            return symbol.value
+        label = self.labels.get(name)
+        if label is not None:
+            return label.absolute_addr
         raise NameError(f"Unknown name {name}")
 
+    def depends_on_labels(self, text: str) -> bool:
+        """
+        Whether an operand uses any name that isn't a symbol, so its value isn't known until labels are laid out.
+        """
+        operand = self.classify(text)
+        if operand.kind == "name":
+            return operand.name not in self.symbols
+        if operand.kind == "expression":
+            return any(name not in self.symbols for name in operand.expression.names)
+        return False
+
+    def clear_caches(self, labels_only: bool = False) -> None:
+        self._label_values.clear()
+        self._label_bytes.clear()
+        if not labels_only:
+            self._values.clear()
+            self._bytes.clear()
+
+    def clear_labels(self) -> None:
+        self.labels.clear()
+        self.anon_labels.clear()
+        self.anon_positions.clear()
+        self.clear_caches(labels_only=True)
+
     def add_symbols(self, decl_list: list[str]) -> None:
         for i in decl_list:
             self._add_symbol(i)
 
     def _add_symbol(self, declaration: str) -> None:
-        this_symbol = Symbol(declaration)
-        self.symbols[this_symbol.name] = this_symbol
+        value_text = declaration.split("=", 1)[1]
+        value = try_read(value_text)
+        if value is None:
+            # Any other value is an expression of earlier symbols; labels aren't laid out yet
+            try:
+                value = self.get_value(value_text.strip())
+            except NameError as error:
+                raise ValueError(f"{error}, in [{declaration}]; symbols can only use earlier symbols") from None
+        this_symbol = Symbol(declaration, value)
+        self.symbols[sys.intern(this_symbol.name)] = this_symbol
+        self.clear_caches()
 
-    def add_label(self, declaration: str, pos: int) -> None:
-        this_label = Label(declaration, pos)
+    def add_label(self, declaration: str, pos: int, absolute_addr: Union[int, None] = None, bank: int = 0) -> None:
+        this_label = Label(declaration, pos, absolute_addr, bank)
         if this_label.name == "":
-            self.anon_labels.append(this_label)
+            if self.anon_positions and pos < self.anon_positions[-1]:
+                index = bisect_right(self.anon_positions, pos)
+                self.anon_positions.insert(index, pos)
+                self.anon_labels.insert(index, this_label)
+            else:
+                self.anon_positions.append(pos)
+                self.anon_labels.append(this_label)
         else:
-            self.labels[this_label.name] = this_label
+            if this_label.name in self.labels:
+                self.clear_caches(labels_only=True)
+            self.labels[sys.intern(this_label.name)] = this_label
 
-    def get_bytes(self, string_val: str) -> bytes:
-        string_val = string_val.strip().upper()
-        if string_val[0] == "<":
-            if string_val[1:] in self.symbols:
-                return self.symbols[string_val[1:]].get_low_byte()
-            elif string_val[1:] in self.labels:
-                return self.labels[string_val[1:]].get_low_byte()
-            else:
-                raise NameError(f"Unknown reference {string_val[1:]}")
-        elif string_val[0] == ">":
-            if string_val[1:] in self.symbols:
-                return self.symbols[string_val[1:]].get_high_byte()
-            elif string_val[1:] in self.labels:
-                return self.labels[string_val[1:]].get_high_byte()
-            else:
-                raise NameError(f"Unknown reference {string_val[1:]}")
-        elif string_val in self.symbols:
-            this_sym = self.symbols[string_val]
-            if this_sym.byte_sized():
-                return this_sym.get_byte()
-            return this_sym.get_word()
-        elif string_val in self.labels:
-            this_label = self.labels[string_val]
-            return this_label.get_word()
+
+class Operand:
+    """
+    An operand's syntax, worked out once per distinct operand text: an optional `<`, `>` or `^` byte select, then
+    either a literal number, a name, or an expression, which is compiled here.
+    """
+    __slots__ = ("select", "kind", "literal", "name", "expression")
+
+    def __init__(self, text: str) -> None:
+        text = text.strip().upper()
+        self.select = text[0] if text[:1] in ("<", ">", "^") else ""
+        body = text[1:] if self.select else text
+        self.literal = try_read(body)
+        self.expression: Union[Expression, None] = None
+        if self.literal is not None:
+            self.kind = "literal"
+            self.name = ""
+        elif not OPERATOR_CHARS.isdisjoint(body):
+            self.kind = "expression"
+            self.expression = compile_expression(body)
+            self.name = self.expression.text
         else:
-            val = read(string_val)
-            if val > 0xFF:
-                return val.to_bytes(2, "little")
-            return val.to_bytes()
+            # Names start with a letter, underscore or @ (macro-local labels), so anything else is a bad number
+            self.kind = "name" if body[:1].isalpha() or body[:1] in ("_", "@") else "malformed"
+            self.name = sys.intern(body)
 
 
 class Symbol:
-    def __init__(self, declare_str: str) -> None:
-        self.name, val_tmp = declare_str.split("=")
-        self.value = read(val_tmp)
+    def __init__(self, declare_str: str, value: Union[int, None] = None) -> None:
+        self.name, val_tmp = declare_str.split("=", 1)
+        self.value = read(val_tmp) if value is None else value
         self.name = self.name.strip()
 
     def get_low_byte(self) -> bytes:
@@ -310,10 +724,16 @@ class Symbol:
 
 
 class Label:
-    def __init__(self, declare_str: str, pos: int) -> None:
+    def __init__(self, declare_str: str, pos: int, absolute_addr: Union[int, None] = None, bank: int = 0) -> None:
         self.name = declare_str.split(":")[0]
         self.short_addr = pos
-        self.absolute_addr = 0x8000 + (self.short_addr & 0x7FFF)
+        if absolute_addr is None:
+            absolute_addr = 0x8000 + (self.short_addr & 0x7FFF)
+        self.absolute_addr = absolute_addr
+        self.bank = bank
+
+    def get_bank_byte(self) -> bytes:
+        return (self.bank & 0xFF).to_bytes(1)
 
     def get_low_byte(self) -> bytes:
         return (self.absolute_addr & 0xFF).to_bytes(1)
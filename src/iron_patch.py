@@ -0,0 +1,322 @@
+"""
+Delta patches between two builds of a ROM, so a deploy only moves what changed. IPS patches record the bytes that
+differ at the same offset; BPS patches can also copy data from anywhere in the old ROM, so code that only moved
+because something before it grew costs a few bytes rather than all of its length.
+
+Both ROMs are compared a block at a time, and only blocks that differ are looked at byte by byte, so large unchanged
+PRG and CHR regions are skipped quickly. For BPS, the old ROM's blocks are also indexed by content, which is how data
+that moved is found again. The old ROM is mapped into memory rather than read.
+Run with `python iron_patch.py <old.nes> <new.nes> [-o patch] [--format ips|bps]`.
+"""
+import argparse
+import mmap
+import os
+import struct
+import sys
+import zlib
+from contextlib import contextmanager
+from typing import Iterator, Union
+
+from iron_output import atomic_output
+
+Buffer = Union[bytes, bytearray, memoryview, mmap.mmap]
+
+PATCH_FORMATS = ("IPS", "BPS")
+_COMPARE_BLOCK = 0x1000  # Bytes compared at once before narrowing down to the ones that changed
+_INDEX_BLOCK = 16  # Bytes a moved run has to share with the old ROM to be found for a BPS copy
+_MIN_SOURCE_READ = 4  # Shortest same-offset run worth a BPS action of its own
+_IPS_MAX_OFFSET = 0xFFFFFF
+_IPS_MAX_RECORD = 0xFFFF
+_IPS_EOF = 0x454F46  # "EOF", which a record can't start at
+_IPS_MAX_GAP = 5  # Unchanged bytes cheaper to repeat in a record than a new 5-byte record header
+_IPS_MIN_RLE = 9
+_SOURCE_READ, _TARGET_READ, _SOURCE_COPY = range(3)
+
+
+def changed_runs(old: Buffer, new: Buffer) -> list[tuple[int, int]]:
+	"""
+	Returns the start and end of each run of bytes that differ between old and new at the same offset, ending with
+	any bytes new has past the end of old.
+	"""
+	size = min(len(old), len(new))
+	runs: list[tuple[int, int]] = []
+	for start in range(0, size, _COMPARE_BLOCK):
+		end = min(start + _COMPARE_BLOCK, size)
+		if old[start:end] != new[start:end]:
+			_narrow(old, new, start, end, runs)
+	if len(new) > size:
+		_add_run(runs, size, len(new))
+	return runs
+
+
+def _narrow(old: Buffer, new: Buffer, start: int, end: int, runs: list[tuple[int, int]]) -> None:
+	if end - start <= 16:
+		for pos in range(start, end):
+			if old[pos] != new[pos]:
+				_add_run(runs, pos, pos + 1)
+		return
+	middle = (start + end) // 2
+	for half_start, half_end in ((start, middle), (middle, end)):
+		if old[half_start:half_end] != new[half_start:half_end]:
+			_narrow(old, new, half_start, half_end, runs)
+
+
+def _add_run(runs: list[tuple[int, int]], start: int, end: int) -> None:
+	if runs and runs[-1][1] == start:
+		runs[-1] = (runs[-1][0], end)
+	else:
+		runs.append((start, end))
+
+
+def make_ips(old: Buffer, new: Buffer) -> bytes:
+	"""
+	Returns an IPS patch that turns old into new. Raises ValueError if new is too big for IPS offsets.
+	"""
+	if len(new) > _IPS_MAX_OFFSET + 1:
+		raise ValueError(f"IPS patches only reach 16 MiB; the ROM is {len(new)} bytes")
+	records = [b"PATCH"]
+	runs: list[list[int]] = []
+	for start, end in changed_runs(old, new):
+		if runs and start - runs[-1][1] <= _IPS_MAX_GAP:
+			runs[-1][1] = end
+		else:
+			runs.append([start, end])
+	for start, end in runs:
+		while start < end:
+			if start == _IPS_EOF:
+				start -= 1  # Rewrite the byte before it as well instead
+			length = min(end - start, _IPS_MAX_RECORD)
+			data = new[start:start + length]
+			if length >= _IPS_MIN_RLE and data.count(data[:1]) == length:
+				records.append(struct.pack(">BHHHB", start >> 16, start & 0xFFFF, 0, length, data[0]))
+			else:
+				records.append(struct.pack(">BHH", start >> 16, start & 0xFFFF, length))
+				records.append(bytes(data))
+			start += length
+	records.append(b"EOF")
+	if len(new) < len(old):
+		records.append(struct.pack(">BH", len(new) >> 16, len(new) & 0xFFFF))  # Truncate to the new size
+	return b"".join(records)
+
+
+def apply_ips(old: Buffer, patch: Buffer) -> bytes:
+	if patch[:5] != b"PATCH":
+		raise ValueError("Not an IPS patch")
+	out = bytearray(old)
+	pos = 5
+	while patch[pos:pos + 3] != b"EOF":
+		if pos + 5 > len(patch):
+			raise ValueError("IPS patch ends without EOF")
+		offset = int.from_bytes(patch[pos:pos + 3], "big")
+		length = int.from_bytes(patch[pos + 3:pos + 5], "big")
+		pos += 5
+		if length == 0:
+			length = int.from_bytes(patch[pos:pos + 2], "big")
+			data = bytes(patch[pos + 2:pos + 3]) * length
+			pos += 3
+		else:
+			data = bytes(patch[pos:pos + length])
+			pos += length
+		if offset > len(out):
+			out.extend(bytes(offset - len(out)))
+		out[offset:offset + length] = data
+	if len(patch) >= pos + 6:
+		del out[int.from_bytes(patch[pos + 3:pos + 6], "big"):]
+	return bytes(out)
+
+
+def make_bps(old: Buffer, new: Buffer) -> bytes:
+	"""
+	Returns a BPS patch that turns old into new, reading unchanged bytes from the same offset in old and moved ones
+	from wherever they were.
+	"""
+	index: dict[bytes, int] = {}
+	for offset in range(0, len(old) - _INDEX_BLOCK + 1, _INDEX_BLOCK):
+		index.setdefault(old[offset:offset + _INDEX_BLOCK], offset)
+	out = bytearray(b"BPS1")
+	out += _varint(len(old)) + _varint(len(new)) + _varint(0)
+	source_offset = 0  # Where the last copy from old ended, which the next one is relative to
+	literal_start = pos = 0
+	size = len(new)
+	while pos < size:
+		if pos < len(old) and old[pos] == new[pos]:
+			length = _match_length(old, pos, new, pos)
+			if length >= _MIN_SOURCE_READ:
+				_flush_literal(out, new, literal_start, pos)
+				out += _varint((length - 1) << 2 | _SOURCE_READ)
+				pos = literal_start = pos + length
+				continue
+		offset = index.get(new[pos:pos + _INDEX_BLOCK]) if pos + _INDEX_BLOCK <= size else None
+		if offset is not None and offset != pos:
+			length = _match_length(old, offset, new, pos)
+			_flush_literal(out, new, literal_start, pos)
+			relative = offset - source_offset
+			out += _varint((length - 1) << 2 | _SOURCE_COPY) + _varint(abs(relative) << 1 | (relative < 0))
+			source_offset = offset + length
+			pos = literal_start = pos + length
+			continue
+		pos += 1
+	_flush_literal(out, new, literal_start, size)
+	out += struct.pack("<II", zlib.crc32(old), zlib.crc32(new))
+	out += struct.pack("<I", zlib.crc32(out))
+	return bytes(out)
+
+
+def _match_length(a: Buffer, a_pos: int, b: Buffer, b_pos: int) -> int:
+	"""
+	Returns how many bytes match from a_pos in a and b_pos in b, comparing in shrinking steps.
+	"""
+	limit = min(len(a) - a_pos, len(b) - b_pos)
+	length = 0
+	step = _COMPARE_BLOCK
+	while step:
+		while length + step <= limit and (
+				a[a_pos + length:a_pos + length + step] == b[b_pos + length:b_pos + length + step]):
+			length += step
+		step >>= 2
+	return length
+
+
+def _flush_literal(out: bytearray, new: Buffer, start: int, end: int) -> None:
+	if end > start:
+		out += _varint((end - start - 1) << 2 | _TARGET_READ)
+		out += new[start:end]
+
+
+def _varint(value: int) -> bytes:
+	out = bytearray()
+	while True:
+		low = value & 0x7F
+		value >>= 7
+		if value == 0:
+			out.append(0x80 | low)
+			return bytes(out)
+		out.append(low)
+		value -= 1
+
+
+def apply_bps(old: Buffer, patch: Buffer) -> bytes:
+	"""
+	Applies a BPS patch to old, checking the sizes and checksums it records. Raises ValueError if any don't match.
+	"""
+	if patch[:4] != b"BPS1" or len(patch) < 16:
+		raise ValueError("Not a BPS patch")
+	if zlib.crc32(patch[:-4]) != struct.unpack_from("<I", patch, len(patch) - 4)[0]:
+		raise ValueError("BPS patch is corrupt")
+	pos = 4
+	values = []
+	for _ in range(3):
+		value, pos = _read_varint(patch, pos)
+		values.append(value)
+	source_size, target_size, metadata_size = values
+	source_crc, target_crc = struct.unpack_from("<II", patch, len(patch) - 12)
+	if len(old) != source_size or zlib.crc32(old) != source_crc:
+		raise ValueError("BPS patch was made from a different ROM")
+	pos += metadata_size
+	out = bytearray()
+	source_offset = target_offset = 0
+	while pos < len(patch) - 12:
+		action, pos = _read_varint(patch, pos)
+		length = (action >> 2) + 1
+		command = action & 3
+		if command == _SOURCE_READ:
+			out += old[len(out):len(out) + length]
+		elif command == _TARGET_READ:
+			out += patch[pos:pos + length]
+			pos += length
+		else:
+			relative, pos = _read_varint(patch, pos)
+			relative = -(relative >> 1) if relative & 1 else relative >> 1
+			if command == _SOURCE_COPY:
+				source_offset += relative
+				out += old[source_offset:source_offset + length]
+				source_offset += length
+			else:
+				target_offset += relative
+				for _ in range(length):  # May overlap what it's writing
+					out.append(out[target_offset])
+					target_offset += 1
+	if len(out) != target_size or zlib.crc32(out) != target_crc:
+		raise ValueError("BPS patch gave the wrong result")
+	return bytes(out)
+
+
+def _read_varint(data: Buffer, pos: int) -> tuple[int, int]:
+	value = 0
+	shift = 1
+	while True:
+		byte = data[pos]
+		pos += 1
+		value += (byte & 0x7F) * shift
+		if byte & 0x80:
+			return value, pos
+		shift <<= 7
+		value += shift
+
+
+def make_patch(old: Buffer, new: Buffer, patch_format: str) -> bytes:
+	if patch_format == "IPS":
+		return make_ips(old, new)
+	if patch_format == "BPS":
+		return make_bps(old, new)
+	raise ValueError(f"Unknown patch format {patch_format}; should be one of {', '.join(PATCH_FORMATS)}")
+
+
+def apply_patch(old: Buffer, patch: Buffer, patch_format: str) -> bytes:
+	if patch_format == "IPS":
+		return apply_ips(old, patch)
+	if patch_format == "BPS":
+		return apply_bps(old, patch)
+	raise ValueError(f"Unknown patch format {patch_format}; should be one of {', '.join(PATCH_FORMATS)}")
+
+
+@contextmanager
+def mapped(file_path: str) -> Iterator[Buffer]:
+	"""
+	Maps a file into memory read-only for the length of the block. Empty files, which can't be mapped, give b"".
+	"""
+	with open(file_path, mode="rb") as in_file:
+		if os.fstat(in_file.fileno()).st_size == 0:
+			yield b""
+			return
+		with mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+			yield mapping
+
+
+def write_patch(old_path: str, new: Buffer, patch_path: str, patch_format: str) -> int:
+	"""
+	Writes a patch from the ROM at old_path to new, and returns its size.
+	"""
+	with mapped(old_path) as old:
+		patch = make_patch(old, new, patch_format)
+	with atomic_output(patch_path) as patch_file:
+		patch_file.write(patch)
+	return len(patch)
+
+
+def main() -> None:
+	arg_parser = argparse.ArgumentParser(description="Make a patch that turns one ROM into another")
+	arg_parser.add_argument("old", help="the ROM the patch applies to")
+	arg_parser.add_argument("new", help="the ROM the patch should produce")
+	arg_parser.add_argument("-o", "--output", help="patch file; defaults to the new ROM's, with the format's extension")
+	arg_parser.add_argument(
+		"--format", choices=[name.lower() for name in PATCH_FORMATS], help="defaults to -o's extension, or else bps")
+	args = arg_parser.parse_args()
+	patch_format = args.format
+	if patch_format is None:
+		extension = os.path.splitext(args.output or "")[1].lower()
+		patch_format = extension[1:] if extension in (".ips", ".bps") else "bps"
+	patch_format = patch_format.upper()
+	patch_path = args.output or os.path.splitext(args.new)[0] + "." + patch_format.lower()
+
+	with mapped(args.new) as new:
+		size = write_patch(args.old, new, patch_path, patch_format)
+		with mapped(args.old) as old, mapped(patch_path) as patch:
+			if apply_patch(old, patch, patch_format) != new[:]:
+				print(f"{patch_path}: patch doesn't reproduce {args.new}", file=sys.stderr)
+				sys.exit(1)
+		print(f"{patch_path}: {size:,} bytes for a {len(new):,} byte ROM", file=sys.stderr)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,196 @@
+"""
+Opt-in build profiling: wall time and allocations for each pipeline stage, plus counters for the hot paths. A Profiler
+works by wrapping the functions involved while it's active, so builds without one run the plain code at no extra cost.
+Run with `python iron_profile.py [source file] [--json report.json]`, or `python main.py --profile`.
+"""
+import argparse
+import functools
+import json
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from typing import Union
+
+import iron_parser
+import number_reader
+from iron_assembler import Assembler, VirtualCartridge, find_source_file
+from iron_parser import Parser, Symbol_Library
+
+_STAGES = [
+	(Assembler, "lex_tokens", "lex"), (VirtualCartridge, "config_cart", "configure"),
+	(VirtualCartridge, "initialize_prg", "initialize_prg"), (Parser, "parse_symbols", "parse_symbols"),
+	(Parser, "parse_labels", "parse_labels"), (Parser, "parse_opcodes_and_raws", "parse_opcodes_and_raws"),
+	(VirtualCartridge, "save", "save")
+]
+_TRY_READ_IMPORTERS = [number_reader, iron_parser]  # Modules holding their own reference to try_read()
+_LOOKUP_ADDR_MODES = ("ZERO_PAGE", "ABSOLUTE")  # Prefixes of the modes picked by looking up the operand's value
+_active = False
+
+
+class Profiler:
+	def __init__(self, track_allocations: bool = True) -> None:
+		self.track_allocations = track_allocations
+		self.stages: dict[str, dict[str, Union[int, float]]] = {}
+		self.counters: Counter[str] = Counter()
+		self._originals: list[tuple[object, str, object]] = []
+
+	def __enter__(self) -> "Profiler":
+		self.enable()
+		return self
+
+	def __exit__(self, *exc_info) -> None:
+		self.disable()
+
+	def enable(self) -> None:
+		global _active
+		if _active:
+			raise RuntimeError("Another Profiler is already active.")
+		_active = True
+		if self.track_allocations:
+			tracemalloc.start()
+		for owner, attr, stage in _STAGES:
+			self._wrap(owner, attr, self._stage_wrapper(getattr(owner, attr), stage))
+		try_read = self._try_read_wrapper(number_reader.try_read)  # read() goes through it too
+		for module in _TRY_READ_IMPORTERS:
+			self._wrap(module, "try_read", try_read)
+		self._wrap(Symbol_Library, "get_value", self._get_value_wrapper(Symbol_Library.get_value))
+		self._wrap(Symbol_Library, "get_relative", self._get_relative_wrapper(Symbol_Library.get_relative))
+		self._wrap(Parser, "parse_addr_mode", self._parse_addr_mode_wrapper(Parser.parse_addr_mode))
+		self._wrap(Parser, "encode_workers", lambda parser: 1)  # Forked workers would count into copies of the counters
+
+	def disable(self) -> None:
+		global _active
+		while self._originals:
+			owner, attr, original = self._originals.pop()
+			setattr(owner, attr, original)
+		if self.track_allocations and tracemalloc.is_tracing():
+			tracemalloc.stop()
+		_active = False
+
+	def _wrap(self, owner: object, attr: str, wrapper) -> None:
+		self._originals.append((owner, attr, getattr(owner, attr)))
+		setattr(owner, attr, wrapper)
+
+	def _stage_wrapper(self, func, stage: str):
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			if self.track_allocations:
+				tracemalloc.reset_peak()
+				before = tracemalloc.get_traced_memory()[0]
+			start = time.perf_counter()
+			try:
+				return func(*args, **kwargs)
+			finally:
+				record = self.stages.setdefault(
+					stage, {"calls": 0, "seconds": 0.0, "allocated_bytes": 0, "peak_bytes": 0})
+				record["calls"] += 1
+				record["seconds"] += time.perf_counter() - start
+				if self.track_allocations:
+					current, peak = tracemalloc.get_traced_memory()
+					record["allocated_bytes"] += current - before
+					record["peak_bytes"] = max(record["peak_bytes"], peak - before)
+		return wrapper
+
+	def _try_read_wrapper(self, func):
+		counters = self.counters
+
+		@functools.wraps(func)
+		def wrapper(test_str: str) -> Union[int, None]:
+			counters["read.calls"] += 1
+			value = func(test_str)
+			if value is None:
+				counters["read.failures"] += 1
+			return value
+		return wrapper
+
+	def _get_value_wrapper(self, func):
+		counters = self.counters
+
+		@functools.wraps(func)
+		def wrapper(sym_lib: Symbol_Library, name: str) -> int:
+			try:
+				value = func(sym_lib, name)
+			except NameError:
+				counters["get_value.unknown"] += 1
+				raise
+			# Names can't start with a digit, $ or %, so anything else that isn't an expression was a literal
+			if name in sym_lib.symbols:
+				counters["get_value.symbol"] += 1
+			elif name in sym_lib.labels:
+				counters["get_value.label"] += 1
+			elif sym_lib.classify(name).kind == "expression":
+				counters["get_value.expression"] += 1
+			else:
+				counters["get_value.literal"] += 1
+			return value
+		return wrapper
+
+	def _get_relative_wrapper(self, func):
+		counters = self.counters
+
+		@functools.wraps(func)
+		def wrapper(sym_lib: Symbol_Library, current_pos: int, label_name: str) -> bytes:
+			counters["get_relative.calls"] += 1
+			if label_name[0] == ":":
+				counters["get_relative.anonymous"] += 1
+			return func(sym_lib, current_pos, label_name)
+		return wrapper
+
+	def _parse_addr_mode_wrapper(self, func):
+		counters = self.counters
+
+		@functools.wraps(func)
+		def wrapper(parser: Parser, opcode: str) -> tuple[str, str]:
+			counters["parse_addr_mode.calls"] += 1
+			addr_mode, argument = func(parser, opcode)
+			if addr_mode.startswith(_LOOKUP_ADDR_MODES):
+				counters["parse_addr_mode.value_lookups"] += 1
+			return addr_mode, argument
+		return wrapper
+
+	def to_dict(self) -> dict:
+		return {
+			"stages": {stage: dict(record) for stage, record in self.stages.items()},
+			"counters": dict(sorted(self.counters.items()))
+		}
+
+	def summary(self) -> str:
+		lines = [f"{'stage':<24}{'calls':>7}{'ms':>11}{'allocated KiB':>15}{'peak KiB':>11}"]
+		for stage, record in self.stages.items():
+			lines.append(
+				f"{stage:<24}{record['calls']:>7}{record['seconds'] * 1000:>11.2f}"
+				f"{record['allocated_bytes'] / 1024:>15.1f}{record['peak_bytes'] / 1024:>11.1f}")
+		total = sum(record["seconds"] for record in self.stages.values())
+		lines.append(f"{'total':<24}{'':>7}{total * 1000:>11.2f}")
+		if not self.track_allocations:
+			lines.append("(allocations not tracked)")
+		lines.append("")
+		lines.append(f"{'counter':<36}{'count':>12}")
+		for name, count in sorted(self.counters.items()):
+			lines.append(f"{name:<36}{count:>12,}")
+		return "\n".join(lines)
+
+	def write_json(self, file_path: str) -> None:
+		with open(file_path, "w") as report_file:
+			json.dump(self.to_dict(), report_file, indent=2)
+
+
+def main() -> None:
+	arg_parser = argparse.ArgumentParser(description="Assemble a project and report where the time went")
+	arg_parser.add_argument("source", nargs="?", help="source file; defaults to the first .asm/.s in input/")
+	arg_parser.add_argument("--json", help="write the report to this JSON file instead of printing it")
+	arg_parser.add_argument(
+		"--no-alloc", action="store_true", help="don't track allocations, which slows the build down")
+	args = arg_parser.parse_args()
+
+	with Profiler(track_allocations=not args.no_alloc) as profiler:
+		Assembler(args.source or find_source_file()).assemble()
+	if args.json:
+		profiler.write_json(args.json)
+	else:
+		print(profiler.summary(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+	main()
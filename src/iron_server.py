@@ -0,0 +1,211 @@
+"""
+Assembler daemon: keeps a pool of warm worker processes, with everything imported and lexed includes cached, and
+assembles source text sent over a Unix domain socket, replying with the ROM instead of writing it. Requests for
+different projects are assembled in parallel; the last result for each project is kept, and repeating a request whose
+source, configuration and input files haven't changed returns it without assembling again.
+Run with `python iron_server.py [--socket PATH] [-j N]`, and send requests with iron_client.py, which describes the
+protocol.
+"""
+import argparse
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from typing import Union
+
+import iron_token
+from iron_assembler import Assembler
+from iron_client import DEFAULT_SOCKET_PATH, recv_message, send_message
+
+_MAX_PROJECTS = 64  # Projects whose last result is kept
+
+
+class ProjectState:
+	def __init__(self) -> None:
+		self.lock = threading.Lock()  # One build at a time per project, so repeats wait for the result and reuse it
+		self.request_hash = b""
+		self.reply: dict = {}
+		self.rom = b""
+		self.input_stamps: dict[str, tuple[int, int]] = {}
+
+	def is_current(self, request_hash: bytes) -> bool:
+		return (request_hash == self.request_hash and self.reply.get("ok", False)
+				and all(_file_stamp(path) == stamp for path, stamp in self.input_stamps.items()))
+
+
+def build_request(request: dict, source: bytes) -> tuple[dict, bytes, dict[str, tuple[int, int]]]:
+	"""
+	Assembles one request in memory. Returns the reply header, the ROM, and stamps of every input file it read. Errors
+	are reported in the reply rather than raised.
+	"""
+	start = time.perf_counter()
+	input_stamps = {}
+	try:
+		input_dir = request["input_dir"]
+		assembler = Assembler(input_dir + "/" + request["name"], input_dir, request["output_dir"], encode_workers=1)
+		config_tokens = list(iron_token.lex_lines(request["config"]))
+		for token in config_tokens:
+			if token.type != "CART_CONFIG":
+				raise ValueError(f"[{token.content}] isn't a configuration line")
+		assembler.build(chain(iron_token.lex_source(source), config_tokens))  # Config given last, so it wins
+		cart = assembler.virtual_cart
+		rom = cart.rom_bytes()
+		input_stamps = {path: _file_stamp(path) for path in assembler.included_files + cart.input_files()}
+		reply = {"ok": True, "diagnostics": [], "output_path": cart.output_path()}
+	except Exception as error:
+		rom = b""
+		reply = {
+			"ok": False, "diagnostics": [{"severity": "error", "message": f"{type(error).__name__}: {error}"}],
+			"output_path": ""
+		}
+	reply["cached"] = False
+	reply["seconds"] = time.perf_counter() - start
+	return reply, rom, input_stamps
+
+
+def _file_stamp(file_path: str) -> tuple[int, int]:
+	try:
+		stat = os.stat(file_path)
+	except OSError:
+		return -1, -1
+	return stat.st_mtime_ns, stat.st_size
+
+
+def _request_hash(request: dict, source: bytes) -> bytes:
+	config = json.dumps([request["name"], request["config"]]).encode("utf-8")
+	return hashlib.blake2b(source + b"\0" + config).digest()
+
+
+class AssemblyServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+	def __init__(self, socket_path: str = DEFAULT_SOCKET_PATH, workers: Union[int, None] = None) -> None:
+		_remove_stale_socket(socket_path)
+		super().__init__(socket_path, RequestHandler)
+		self.executor = ProcessPoolExecutor(max_workers=workers)
+		self.executor.submit(int).result()  # Start the workers now, before any request threads exist
+		self.projects: OrderedDict[tuple[str, str], ProjectState] = OrderedDict()
+		self.stats = {"requests": 0, "builds": 0, "cache_hits": 0}
+		self.lock = threading.Lock()  # Guards projects and stats
+
+	def server_close(self) -> None:
+		super().server_close()
+		self.executor.shutdown()
+		try:
+			os.unlink(self.server_address)
+		except FileNotFoundError:
+			pass
+
+	def project(self, request: dict) -> ProjectState:
+		key = (request["input_dir"], request["output_dir"])
+		with self.lock:
+			state = self.projects.get(key)
+			if state is None:
+				state = self.projects[key] = ProjectState()
+				if len(self.projects) > _MAX_PROJECTS:
+					self.projects.popitem(last=False)
+			else:
+				self.projects.move_to_end(key)
+			return state
+
+	def assemble(self, request: dict, source: bytes) -> tuple[dict, bytes]:
+		for field, field_type in (("input_dir", str), ("output_dir", str), ("name", str), ("config", list)):
+			if not isinstance(request.get(field), field_type):
+				raise ValueError(f"Assemble request needs a {field} ({field_type.__name__})")
+		request_hash = _request_hash(request, source)
+		state = self.project(request)
+		with state.lock:
+			if state.is_current(request_hash):
+				self.count("cache_hits")
+				return dict(state.reply, cached=True, seconds=0.0), state.rom
+			self.count("builds")
+			reply, rom, input_stamps = self.executor.submit(build_request, request, source).result()
+			state.request_hash = request_hash
+			state.reply, state.rom, state.input_stamps = reply, rom, input_stamps
+			return reply, rom
+
+	def count(self, stat: str) -> None:
+		with self.lock:
+			self.stats[stat] += 1
+
+	def dispatch(self, request: dict, payload: bytes) -> tuple[dict, bytes]:
+		self.count("requests")
+		op = request.get("op")
+		if op == "assemble":
+			return self.assemble(request, payload)
+		if op == "ping":
+			return dict(self.stats, ok=True, projects=len(self.projects), pid=os.getpid()), b""
+		if op == "stop":
+			threading.Thread(target=self.shutdown).start()
+			return {"ok": True}, b""
+		raise ValueError(f"Unknown op {op!r}")
+
+
+class RequestHandler(socketserver.BaseRequestHandler):
+	server: AssemblyServer
+
+	def handle(self) -> None:
+		"""
+		Answers requests on one connection until the client closes it.
+		"""
+		while True:
+			try:
+				message = recv_message(self.request)
+			except (ValueError, ConnectionError) as error:
+				send_message(self.request, _error_reply(error))
+				return
+			if message is None:
+				return
+			try:
+				reply, rom = self.server.dispatch(*message)
+			except (ValueError, TypeError) as error:
+				reply, rom = _error_reply(error), b""
+			send_message(self.request, reply, rom)
+
+
+def _error_reply(error: Exception) -> dict:
+	return {"ok": False, "diagnostics": [{"severity": "error", "message": f"Bad request: {error}"}]}
+
+
+def _remove_stale_socket(socket_path: str) -> None:
+	"""
+	Removes a socket file left behind by a daemon that didn't shut down cleanly, but not one that's still in use.
+	"""
+	if not os.path.exists(socket_path):
+		return
+	probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		probe.connect(socket_path)
+	except OSError:
+		os.unlink(socket_path)
+		return
+	finally:
+		probe.close()
+	raise OSError(f"An assembler daemon is already listening on {socket_path}")
+
+
+def main() -> None:
+	arg_parser = argparse.ArgumentParser(description="Keep a warm assembler running behind a Unix domain socket")
+	arg_parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH, help=f"defaults to {DEFAULT_SOCKET_PATH}")
+	arg_parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes; defaults to CPU count")
+	args = arg_parser.parse_args()
+	if not hasattr(socket, "AF_UNIX"):
+		sys.exit("The assembler daemon needs Unix domain sockets, which this platform doesn't have.")
+
+	with AssemblyServer(args.socket, args.jobs) as server:
+		print(f"Listening on {args.socket}; stop with `python iron_client.py --stop`.", file=sys.stderr)
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+
+
+if __name__ == "__main__":
+	main()
@@ -1,15 +1,36 @@
-from number_reader import read
+import hashlib
+import io
+import locale
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator
+
+_LABEL_SPLIT = re.compile(r":([^+-])")
+_WHITESPACE_RUN = re.compile(r"[ \t]+")
+_FILE_DIRECTIVES = (".INCLUDE ", ".INCBIN ")  # Their file name argument keeps its case
+_QUOTED_FILE = re.compile(r'[ \t]*(\.INCLUDE|\.INCBIN)[ \t]+"([^"]*)"(.*)', re.IGNORECASE | re.DOTALL)
+# Any labels before a conditional directive, then the directive
+_CONDITIONAL = re.compile(r"((?:[ \t]*[^\s:;]*:(?![+-]))*)[ \t]*\.(IF|IFDEF|IFNDEF|ELSE|ENDIF)\b", re.IGNORECASE)
+_LEX_CACHE: dict[bytes, list["Token"]] = {}  # Lexed files by content hash
+_LEX_CACHE_ENTRIES = 256
+_PARALLEL_LEX_MIN_BYTES = 1 << 20
+SOURCE_ENCODING = locale.getpreferredencoding(False)
 
 
 class Tokenizer:
 	def __init__(self, text_lines: list[str]):
 		self.tokens: list[Token] = []
-		for line in text_lines:
-			self.tokens.append(Token(line))
+		for line_no, line in enumerate(text_lines, start=1):
+			self.tokens.append(Token(line, line_no))
+
 
 class Token:
-	def __init__(self, line: str):
+	__slots__ = ("content", "type", "line_no")
+
+	def __init__(self, line: str, line_no: int = 0):
 		self.content = line
+		self.line_no = line_no
 		if line[0] == "!":
 			self.type = "CART_CONFIG"
 		elif line[0] == ".":
@@ -20,3 +41,176 @@ class Token:
 			self.type = "SYMBOL"
 		else:
 			self.type = "OPCODE"
+
+	def copy(self) -> "Token":
+		token = Token.__new__(Token)
+		token.content = self.content
+		token.type = self.type
+		token.line_no = self.line_no
+		return token
+
+	def __repr__(self) -> str:
+		return f"Token({self.type}, {self.content!r}, line {self.line_no})"
+
+
+class ConditionalToken(Token):
+	"""
+	A whole `.IF`/`.IFDEF`/`.IFNDEF` block. Its branches are kept as raw lines, to be lexed only if they're taken.
+	"""
+	__slots__ = ("branches",)
+
+	def __init__(self, line: str, line_no: int, branches: list[tuple[int, list[str]]]):
+		super().__init__(line, line_no)
+		self.type = "CONDITIONAL"
+		self.branches = branches  # First line number and raw lines of the block, then of its .ELSE if it has one
+
+	def copy(self) -> "ConditionalToken":
+		return ConditionalToken(self.content, self.line_no, self.branches)
+
+
+def lex_lines(lines: Iterable[str], first_line_no: int = 1) -> Iterator[Token]:
+	"""
+	Single-pass lexer: splits labels onto their own lines, removes comments, uppercases, collapses whitespace and
+	classifies each resulting line, yielding one Token per non-empty line as it goes. Conditional blocks are yielded
+	as one ConditionalToken each, without lexing the lines inside.
+	"""
+	numbered_lines = enumerate(lines, start=first_line_no)
+	for line_no, raw_line in numbered_lines:
+		if "." in raw_line:
+			match = _CONDITIONAL.match(raw_line)
+			if match is not None:
+				if match.group(1):
+					yield from lex_lines((match.group(1),), line_no)
+				token, end_labels, end_line_no = _conditional_block(raw_line[match.end(1):], line_no, numbered_lines)
+				yield token
+				if end_labels:
+					yield from lex_lines((end_labels,), end_line_no)
+				continue
+		if '"' in raw_line:
+			match = _QUOTED_FILE.match(raw_line)
+			if match is not None:
+				yield _quoted_file_token(match, line_no)
+				continue
+		if ":" in raw_line:
+			pieces = _LABEL_SPLIT.sub(r":\g<1>\n", raw_line).split("\n")
+		else:
+			pieces = (raw_line,)
+		for piece in pieces:
+			if ";" in piece:
+				piece = piece.split(";", 1)[0]
+			line = piece.strip()
+			if line == "":
+				continue
+			if "\t" in line or "  " in line:
+				line = _WHITESPACE_RUN.sub(" ", line)
+			upper_line = line.upper()
+			if upper_line.startswith(_FILE_DIRECTIVES):
+				directive_length = upper_line.index(" ")
+				upper_line = upper_line[:directive_length] + line[directive_length:]
+			yield Token(upper_line, line_no)
+
+
+def _quoted_file_token(match: re.Match, line_no: int) -> Token:
+	"""
+	Lexes a `.INCLUDE`/`.INCBIN` line whose file name is quoted, keeping the name exactly as written, semicolons and
+	runs of spaces included.
+	"""
+	directive, file_name, rest = match.groups()
+	rest = _WHITESPACE_RUN.sub(" ", rest.split(";", 1)[0].strip()).upper()
+	return Token(f'{directive.upper()} "{file_name}"' + (" " + rest if rest else ""), line_no)
+
+
+def _conditional_block(first_line: str, first_line_no: int,
+					   numbered_lines: Iterator[tuple[int, str]]) -> tuple[Token, str, int]:
+	"""
+	Collects the lines of a conditional block up to its .ENDIF, only looking at each for nested conditionals. Returns
+	the block, and any labels before the .ENDIF and their line number, since they come after the block whichever
+	branch is taken. Labels before an .ELSE end one branch and start the other, so they go in both.
+	"""
+	content = _WHITESPACE_RUN.sub(" ", first_line.split(";", 1)[0].strip()).upper()
+	directive = content.split(" ", 1)[0]
+	if directive in (".ELSE", ".ENDIF"):
+		raise ValueError(f"{directive} on line {first_line_no} has no .IF before it")
+	branches = [(first_line_no + 1, [])]
+	depth = 0
+	for line_no, raw_line in numbered_lines:
+		match = _CONDITIONAL.match(raw_line) if "." in raw_line else None
+		if match is not None:
+			nested = match.group(2).upper()
+			labels = match.group(1)
+			if nested.startswith("IF"):
+				depth += 1
+			elif nested == "ENDIF" and depth > 0:
+				depth -= 1
+			elif nested == "ENDIF":
+				return ConditionalToken(content, first_line_no, branches), labels, line_no
+			elif depth == 0:
+				if len(branches) == 2:
+					raise ValueError(f"Second .ELSE on line {line_no}, for the {directive} on line {first_line_no}")
+				if labels:
+					branches[-1][1].append(labels)
+					branches.append((line_no, [labels]))
+				else:
+					branches.append((line_no + 1, []))
+				continue
+		branches[-1][1].append(raw_line)
+	raise ValueError(f"{directive} on line {first_line_no} has no .ENDIF")
+
+
+def lex_file(file_path: str) -> Iterator[Token]:
+	"""
+	Streams tokens from a source file without reading it into memory all at once.
+	"""
+	with open(file_path) as infile:
+		yield from lex_lines(infile)
+
+
+def lex_source(content: bytes) -> list[Token]:
+	"""
+	Lexes the raw bytes of a source file, decoding them the same way lex_file's text-mode open does.
+	"""
+	return list(lex_lines(io.StringIO(content.decode(SOURCE_ENCODING), newline=None)))
+
+
+def lex_files(file_paths: list[str]) -> dict[str, list[Token]]:
+	"""
+	Lexes several source files, returning fresh tokens for each path. Results are cached by content hash, and files that
+	aren't cached are lexed in parallel worker processes when there are enough of them to be worth it.
+	"""
+	contents = {}
+	for path in file_paths:
+		with open(path, mode="rb") as infile:
+			contents[path] = infile.read()
+	hashes = {path: hashlib.blake2b(content).digest() for path, content in contents.items()}
+	tokens_by_hash = {content_hash: _LEX_CACHE[content_hash] for content_hash in hashes.values()
+					  if content_hash in _LEX_CACHE}
+	uncached = {hashes[path]: content for path, content in contents.items() if hashes[path] not in tokens_by_hash}
+	if len(uncached) > 1 and sum(map(len, uncached.values())) >= _PARALLEL_LEX_MIN_BYTES:
+		with ProcessPoolExecutor(max_workers=min(len(uncached), os.cpu_count() or 1)) as executor:
+			lexed = dict(zip(uncached, executor.map(lex_source, uncached.values())))
+	else:
+		lexed = {content_hash: lex_source(content) for content_hash, content in uncached.items()}
+	tokens_by_hash.update(lexed)
+	for content_hash, tokens in lexed.items():
+		while len(_LEX_CACHE) >= _LEX_CACHE_ENTRIES:
+			del _LEX_CACHE[next(iter(_LEX_CACHE))]
+		_LEX_CACHE[content_hash] = tokens
+	# Callers may renumber or replace tokens, so the cached lists are never handed out directly
+	return {path: [token.copy() for token in tokens_by_hash[hashes[path]]] for path in contents}
+
+
+def split_file_argument(content: str) -> tuple[str, list[str]]:
+	"""
+	Splits a `.INCLUDE`/`.INCBIN` line into its file name, which may be in double quotes, and any further arguments.
+	"""
+	rest = content.split(" ", 1)[1] if " " in content else ""
+	if rest.startswith('"'):
+		end = rest.find('"', 1)
+		if end == -1:
+			raise ValueError(f"Unterminated file name in [{content}]")
+		file_name, args = rest[1:end], rest[end + 1:].split()
+	else:
+		file_name, *args = rest.split(" ")
+	if file_name == "":
+		raise ValueError(f"Missing file name in [{content}]")
+	return file_name, [arg.upper() for arg in args]
@@ -0,0 +1,319 @@
+"""
+Watch mode: keeps an assembled project in memory and, when the source changes, re-lexes and re-encodes only the lines
+that were edited, patching the output ROM in place. Label layout is only re-run when an edit changes the size of the
+code (or touches labels, symbols or cartridge config).
+Run with `python iron_watch.py [source file]`.
+"""
+import argparse
+import hashlib
+import io
+import os
+import time
+from bisect import bisect_left
+from typing import Union
+
+import iron_token
+from iron_assembler import Assembler, find_source_file
+from iron_token import Token
+
+_BYTE_DIRECTIVES = (".B", ".BYTE", ".BYTES")
+_WORD_DIRECTIVES = (".W", ".WORD", ".WORDS")
+
+
+class Watcher:
+	def __init__(self, file_path: str) -> None:
+		self.assembler = Assembler(file_path)
+		self.encoding = iron_token.SOURCE_ENCODING
+		self.content = b""
+		self.tokens: list[Token] = []
+		self.positions: list[Union[int, None]] = []  # PRG position of each token that emits bytes, else None
+		self.image_hash = b""
+		self.input_stamps: dict[str, tuple[int, int]] = {}
+		self.needs_full_build = True
+
+	def stamp(self) -> tuple:
+		"""
+		Returns something that changes whenever the source file or one of the cartridge's input files does.
+		"""
+		return _file_stamp(self.assembler.main_asm_file), self._stamp_inputs()
+
+	def rebuild(self) -> str:
+		"""
+		Brings the output ROM up to date with the source, doing as little work as possible. Returns a short description
+		of what was done.
+		"""
+		with open(self.assembler.main_asm_file, mode="rb") as infile:
+			content = infile.read()
+		if b"\r" in content and content.count(b"\r") != content.count(b"\r\n"):
+			self.needs_full_build = True  # Lone carriage returns would throw off the byte-level line numbering
+		if self.needs_full_build or self._stamp_inputs() != self.input_stamps:
+			return self.full_build(content)
+		if content == self.content:
+			return "No changes."
+		return self.incremental_build(content)
+
+	def full_build(self, content: bytes, tokens: Union[list[Token], None] = None) -> str:
+		self.needs_full_build = True
+		if tokens is None:
+			tokens = iron_token.lex_source(content)
+		self.assembler.build(iter(tokens))
+		cart = self.assembler.virtual_cart
+		out_path = cart.output_path()
+		indexed = self._index_tokens(tokens)
+		self.content = content
+
+		image_hash = self._hash_image()
+		input_stamps = self._stamp_inputs()
+		if image_hash == self.image_hash and input_stamps == self.input_stamps and os.path.exists(out_path):
+			message = "Rebuilt; image unchanged, nothing written."
+		else:
+			cart.save()
+			message = f"Rebuilt and wrote {out_path}."
+		self.image_hash = image_hash
+		self.input_stamps = input_stamps
+		# Lines that come from included files or macro expansions can't be patched, so such projects always rebuild
+		self.needs_full_build = not indexed
+		return message
+
+	def incremental_build(self, content: bytes) -> str:
+		old_content = self.content
+		start, old_end, new_end = _changed_line_span(old_content, content)
+		first_line = old_content.count(b"\n", 0, start) + 1
+		old_line_count = _line_count(old_content, start, old_end)
+		new_line_count = _line_count(content, start, new_end)
+		first_index = bisect_left(self.tokens, first_line, key=_line_no)
+		end_index = bisect_left(self.tokens, first_line + old_line_count, key=_line_no)
+		old_span = self.tokens[first_index:end_index]
+		new_span = list(iron_token.lex_lines(
+			io.StringIO(content[start:new_end].decode(self.encoding), newline=None), first_line))
+
+		if [token.content for token in old_span] == [token.content for token in new_span]:
+			self._splice(first_index, end_index, new_span, self.positions[first_index:end_index],
+						 new_line_count - old_line_count)
+			self.content = content
+			return "No changes to the assembled output."
+
+		patch = self._patch(first_index, old_span, new_span)
+		if patch is None:
+			tokens = self.tokens[:first_index] + new_span + self.tokens[end_index:]
+			for token in self.tokens[end_index:]:
+				token.line_no += new_line_count - old_line_count
+			message = self.full_build(content, tokens)
+			return "Layout changed; " + message[:1].lower() + message[1:]
+		new_positions, patch_start, old_bytes = patch
+		self._splice(first_index, end_index, new_span, new_positions, new_line_count - old_line_count)
+		self.content = content
+
+		cart = self.assembler.virtual_cart
+		new_bytes = cart.prg_image.view[patch_start:patch_start + len(old_bytes)]
+		if new_bytes == old_bytes:
+			return "Re-encoded; image unchanged, nothing written."
+		out_path = cart.output_path()
+		if not os.path.exists(out_path):
+			cart.save()
+			return f"Re-encoded and wrote {out_path}."
+		with open(out_path, mode="r+b") as out_file:
+			out_file.seek(cart.prg_offset() + patch_start)
+			out_file.write(new_bytes)
+		self.image_hash = b""  # Only recomputed on the next full build
+		return f"Patched {len(old_bytes)} byte(s) at PRG offset {patch_start:#x} in {out_path}."
+
+	def _patch(self, first_index: int, old_span: list[Token], new_span: list[Token]) -> Union[tuple, None]:
+		"""
+		Re-encodes new_span over the bytes of old_span if both are made of plain instructions and data with the same
+		total size. Returns the new token positions, the patch start and the old bytes, or None if layout must be
+		redone, which includes when a full build would reject new_span.
+		"""
+		if not old_span:
+			return None
+		old_sizes = [self._patch_size(token) for token in old_span]
+		new_sizes = [self._patch_size(token) for token in new_span]
+		parser = self.assembler.parser
+		if None in old_sizes or None in new_sizes or sum(old_sizes) != sum(new_sizes) or parser.cycle_budgets:
+			return None  # Cycle budgets are only checked by full builds
+		prg_image = self.assembler.virtual_cart.prg_image
+		patch_start = self.positions[first_index]
+		if any(self._uses_later_label(token, patch_start) for token in new_span if token.type == "OPCODE"):
+			return None
+		patch_end = patch_start + sum(old_sizes)
+		old_bytes = bytes(prg_image.view[patch_start:patch_end])
+		end_cursor = prg_image.cursor
+		new_positions = []
+		prg_image.seek(patch_start)
+		try:
+			for token in new_span:
+				new_positions.append(prg_image.cursor)
+				instruction = parser.decode_instruction(token.content) if token.type == "OPCODE" else None
+				parser.emit_token(token, instruction)
+		except Exception:
+			prg_image.view[patch_start:patch_end] = old_bytes
+			raise
+		finally:
+			prg_image.cursor = end_cursor
+		return new_positions, patch_start, old_bytes
+
+	def _uses_later_label(self, token: Token, patch_start: int) -> bool:
+		"""
+		Whether an instruction's operand uses a label laid out at or after patch_start. A full build picks addressing
+		modes knowing only the labels before each instruction, so it can reject operands that patching would accept.
+		"""
+		sym_lib = self.assembler.parser.sym_lib
+		instruction = self.assembler.parser.decode_instruction(token.content)
+		if instruction.addr_mode == "RELATIVE" or not sym_lib.depends_on_labels(instruction.operand):
+			return False  # Branches may always go forward
+		operand = sym_lib.classify(instruction.operand)
+		names = operand.expression.names if operand.kind == "expression" else (operand.name,)
+		return any(name in sym_lib.labels and sym_lib.labels[name].short_addr >= patch_start for name in names)
+
+	def _patch_size(self, token: Token) -> Union[int, None]:
+		"""
+		Returns how many bytes a token encodes to if it can be re-encoded in place, or None if it can't.
+		"""
+		if token.type == "OPCODE":
+			return self.assembler.parser.decode_instruction(token.content).length
+		if token.type == "RAW_DATA":
+			args = token.content.split(" ")
+			if args[0] in _BYTE_DIRECTIVES:
+				return len(args) - 1
+			if args[0] in _WORD_DIRECTIVES:
+				return 2 * (len(args) - 1)
+		return None
+
+	def _splice(self, first_index: int, end_index: int, new_span: list[Token], new_positions: list,
+				line_delta: int) -> None:
+		if line_delta != 0:
+			for token in self.tokens[end_index:]:
+				token.line_no += line_delta
+		self.tokens[first_index:end_index] = new_span
+		self.positions[first_index:end_index] = new_positions
+
+	def _index_tokens(self, tokens: list[Token]) -> bool:
+		"""
+		Records the PRG position of each of the source's tokens, and returns whether the parser's tokens were exactly
+		those of the source.
+		"""
+		parser = self.assembler.parser
+		self.tokens = tokens
+		self.positions = [None] * len(tokens)
+		emitted_index = 0
+		for i, token in enumerate(tokens):
+			if emitted_index < len(parser.token_list) and parser.token_list[emitted_index] is token:
+				self.positions[i] = parser.positions[emitted_index]
+				emitted_index += 1
+		return emitted_index == len(parser.token_list)
+
+	def _hash_image(self) -> bytes:
+		cart = self.assembler.virtual_cart
+		image_hash = hashlib.blake2b(cart.header())
+		for prg_chunk in cart.prg_image.chunks():
+			image_hash.update(prg_chunk)
+		return image_hash.digest()
+
+	def _stamp_inputs(self) -> dict[str, tuple[int, int]]:
+		cart = self.assembler.virtual_cart
+		if cart is None:
+			return {}
+		paths = [cart.chr_file, cart.trainer] + cart.misc_roms
+		stamps = {path: _file_stamp(cart.input_path(path)) for path in paths if path != ""}
+		stamps.update((path, _file_stamp(path)) for path in self.assembler.included_files)
+		return stamps
+
+
+def _file_stamp(file_path: str) -> tuple[int, int]:
+	try:
+		stat = os.stat(file_path)
+	except FileNotFoundError:
+		return 0, -1
+	return stat.st_mtime_ns, stat.st_size
+
+
+def _line_no(token: Token) -> int:
+	return token.line_no
+
+
+def _common_prefix_length(a: bytes, b: bytes) -> int:
+	# Binary search with startswith over memoryview slices, so each probe is a memcmp with no copying
+	b_view = memoryview(b)
+	low, high = 0, min(len(a), len(b))
+	while low < high:
+		mid = (low + high + 1) // 2
+		if a.startswith(b_view[low:mid], low):
+			low = mid
+		else:
+			high = mid - 1
+	return low
+
+
+def _common_suffix_length(a: bytes, b: bytes, limit: int) -> int:
+	b_view = memoryview(b)
+	low, high = 0, limit
+	while low < high:
+		mid = (low + high + 1) // 2
+		if a.startswith(b_view[len(b) - mid:len(b) - low], len(a) - mid):
+			low = mid
+		else:
+			high = mid - 1
+	return low
+
+
+def _is_line_boundary(content: bytes, pos: int) -> bool:
+	return pos == 0 or pos == len(content) or content[pos - 1] == 0x0A
+
+
+def _changed_line_span(old: bytes, new: bytes) -> tuple[int, int, int]:
+	"""
+	Returns the start of the first changed line, and the end of the last changed line in old and in new. Both ends lie
+	the same distance into the shared suffix, so everything after them is unchanged.
+	"""
+	prefix = _common_prefix_length(old, new)
+	suffix = _common_suffix_length(old, new, min(len(old), len(new)) - prefix)
+	start = old.rfind(b"\n", 0, prefix) + 1
+	old_stop = len(old) - suffix
+	new_stop = len(new) - suffix
+	if _is_line_boundary(old, old_stop) and _is_line_boundary(new, new_stop):
+		into_suffix = 0
+	else:
+		newline = old.find(b"\n", old_stop)
+		into_suffix = suffix if newline == -1 else newline + 1 - old_stop
+	return start, old_stop + into_suffix, new_stop + into_suffix
+
+
+def _line_count(content: bytes, start: int, end: int) -> int:
+	line_count = content.count(b"\n", start, end)
+	if end == len(content) and end > start and content[end - 1] != 0x0A:
+		line_count += 1  # Unterminated last line
+	return line_count
+
+
+def watch(file_path: str, interval: float = 0.2) -> None:
+	watcher = Watcher(file_path)
+	last_stamp = None
+	print(f"Watching {file_path}; press Ctrl+C to stop.")
+	try:
+		while True:
+			stamp = watcher.stamp()
+			if stamp != last_stamp:
+				start = time.perf_counter()
+				try:
+					message = watcher.rebuild()
+				except Exception as error:
+					message = f"Assembly failed: {type(error).__name__}: {error}"
+				# The set of input files is only known after a build, so take their stamps afresh
+				last_stamp = stamp[0], watcher.stamp()[1]
+				elapsed = (time.perf_counter() - start) * 1000
+				print(f"[{time.strftime('%H:%M:%S')}] {message} ({elapsed:.1f} ms)")
+			time.sleep(interval)
+	except KeyboardInterrupt:
+		pass
+
+
+def main() -> None:
+	arg_parser = argparse.ArgumentParser(description="Re-assemble a project whenever its source changes")
+	arg_parser.add_argument("source", nargs="?", help="source file; defaults to the first .asm/.s in input/")
+	arg_parser.add_argument("--interval", type=float, default=0.2, help="polling interval in seconds")
+	args = arg_parser.parse_args()
+	watch(args.source or find_source_file(), args.interval)
+
+
+if __name__ == "__main__":
+	main()
@@ -2,19 +2,56 @@
 This is the end-user file to run.
 Development started: 5 Feb 2024
 """
-from iron_assembler import Assembler
+from iron_assembler import Assembler, find_source_file
+from iron_cycles import analyze
+from iron_profile import Profiler
+from iron_watch import watch
+from number_reader import read
+from contextlib import nullcontext
+from typing import Union
 import os
+import sys
+
+def command_line_defines() -> dict[str, int]:
+    """
+    Returns the symbols set with -DNAME or -DNAME=VALUE; a name alone is set to 1.
+    """
+    defines = {}
+    for arg in sys.argv[1:]:
+        if arg.startswith("-D"):
+            name, _, value = arg[2:].partition("=")
+            defines[name] = read(value) if value else 1
+    return defines
+
+
+def command_line_jobs() -> Union[int, None]:
+    """
+    Returns the processes to encode with, set with --jobs=N, or --jobs alone for one per CPU; without it, None.
+    """
+    for arg in sys.argv[1:]:
+        if arg == "--jobs":
+            return os.cpu_count() or 1
+        if arg.startswith("--jobs="):
+            return read(arg[len("--jobs="):])
+    return None
+
 
 def main():
+    if "--watch" in sys.argv[1:]:
+        watch(find_source_file())
+        return
     try:
-        for file in os.listdir("input"):
-            if file.endswith(".asm") or file.endswith(".s"):
-                in_fp = "input/" + file
-                break
-        else:
-            raise FileNotFoundError("Can't find source file!")
-        assembler = Assembler(in_fp)
-        assembler.assemble()
+        in_fp = find_source_file()
+        assembler = Assembler(in_fp, encode_workers=command_line_jobs(), optimize="--optimize" in sys.argv[1:],
+                              defines=command_line_defines())
+        with Profiler() if "--profile" in sys.argv[1:] else nullcontext() as profiler:
+            assembler.assemble()
+        if profiler is not None:
+            print(profiler.summary(), file=sys.stderr)
+        if assembler.optimization is not None:
+            print(assembler.optimization.summary(), file=sys.stderr)
+        if "--cycles" in sys.argv[1:]:
+            print(analyze(assembler.parser).summary(), file=sys.stderr)
         input("Success! Press [ENTER] to exit...")
     except ValueError or FileNotFoundError:
         input("Assembly failed; press [ENTER] to exit...")
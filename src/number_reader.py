@@ -1,18 +1,34 @@
 import re
+from typing import Union
+
+# Decimal, hexadecimal and binary in one pass; exactly one of the groups is set on a match
+pattern_number = re.compile(
+	pattern=r"(?:0d)?(\d{1,5})|(?:0x|\$)((?:[0-9A-F]{2}){1,2})|(?:%|0b)((?:[01]{8}){1,2})", flags=re.IGNORECASE)
+_NUMBER_STARTS = frozenset("0123456789$%")
+
+
+def try_read(test_str: str) -> Union[int, None]:
+	"""
+	Parses a number like read does, but returns None instead of raising if test_str isn't one.
+	"""
+	if "_" in test_str:
+		test_str = test_str.replace("_", "")
+	test_str = test_str.strip()
+	if test_str[:1] not in _NUMBER_STARTS:  # Cheap rejection of names, which start with a letter
+		return None
+	match = pattern_number.fullmatch(test_str)
+	if match is None:
+		return None
+	decimal, hexadecimal, binary = match.groups()
+	if decimal is not None:
+		return int(decimal, 10)
+	if hexadecimal is not None:
+		return int(hexadecimal, 16)
+	return int(binary, 2)
 
-pattern_decimal = re.compile(pattern=r"^(?:0d)?(\d{1,5})$", flags=re.IGNORECASE)
-pattern_binary = re.compile(pattern=r"^(?:%|0b)((?:[01]{8}){1,2})$", flags=re.IGNORECASE)
-pattern_hexadecimal = re.compile(pattern=r"^(?:0x|\$)((?:[0-9A-F]{2}){1,2})$", flags=re.IGNORECASE)
 
 def read(test_str: str) -> int:
-	test_str = test_str.replace("_", "").strip()
-	dec_match = pattern_decimal.fullmatch(test_str)
-	if dec_match is not None:
-		return int(dec_match.group(1), 10)
-	hex_match = pattern_hexadecimal.fullmatch(test_str)
-	if hex_match is not None:
-		return int(hex_match.group(1), 16)
-	bin_match = pattern_binary.fullmatch(test_str)
-	if bin_match is not None:
-		return int(bin_match.group(1), 2)
-	raise ValueError(f"Could not parse number {test_str}")
+	value = try_read(test_str)
+	if value is None:
+		raise ValueError(f"Could not parse number {test_str.replace('_', '').strip()}")
+	return value
@@ -0,0 +1,152 @@
+"""
+Round-trip tests for iron_disasm: every opcode with the operands at the edges of what the assembler encodes the same
+way, and random images from fixed seeds. Run with `python -m pytest tests` or `python -m unittest discover tests`.
+"""
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import iron_disasm  # noqa: E402
+from iron_disasm import OPCODE_TABLE, decode, disassemble, read_prg, round_trip, unit_lengths  # noqa: E402
+
+NOP = b"\xEA"
+_MARGIN = 130  # NOPs on each side, so branches of -128 and +127 land on an instruction
+_OPERANDS = (
+	b"\x00\x00", b"\xFF\x00", b"\x00\x01", b"\xFF\xFF", b"\x10\x00", b"\x10\x01", b"\x7F\xEA", b"\x80\xEA"
+)
+
+# Operands the assembler encodes as they are, where $1234 isn't: a zero pad byte, and a branch to just after itself
+_PLAIN_OPERANDS = {"X_INDIRECT": b"\x34\x00", "INDIRECT_Y": b"\x34\x00", "RELATIVE": b"\x00\xEA"}
+
+
+def _modes(*addr_modes: str) -> list[int]:
+	return [opcode for opcode, entry in enumerate(OPCODE_TABLE) if entry is not None and entry[1] in addr_modes]
+
+
+def _lengths(data: bytes) -> dict[int, int]:
+	units, lengths = decode(data)
+	return dict(zip(units, lengths))
+
+
+class OpcodeTests(unittest.TestCase):
+	def test_every_opcode_round_trips(self) -> None:
+		for opcode in range(0x100):
+			for operand in _OPERANDS:
+				with self.subTest(opcode=f"${opcode:02X}", operand=operand.hex()):
+					data = NOP * _MARGIN + bytes((opcode,)) + operand + NOP * _MARGIN
+					self.assertIsNone(round_trip(data))
+
+	def test_unused_opcodes_are_data(self) -> None:
+		for opcode, entry in enumerate(OPCODE_TABLE):
+			if entry is None:
+				with self.subTest(opcode=f"${opcode:02X}"):
+					self.assertEqual(_lengths(bytes((opcode,)) + NOP)[0], 1)
+					self.assertTrue(disassemble(bytes((opcode,))).startswith(f".BYTE ${opcode:02X}"))
+
+	def test_opcode_table_matches_lengths(self) -> None:
+		self.assertEqual(len(OPCODE_TABLE), 0x100)
+		for opcode, entry in enumerate(OPCODE_TABLE):
+			if entry is not None:
+				operand = _PLAIN_OPERANDS.get(entry[1], b"\x34\x12")
+				with self.subTest(opcode=f"${opcode:02X}"):
+					self.assertEqual(_lengths(bytes((opcode,)) + operand)[0], entry[2])
+
+
+class BoundaryTests(unittest.TestCase):
+	def test_absolute_addresses_in_zero_page_are_data(self) -> None:
+		# The assembler picks zero page for any address below $100, so only $0100 and up can be absolute
+		for opcode in _modes("ABSOLUTE", "ABSOLUTE_X", "ABSOLUTE_Y"):
+			with self.subTest(opcode=f"${opcode:02X}"):
+				self.assertEqual(_lengths(bytes((opcode, 0xFF, 0x00)))[0], 1)
+				self.assertEqual(_lengths(bytes((opcode, 0x00, 0x01)))[0], 3)
+
+	def test_zero_page_operands_are_one_byte(self) -> None:
+		for opcode in _modes("ZERO_PAGE", "ZERO_PAGE_X", "ZERO_PAGE_Y", "IMMEDIATE"):
+			with self.subTest(opcode=f"${opcode:02X}"):
+				self.assertEqual(_lengths(bytes((opcode, 0xFF)) + NOP), {0: 2, 2: 1})
+
+	def test_indirect_indexed_modes_need_their_zero_pad_byte(self) -> None:
+		for opcode in _modes("X_INDIRECT", "INDIRECT_Y"):
+			with self.subTest(opcode=f"${opcode:02X}"):
+				self.assertEqual(_lengths(bytes((opcode, 0x10, 0x00)))[0], 3)
+				self.assertEqual(_lengths(bytes((opcode, 0x10, 0x01)))[0], 1)
+
+	def test_instructions_cut_off_by_the_end_are_data(self) -> None:
+		for opcode in _modes("ABSOLUTE", "X_INDIRECT"):
+			with self.subTest(opcode=f"${opcode:02X}"):
+				self.assertEqual(_lengths(bytes((opcode, 0x00))), {0: 1, 1: 1})
+				self.assertIsNone(round_trip(bytes((opcode, 0x00))))
+
+	def test_branch_offsets(self) -> None:
+		for opcode in _modes("RELATIVE"):
+			for offset in (0x7F, 0x80, 0x00, 0xFE):
+				with self.subTest(opcode=f"${opcode:02X}", offset=offset):
+					data = NOP * _MARGIN + bytes((opcode, offset)) + NOP * _MARGIN
+					self.assertEqual(_lengths(data)[_MARGIN], 2)
+					self.assertIsNone(round_trip(data))
+
+	def test_branches_off_the_image_are_data(self) -> None:
+		for opcode in _modes("RELATIVE"):
+			for offset in (0x7F, 0x80):
+				with self.subTest(opcode=f"${opcode:02X}", offset=offset):
+					data = bytes((opcode, offset)) + NOP * 4
+					self.assertEqual(_lengths(data)[0], 1)
+					self.assertIsNone(round_trip(data))
+
+	def test_branches_into_an_instruction_are_data(self) -> None:
+		# BNE +1 lands on the operand of the LDA $1234 after it
+		data = b"\xD0\x01\xAD\x34\x12" + NOP
+		self.assertEqual(_lengths(data)[0], 1)
+		self.assertIsNone(round_trip(data))
+
+
+class ReadPrgTests(unittest.TestCase):
+	def read(self, header: bytes, body: bytes) -> bytes:
+		with tempfile.TemporaryDirectory() as temp_dir:
+			rom_path = os.path.join(temp_dir, "rom.nes")
+			with open(rom_path, "wb") as rom_file:
+				rom_file.write(b"NES\x1a" + header.ljust(12, b"\x00") + body)
+			return read_prg(rom_path)
+
+	def test_bank_counts(self) -> None:
+		body = bytes(range(0x100)) * 0x100 + b"CHR" * 0x100
+		self.assertEqual(self.read(b"\x01\x01", body), body[:0x4000])
+		# NES 2.0, whose byte 9 holds the high bits of the count
+		self.assertEqual(self.read(b"\x02\x01\x00\x08\x00\x00", body + bytes(0x4000)), body[:0x8000])
+
+	def test_exponent_multiplier_sizes(self) -> None:
+		# 2 ** 13 * 3 bytes, as !PRG_SIZE 3 13 writes it: multiplier 3 as 1, exponent 13, and $F in byte 9
+		body = bytes(range(0x100)) * 0x60 + b"CHR" * 0x100
+		prg = self.read(bytes((13 << 2 | 1, 0x01, 0x00, 0x08, 0x00, 0x0F)), body)
+		self.assertEqual(prg, body[:0x6000])
+
+	def test_short_files_are_rejected(self) -> None:
+		with self.assertRaises(ValueError):
+			self.read(b"\x02", bytes(0x4000))
+
+
+class FuzzTests(unittest.TestCase):
+	def test_random_images_round_trip(self) -> None:
+		for seed in range(8):
+			with self.subTest(seed=seed):
+				data = random.Random(seed).randbytes(0x2000)
+				self.assertIsNone(round_trip(data))
+
+	@unittest.skipIf(iron_disasm.numpy is None, "NumPy isn't installed")
+	def test_numpy_lengths_match_plain_python(self) -> None:
+		data = random.Random(1).randbytes(0x2000)
+		numpy = iron_disasm.numpy
+		try:
+			iron_disasm.numpy = None
+			expected = unit_lengths(data)
+		finally:
+			iron_disasm.numpy = numpy
+		self.assertEqual(unit_lengths(data), expected)
+
+
+if __name__ == "__main__":
+	unittest.main()